@@ -216,6 +216,7 @@ shells = None # The shell stack instance
 main = None # The mainwindow
 icon = None # The icon 
 parser = None # The source parser
+symbolIndex = None # The index of the symbols in the user's projects
 status = None # The statusbar (or None)
 
 # Get directories of interest
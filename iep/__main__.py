@@ -46,5 +46,9 @@ else:
         except ImportError:
             raise ImportError('Could not import IEP in either way.')
 
-# Start IEP
-iep.startIep()
+# Start IEP (worker processes, e.g. of the source parser, import this 
+# module too, but should not start IEP)
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    iep.startIep()
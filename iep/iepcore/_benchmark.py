@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012, the IEP development team
+#
+# IEP is distributed under the terms of the (new) BSD License.
+# The full license can be found in 'license.txt'.
+
+""" This script measures the speed of some of the text processing in IEP,
+using generated input, so that the results can be reproduced. Run it
+from the directory that contains the iep package:
+
+    python iep/iepcore/_benchmark.py
+
+To compare with an older version of IEP, run the same script in a
+checkout of that version.
+"""
+
+import os, sys, time
+
+## Make sure that the iep package in this directory is imported
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..', '..')))
+
+
+def timeIt(func, *args):
+    """ timeIt(func, *args)
+    Call the function with the given arguments a few times and return
+    the shortest time it took. Slow functions are called only once.
+    """
+    times = []
+    while len(times) < 3 and sum(times) < 1.0:
+        t0 = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def benchWashMultilineStrings():
+    """ benchWashMultilineStrings()
+    Remove the multiline strings from a module of 50k lines with 11k
+    docstrings (see washMultilineStrings in codeparser.py).
+    """
+    from iep.iepcore.codeparser import washMultilineStrings
+    
+    chunk = '''class Foo{0}(object):
+    """ Docstring of class {0}.
+    With 'quotes' and "more" of them. # not a comment
+    """
+    def method(self, x):
+        """ Method docstring. """
+        s = "it's a string"  # comment with \'\'\'
+        return x
+
+'''
+    text = ''.join(chunk.format(i) for i in range(5556))
+    print('washMultilineStrings, %i lines, %i multiline strings: %.3f s' % (
+            text.count('\n'), text.count('"""') // 2,
+            timeIt(washMultilineStrings, text)))
+
+
+def benchShellControlChars():
+    """ benchShellControlChars()
+    Process 20k messages of a progress bar that are received by the shell
+    at once, as write() does before the text is inserted: first with
+    carriage returns, then with backspaces (see _handleBackspacesOnList
+    and _handleBackspaces in shell.py).
+    """
+    from iep.iepcore.shell import BaseShell
+    
+    # The methods only process text, so they can be used without a widget,
+    # using a cursor that does nothing
+    class Cursor:
+        StartOfBlock = Left = None
+        def clearSelection(self): pass
+        def movePosition(self, *args): pass
+        def removeSelectedText(self): pass
+        def positionInBlock(self): return 0
+    class Handler:
+        _cursor1 = Cursor()
+        _pendingCR = False
+    for name in ['_handleBackspacesOnList', '_handleBackspaces',
+                 '_handleControlChars', '_handleBackspaces_split']:
+        if hasattr(BaseShell, name):
+            setattr(Handler, name, getattr(BaseShell, name))
+    
+    def process(messages):
+        handler = Handler()
+        # The list is copied, because older versions modify it in place
+        texts = handler._handleBackspacesOnList(list(messages))
+        return [handler._handleBackspaces(text) for text in texts]
+    
+    # Each message replaces the previous bar
+    n = 20000
+    bars = ['%3i%%|%-50s| %i/%i' % (i*100//n, '#'*(i*50//n), i, n)
+            for i in range(n)]
+    cr = ['\r' + bar for bar in bars]
+    bs = bars[:1] + ['\b'*len(bars[i-1]) + bars[i] for i in range(1, n)]
+    for kind, messages in [('carriage returns', cr), ('backspaces', bs)]:
+        size = sum(len(text) for text in process(messages))
+        print('Shell output, %i messages with %s: %.3f s, '
+              '%i characters to insert' % (n, kind, timeIt(process, messages),
+                                           size))
+
+
+if __name__ == '__main__':
+    benchWashMultilineStrings()
+    benchShellControlChars()
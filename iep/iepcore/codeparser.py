@@ -14,7 +14,9 @@ structure of a source file in for example a tree widget.
 
 #TODO: replace this module, get data from the syntax highlighter in the code editor
 
-import time, threading, re
+import sys, time, threading, re, bisect, copy, weakref, ast
+import multiprocessing, concurrent.futures
+from collections import OrderedDict
 from iep.codeeditor.qt import QtCore, QtGui
 import iep
 
@@ -35,19 +37,42 @@ defPattern += r'\((.*?)\)' # The SIGNATURE
 #defPattern += r'\s*:' # Optional whitespace and the colon
 # Leave the colon, easier for cython
 
+# The maximum number of objects in the cached results of all editors. The
+# least recently used results are dropped first. The result of the most
+# recently used editor is always kept.
+MAX_CACHED_OBJECTS = 100000
+
+
 class Job:
-    """ Simple class to represent a job. """
-    def __init__(self, text, editorId):
-        self.text = text
+    """ Simple class to represent a job.
+    The lines are the lines (i.e. blocks) of the document. If dirty is
+    given, it is a tuple (nStart, nEnd, oStart, oEnd) of block numbers,
+    indicating that the lines nStart:nEnd replace the lines oStart:oEnd
+    of the text of the previous result.
+    """
+    def __init__(self, lines, editorId, revision, dirty=None):
+        self.lines = lines
         self.editorId = editorId
+        self.revision = revision
+        self.dirty = dirty
+        self.time = time.time()
 
 
 class Result:
-    """ Simple class to represent a parser result. """
-    def __init__(self, rootItem, importList, editorId):
+    """ Simple class to represent a parser result. The attribute fromAst
+    tells whether it was produced by analyzeWithAst().
+    """
+    def __init__(self, rootItem, importList, job):
         self.rootItem = rootItem
         self.importList = importList
-        self.editorId = editorId
+        self.fromAst = False
+        self.editorId = job.editorId
+        self.revision = job.revision
+        self.lines = job.lines
+        # Index the classes and defs, and count the objects (except root)
+        scopes = []
+        self.objectCount = countObjects(rootItem, scopes) - 1
+        self.scopeIndex = ScopeIndex(scopes)
     
     def isMatch(self, editorId):
         """ isMatch(editorId):
@@ -67,17 +92,41 @@ class Parser(threading.Thread):
     to extract information from the result.
     """
     
-    def __init__(self):
+    def __init__(self, debounce=None, useProcess=None):
         threading.Thread.__init__(self)
         
-        # Reference current job
-        self._job = None
+        # The pending jobs, by editor id
+        self._jobs = {}
+        self._newJob = False
+        
+        # The results of each editor, the least recently used first
+        self._results = OrderedDict()
         
-        # Reference to last result
-        self._result = None
+        # The lines of each editor, which are kept up to date using the
+        # changes reported by the editor. Also weak references to the 
+        # editors, so we can tell when an id is reused.
+        self._lines = {}
+        self._editorRefs = {}
         
-        # Lock to enable save threading
+        # Lock to enable save threading. The condition is used to wake
+        # up the parser thread when a new job comes in (or when we stop).
         self._lock = threading.RLock()
+        self._condition = threading.Condition(self._lock)
+        
+        # The time (in seconds) that the text should be left alone before
+        # it is parsed. Bursts of parseThis() calls are coalesced this way.
+        if debounce is None:
+            debounce = iep.config.advanced.parserDebounce / 1000.0
+        self._debounce = max(0.0, float(debounce))
+        
+        # Whether to analyze files in a worker process using the ast
+        # module. Changes are then not analyzed incrementally (the result 
+        # would mix both analyzers). The process pool is created when it 
+        # is first needed.
+        if useProcess is None:
+            useProcess = iep.config.advanced.parserUseProcess
+        self._useProcess = bool(useProcess)
+        self._pool = None
         
         # Set deamon
         self.daemon = True
@@ -85,24 +134,114 @@ class Parser(threading.Thread):
     
     
     def stop(self, timeout=1.0):
-        self._exit = True
+        with self._condition:
+            self._exit = True
+            self._condition.notify()
         self.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
     
     
-    def parseThis(self, editor):
-        """ parseThis(editor)
+    def parseThis(self, editor, change=None):
+        """ parseThis(editor, change=None)
         Give the parser new text to parse.
         If the parser is busy parsing text, it will stop doing that
-        and start anew with the most recent version of the text. 
+        and start anew with the most recent version of the text.
+        
+        The change can be given as a (position, charsRemoved, charsAdded)
+        tuple, as emitted by the contentsChange signal of the document.
+        In that case only the changed blocks are obtained from the editor,
+        and only the affected top-level definitions are re-analyzed.
+        """
+        
+        editorId = id(editor)
+        revision = editor.document().revision()
+        
+        with self._condition:
+            
+            # Forget what we know if this id belonged to another editor
+            ref = self._editorRefs.get(editorId)
+            if ref is None or ref() is not editor:
+                self.forget(editorId)
+                self._editorRefs[editorId] = weakref.ref(editor)
+            
+            job = self._jobs.get(editorId)
+            result = self._results.get(editorId)
+            
+            # Get the changed lines, or else all text
+            lines, dirty = None, None
+            if change is not None and editorId in self._lines:
+                tmp = self._getChangedLines(editor, change)
+                if tmp is False:
+                    # Only the formatting changed, or the text was replaced
+                    # by the same text. Mark the most recent text as current.
+                    ob = job if job is not None else result
+                    if ob is not None:
+                        ob.revision = revision
+                    return
+                elif tmp is not None:
+                    lines, dirty = tmp
+            elif (change is None and job is None and result is not None and
+                    result.revision == revision):
+                return # This text has already been parsed
+            if lines is None:
+                lines = editor.toPlainText().split('\n')
+            self._lines[editorId] = lines
+            
+            # A pending job for this editor has not been analyzed yet,
+            # so its changes should be combined with ours
+            if job is not None:
+                dirty = mergeDirtyRanges(job.dirty, dirty)
+            
+            # Make job and wake up the parser thread
+            self._jobs[editorId] = Job(lines, editorId, revision, dirty)
+            self._newJob = True
+            self._condition.notify()
+    
+    
+    def forget(self, editor):
+        """ forget(editor)
+        Forget the cached results and pending jobs of the given editor
+        (or editor id), e.g. because it was closed.
+        """
+        editorId = editor if isinstance(editor, int) else id(editor)
+        with self._lock:
+            for d in [self._jobs, self._results, self._lines, self._editorRefs]:
+                d.pop(editorId, None)
+    
+    
+    def _getChangedLines(self, editor, change):
+        """ _getChangedLines(editor, change)
+        Update our copy of the lines of the editor using the given change.
+        Returns a (lines, dirty) tuple, None if the change could not be
+        applied, or False if the text did not change.
         """
         
-        # Get text
-        text = editor.toPlainText()
+        position, charsRemoved, charsAdded = change
+        doc = editor.document()
+        lines = self._lines[id(editor)]
+        
+        # Get the range of blocks that changed, in the new and old text
+        block = doc.findBlock(position)
+        first = block.blockNumber()
+        last = doc.findBlock(position + charsAdded).blockNumber()
+        if last < 0:
+            last = doc.blockCount() - 1
+        oldLast = last - (doc.blockCount() - len(lines))
+        if first < 0 or oldLast < first or oldLast >= len(lines):
+            return None
+        
+        # Get the text of the changed blocks
+        newLines = []
+        for i in range(first, last+1):
+            newLines.append(block.text())
+            block = block.next()
+        if newLines == lines[first:oldLast+1]:
+            return False
         
-        # Make job
-        self._lock.acquire()
-        self._job = Job(text, id(editor))
-        self._lock.release()
+        # Create a new list (the old one may be in use by the parser thread)
+        lines = lines[:first] + newLines + lines[oldLast+1:]
+        return lines, (first, last+1, first, oldLast+1)
     
     
     def getFictiveNameSpace(self, editor):
@@ -112,8 +251,8 @@ class Parser(threading.Thread):
         """
         
         # Obtain result
-        result = self._getResult()
-        if result is None or not result.isMatch(editor):
+        result = self._getResult(editor)
+        if result is None:
             return []
         
         # Get linenr and indent. These are used to establish the namespace
@@ -122,31 +261,19 @@ class Parser(threading.Thread):
         linenr = cursor.blockNumber()
         index = cursor.positionInBlock()
         
-        # init empty namespace and item list
-        namespace = [];        
-        items = result.rootItem.children
-        curIsClass = False # to not add methods (of classes)
+        # Names at module level
+        namespace = [   item.name for item in result.rootItem.children 
+                        if item.type in ['class', 'def'] ]
+        
+        # Go down the scopes that contain the current line, as long as
+        # we are indented in them. Methods of classes are not added.
+        for scope in result.scopeIndex.getScopes(linenr):
+            if scope.indent >= index:
+                break
+            if scope.type != 'class':
+                namespace.extend([  item.name for item in scope.children
+                                    if item.type in ['class', 'def'] ])
         
-        while items:
-            curitem = None
-            for item in items:
-                # append name
-                if not curIsClass and item.type in ['class', 'def']:
-                    namespace.append( item.name )
-                # check if this is the one only last one remains
-                if (item.type in ['class', 'def'] and 
-                    item.linenr <= linenr and item.linenr2 > linenr):
-                    curitem = item
-            # prepare for next round
-            if curitem and curitem.indent < index:
-                items = curitem.children
-                if curitem.type=='class':
-                    curIsClass = True
-                else:
-                    curIsClass = False
-            else:
-                items = []
-                
         return namespace
     
     
@@ -197,8 +324,8 @@ class Parser(threading.Thread):
         """
         
         # Obtain result
-        result = self._getResult()
-        if result is None or not result.isMatch(editor):
+        result = self._getResult(editor)
+        if result is None:
             return [], []
         
         # Extract list of names and dict of lines
@@ -210,14 +337,42 @@ class Parser(threading.Thread):
         return imports, importlines
     
     
-    def _getResult(self):
-        """ getResult()
-        Savely Obtain result.
+    def _getResult(self, editor=None):
+        """ _getResult(editor=None)
+        Savely obtain the result for the given editor (or editor id), 
+        or None if there is no (cached) result. If no editor is given,
+        returns the most recent result.
+        """
+        with self._lock:
+            if editor is None:
+                if not self._results:
+                    return None
+                editorId = next(reversed(self._results))
+            elif isinstance(editor, int):
+                editorId = editor
+            else:
+                editorId = id(editor)
+            result = self._results.get(editorId)
+            if result is not None:
+                self._results.move_to_end(editorId)
+            return result
+    
+    
+    def _storeResult(self, result):
+        """ _storeResult(result)
+        Store the result and drop the least recently used results if
+        the cache has grown too large. Must be called with the lock
+        acquired.
         """
-        self._lock.acquire()
-        result = self._result
-        self._lock.release()
-        return result
+        self._results.pop(result.editorId, None)
+        self._results[result.editorId] = result
+        # Drop old results
+        total = sum(r.objectCount for r in self._results.values())
+        while total > MAX_CACHED_OBJECTS and len(self._results) > 1:
+            editorId, oldResult = self._results.popitem(last=False)
+            total -= oldResult.objectCount
+            if editorId not in self._jobs:
+                self._lines.pop(editorId, None)
     
     
     def _getFictiveItem(self, name, type, editor, handleSelf=False):
@@ -228,8 +383,8 @@ class Parser(threading.Thread):
         """
         
         # Obtain result
-        result = self._getResult()
-        if result is None or not result.isMatch(editor):
+        result = self._getResult(editor)
+        if result is None:
             return None
         
         # Split name in parts 
@@ -277,7 +432,7 @@ class Parser(threading.Thread):
         """
         
         # Obtain result
-        result = self._getResult()
+        result = self._getResult(editor)
         if result is None:
             return None
         
@@ -287,28 +442,14 @@ class Parser(threading.Thread):
         index = cursor.positionInBlock()
         
         
-        # Init
-        items = result.rootItem.children
+        # Go down the scopes that contain the current line, as long as
+        # we are indented in them
         theclass = None
-        
-        while items:
-            curitem = None
-            for item in items:                
-                # check if this is the one only last one remains
-                if item.linenr <= linenr:                    
-                    if not item.linenr2 > linenr:
-                        continue
-                    curitem = item
-                    if item.type == 'def' and item.selfname==selfname:
-                        theclass = item.parent
-                else:
-                    break
-            
-            # prepare for next round
-            if curitem and curitem.indent < index:
-                items = curitem.children
-            else:
-                items = []      
+        for scope in result.scopeIndex.getScopes(linenr):
+            if scope.type == 'def' and scope.selfname == selfname:
+                theclass = scope.parent
+            if scope.indent >= index:
+                break
         
         # return
         return theclass
@@ -316,57 +457,250 @@ class Parser(threading.Thread):
     
     def run(self):
         """ run()
-        This is the main loop.
+        This is the main loop. The thread sleeps until a job is posted
+        (or until we are stopped), and then waits until the text has
+        been left alone for the debounce time before parsing it.
         """
         
-        time.sleep(0.5)
         try:
             while True:
-                time.sleep(0.1)
                 
-                if self._exit:
-                    return
+                # Savely obtain job
+                with self._condition:
+                    job = self._waitForJob()
+                    if job is None:
+                        return
+                    del self._jobs[job.editorId]
+                    self._newJob = False
                 
-                if self._job:
-                    
-                    # Savely obtain job
-                    self._lock.acquire()
-                    job = self._job
-                    self._job = None
-                    self._lock.release()
-                    
-                    # Analyse job
-                    result = self._analyze(job)
-                    
-                    # Savely store result
-                    self._lock.acquire()
-                    self._result = result
-                    self._lock.release()
-                    
-                    # Notify 
-                    if iep.editors is not None:
-                        iep.editors.parserDone.emit()
+                # Analyse job
+                result = self._analyze(job)
+                
+                # Savely store result. If we were interrupted by a new job,
+                # our job should be done later, or be combined with a new 
+                # job for the same editor.
+                with self._condition:
+                    if result is None:
+                        pending = self._jobs.get(job.editorId)
+                        if pending is not None:
+                            pending.dirty = mergeDirtyRanges(job.dirty,
+                                                             pending.dirty)
+                        elif job.editorId in self._lines:
+                            self._jobs[job.editorId] = job
+                        continue
+                    if job.editorId in self._lines:
+                        self._storeResult(result)
+                
+                # Notify 
+                if iep.editors is not None:
+                    iep.editors.parserDone.emit()
             
         except AttributeError:
             pass # when python exits, time can be None...
     
     
+    def _waitForJob(self):
+        """ _waitForJob()
+        Block until there is a job that has not been superseded for
+        the debounce time. Returns None if the parser should exit.
+        Must be called with the condition acquired.
+        """
+        while not self._exit:
+            if not self._jobs:
+                self._condition.wait()
+                continue
+            # Wait until the most recent job is old enough. A new
+            # parseThis() call during the wait resets the clock.
+            job = max(self._jobs.values(), key=lambda job: job.time)
+            remaining = job.time + self._debounce - time.time()
+            if remaining > 0:
+                self._condition.wait(remaining)
+            else:
+                return job
+        return None
+    
+    
     def _analyze(self, job):
-        """ The core function.
-        Analyses the source code.
-        Produces:
-        - a tree of FictiveObject objects.
-        - a (flat) list of the same object
-        - a list of imports
-        """    
+        """ _analyze(job)
+        Analyses the source code of the job and produces a Result object.
+        If the job tells which lines have changed, only the affected
+        top-level definitions are analyzed, unless the worker process is
+        used. Returns None if interrupted.
+        """
+        
+        # Try to analyze only the part that changed. Only for results of
+        # the line-based analysis, so that a result never mixes analyzers.
+        with self._lock:
+            result = self._results.get(job.editorId)
+        if (job.dirty and result is not None and not result.fromAst and
+                not self._useProcess):
+            region = self._getDirtyRegion(job, result)
+            if region is not None:
+                return self._analyzeIncremental(job, result, *region)
         
-        # Remove multiline strings
-        text = washMultilineStrings(job.text)
+        # Try to analyze in the worker process
+        if self._useProcess:
+            tmp = self._analyzeInProcess(job)
+            if tmp is None:
+                return None
+            elif tmp is not False:
+                root, importList = tmp
+                result = Result(root, importList, job)
+                result.fromAst = True
+                return result
         
-        # Split text in lines
-        lines = text.splitlines()
+        # Remove multiline strings and split text in lines
+        text = washMultilineStrings('\n'.join(job.lines))
+        lines = text.split('\n')
         lines.insert(0,"") # so the lines start at 1
         
+        # Analyse all lines
+        tmp = self._analyzeLines(lines, 0, len(lines))
+        if tmp is None:
+            return None
+        root, importList = tmp
+        return Result(root, importList, job)
+    
+    
+    def _analyzeInProcess(self, job):
+        """ _analyzeInProcess(job)
+        Analyse the source code of the job in the worker process, using
+        the ast module. Returns a (root, importList) tuple, None if 
+        interrupted, or False if the code could not be analyzed this way.
+        """
+        
+        # Submit to the pool. Use spawn, because forking a process that 
+        # runs Qt and several threads is not safe.
+        try:
+            if self._pool is None:
+                context = multiprocessing.get_context('spawn')
+                self._pool = concurrent.futures.ProcessPoolExecutor(1, 
+                                                            mp_context=context)
+            future = self._pool.submit(analyzeWithAst, job.lines)
+        except Exception as err:
+            print('Could not analyze source in a worker process: ' + str(err))
+            self._useProcess = False
+            return False
+        
+        # Wait for the result, or until we are interrupted. The future
+        # cannot be stopped once it is running; the worker process will
+        # pick up the new job when it is done.
+        future.add_done_callback(self._onFutureDone)
+        with self._condition:
+            while not (future.done() or self._newJob or self._exit):
+                self._condition.wait()
+        if not future.done():
+            future.cancel()
+            return None
+        
+        try:
+            return future.result()
+        except Exception as err:
+            print('Could not analyze source in a worker process: ' + str(err))
+            if isinstance(err, concurrent.futures.BrokenExecutor):
+                self._useProcess = False
+            return False
+    
+    
+    def _onFutureDone(self, future):
+        """ Wake up the parser thread when the worker process is done. """
+        with self._condition:
+            self._condition.notify()
+    
+    
+    def _getDirtyRegion(self, job, result):
+        """ _getDirtyRegion(job, result)
+        Get the region (start, end) of line numbers in the previous result
+        that should be analyzed again. The region is bounded by top-level
+        classes and defs; end is None if the region runs to the end of
+        the text. Returns None if the whole text should be analyzed.
+        """
+        
+        nStart, nEnd, oStart, oEnd = job.dirty
+        if result.lines is None or oEnd > len(result.lines):
+            return None
+        
+        # Adding or removing triple quotes can affect all text after it
+        for lines, i1, i2 in [  (result.lines, oStart, oEnd),
+                                (job.lines, nStart, nEnd) ]:
+            for line in lines[i1:i2]:
+                if "'''" in line or '"""' in line:
+                    return None
+        
+        # Get line numbers of top-level definitions
+        bounds = [item.linenr for item in result.rootItem.children
+                    if item.type in ['class', 'def'] and item.indent == 0]
+        
+        # The region starts at a definition before the first changed line
+        # (far enough to include multiline defs that reach into the change)
+        # and ends at the first definition after the last changed line.
+        # Note that line numbers are block numbers plus one.
+        i = bisect.bisect_left(bounds, oStart + 1 - 4)
+        start = bounds[i-1] if i else 1
+        i = bisect.bisect_left(bounds, oEnd + 1)
+        end = bounds[i] if i < len(bounds) else None
+        return start, end
+    
+    
+    def _analyzeIncremental(self, job, result, start, end):
+        """ _analyzeIncremental(job, result, start, end)
+        Analyse the given region of the text and splice the new objects
+        into a copy of the tree of the previous result.
+        Returns None if interrupted.
+        """
+        
+        nStart, nEnd, oStart, oEnd = job.dirty
+        delta = (nEnd - nStart) - (oEnd - oStart)
+        
+        # Get where the region ends in the new text
+        if end is None:
+            newEnd = len(job.lines) + 1
+        else:
+            newEnd = end + delta
+        
+        # Wash the region (plus a few lines for multiline defs). Since
+        # the region is bounded by definitions, it is not inside a string.
+        text = washMultilineStrings('\n'.join(job.lines[start-1:newEnd+3]))
+        lines = [''] * start + text.split('\n')
+        
+        # Analyse the region
+        tmp = self._analyzeLines(lines, start, newEnd, end is not None)
+        if tmp is None:
+            return None
+        region, regionImports = tmp
+        
+        # Combine the objects before, in and after the region. The objects
+        # of the previous result are copied, since it may still be in use.
+        root = FictiveObject("root", 0, -1, 'root')
+        importList = []
+        for item in result.rootItem.children:
+            if item.linenr < start:
+                item = shiftedCopy(item, 0, root, importList)
+                root.children.append(item)
+        for item in region.children:
+            item.parent = root
+            root.children.append(item)
+        importList.extend(regionImports)
+        if end is not None:
+            for item in result.rootItem.children:
+                if item.linenr >= end:
+                    item = shiftedCopy(item, delta, root, importList)
+                    root.children.append(item)
+        
+        return Result(root, importList, job)
+    
+    
+    def _analyzeLines(self, lines, start, end, close=False):
+        """ _analyzeLines(lines, start, end, close=False)
+        The core function.
+        Analyses the (washed) lines from start up to end.
+        Produces:
+        - a tree of FictiveObject objects.
+        - a list of imports
+        If close is True, objects that are still open at the end are
+        closed at line end. Returns None if interrupted.
+        """
+        
         # The structure object. It will first only consist of class and defs
         # the rest will be inserted afterwards.
         root = FictiveObject("root", 0, -1, 'root')
@@ -399,15 +733,15 @@ class Parser(threading.Thread):
         
         # Find objects! 
         # type can be: cell, class, def, import, var 
-        for i in range( len(lines) ):
+        for i in range(start, end):
             
             # Obtain line
             line = lines[i]            
             linelen = len(line)
             
             # Should we stop?
-            if self._job or self._exit:
-                break
+            if self._newJob or self._exit:
+                return None
             
             # Remove indentation
             tmp = line.lstrip()
@@ -541,76 +875,228 @@ class Parser(threading.Thread):
                                     classItem.members.append(part2)
         
      
+        # Close the objects that are still open
+        if close:
+            while lastObject[0] is not root:
+                lastObject[0].linenr2 = end
+                lastObject[0] = lastObject[0].parent
+        
         ## Post processing
         
-        def getTwoItems(series, linenr):
-            """ Return the two items just above and below the 
-            given linenr. The object always is a class or def.
-            """
-            # find object after linenr
-            object1, object2 = None, None # if no items at all
-            i = -1  
-            for i in range(len(series)):
-                object = series[i]
-                if object.type not in ['class','def']:
-                    continue                
-                if object.linenr > linenr:
-                    object2 = object
-                    break
-            # find object just before linenr
-            for ii in range(i,-1,-1):
-                object = series[ii]
-                if object.type not in ['class','def']:
-                    continue            
-                if object.linenr < linenr:
-                    object1 = object                    
-                    break
-            # return result
-            return object1, object2
-                
-        # insert the leafs (backwards as the last inserted is at the top)
-        for leaf in reversed(leafs):
-            ob1, ob2 = getTwoItems(flatList, leaf.linenr)           
-            if ob1 is None: # also if ob2 is None 
-                # insert in root
-                root.children.insert(0,leaf)
-                leaf.parent = root
-                continue
-            if ob2 is None:
-                ob2parent = root
-            else:
-                ob2parent = ob2.parent
-                
+        # Insert the leafs in the object just above them
+        insertLeafs(root, flatList, leafs)
+        
+        # Return result
+        return root, importList
+
+
+
+## Analysis using the ast module (can be run in a worker process)
+
+
+def analyzeWithAst(lines):
+    """ analyzeWithAst(lines)
+    Analyses the source code using the ast module, which is more accurate
+    than the line-based analysis, but can only handle valid Python code.
+    Produces the same tree of FictiveObject objects and list of imports
+    as Parser._analyzeLines(). Returns False if the code cannot be parsed
+    (e.g. syntax errors or Cython code). This function is run in a 
+    worker process, so that large files do not keep the GUI busy.
+    """
+    
+    # Parse (positions of the source segments require Python 3.8)
+    text = '\n'.join(lines)
+    if sys.version_info < (3, 8) or '\r' in text:
+        return False
+    try:
+        tree = ast.parse(text)
+    except (SyntaxError, ValueError):
+        return False
+    
+    # Get the washed lines, starting at 1 (as Parser._analyzeLines)
+    washed = washMultilineStrings(text).split('\n')
+    washed.insert(0, '')
+    
+    # For each line, get the first line from there that contains code. 
+    # That is where a class or def is closed.
+    nextCode = [9999999] * (len(washed) + 1)
+    for i in range(len(washed)-1, 0, -1):
+        line = washed[i].strip()
+        nextCode[i] = i if (line and line[0] != '#') else nextCode[i+1]
+    
+    root = FictiveObject("root", 0, -1, 'root')
+    flatList = []
+    leafs = []
+    importList = []
+    
+    def getIndent(i):
+        line = washed[i]
+        return len(line) - len(line.lstrip())
+    
+    def getLine(i):
+        return washed[i].partition('#')[0].strip()
+    
+    def getSource(node):
+        # As ast.get_source_segment(), which splits the whole text each time
+        parts = [line.encode('utf-8') 
+                    for line in lines[node.lineno-1:node.end_lineno]]
+        parts[-1] = parts[-1][:node.end_col_offset]
+        parts[0] = parts[0][node.col_offset:]
+        return b'\n'.join(parts).decode('utf-8')
+    
+    def appendToStructure(item, node, parent):
+        item.linenr2 = nextCode[node.end_lineno+1]
+        item.parent = parent
+        parent.children.append(item)
+        flatList.append(item)
+    
+    def visit(nodes, parent, method):
+        # parent is the object that new classes and defs belong to, 
+        # method is the def in which attributes can be set (or None)
+        for node in nodes:
+            i = node.lineno
+            if isinstance(node, ast.ClassDef):
+                item = FictiveObject('class', i, getIndent(i), node.name)
+                item.supers = [getSource(base) for base in node.bases]
+                item.members = []
+                appendToStructure(item, node, parent)
+                visit(node.body, item, None)
             
-            # get the object IN which to insert it: ob1
-            sibling = None
-            while 1:            
-                canGoDeeper = ob1 is not ob2parent
-                canGoDeeper = canGoDeeper and ob1 is not root
-                shouldGoDeeper = ob1.indent >= leaf.indent 
-                shouldGoDeeper = shouldGoDeeper or ob1.linenr2 < leaf.linenr
-                if canGoDeeper and shouldGoDeeper:
-                    sibling = ob1
-                    ob1 = ob1.parent                
-                else:
-                    break
+            elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                item = FictiveObject('def', i, getIndent(i), node.name)
+                item.selfname = None
+                # Get the signature from the text (as Parser._analyzeLines)
+                multiLine = ' '.join([getLine(i)] + 
+                                [line.strip() for line in washed[i+1:i+5]])
+                if multiLine.startswith('async '):
+                    multiLine = multiLine[6:]
+                defResult = re.search(defPattern, multiLine)
+                if defResult:
+                    item.sig = defResult.group(4)
+                appendToStructure(item, node, parent)
+                if parent.type == 'class':
+                    parent.members.append(node.name)
+                    args = getattr(node.args, 'posonlyargs', []) + node.args.args
+                    if args:
+                        item.selfname = args[0].arg
+                visit(node.body, item, item if item.selfname else None)
             
-            # insert into ob1, after sibling (if available)
-            L = ob1.children        
-            if sibling:
-                i = L.index(sibling)
-                L.insert(i+1,leaf)
             else:
-                L.insert(0,leaf)
-        
-        # Return result
-        return Result(root, importList, job.editorId)
+                if isinstance(node, ast.Import):
+                    names = [alias.asname or alias.name for alias in node.names]
+                elif isinstance(node, ast.ImportFrom):
+                    names = [alias.asname or alias.name for alias in node.names
+                                if alias.name != '*']
+                else:
+                    names = []
+                for name in names:
+                    item = FictiveObject('import', i, getIndent(i), name)
+                    item.text = getLine(i)
+                    item.linenr2 = i+1 # an import is active at one line only
+                    leafs.append(item)
+                    importList.append(item)
+                
+                # Attributes that are set on the "self" of a method
+                if method is not None and isinstance(node, ast.Assign):
+                    targets = []
+                    for target in node.targets:
+                        if isinstance(target, (ast.Tuple, ast.List)):
+                            targets.extend(target.elts)
+                        else:
+                            targets.append(target)
+                    for target in targets:
+                        if (isinstance(target, ast.Attribute) and 
+                                isinstance(target.value, ast.Name) and
+                                target.value.id == method.selfname):
+                            name = target.attr
+                            item = FictiveObject('attribute', i, getIndent(i), name)
+                            item.parent = method
+                            method.children.append(item)
+                            if name not in method.parent.members:
+                                method.parent.members.append(name)
+                
+                # Look inside compound statements (if, for, try, with, ...)
+                for child in ast.iter_child_nodes(node):
+                    if isinstance(child, ast.stmt):
+                        visit([child], parent, method)
+                    elif isinstance(getattr(child, 'body', None), list):
+                        visit(child.body, parent, method) # except, case
+    
+    visit(tree.body, root, None)
+    
+    # Detect cells and todos
+    for i in range(1, len(washed)):
+        line = washed[i].strip()
+        if line.startswith('##'):
+            leafs.append(FictiveObject('cell', i, getIndent(i), line[2:].lstrip()))
+            continue
+        cmnt = line.partition('#')[2].lower().strip()
+        if cmnt and (cmnt.startswith('todo:') or cmnt.startswith('2do:') ):
+            item = FictiveObject('todo', i, getIndent(i), cmnt)
+            item.linenr2 = i+1 # a todo is active at one line only
+            leafs.append(item)
+    
+    # Insert the leafs, which must be sorted by line number (a todo
+    # goes before an import on the same line, as in _analyzeLines)
+    leafs.sort(key=lambda item: (item.linenr, item.type == 'import'))
+    insertLeafs(root, flatList, leafs)
+    return root, importList
 
 
 
 ## Helper classes and functions
 
 
+class ScopeIndex:
+    """ ScopeIndex(items)
+    An index of class and def objects (sorted by line number) to find
+    the objects around a line, and the scopes that contain a line, in 
+    O(log n) time.
+    """
+    def __init__(self, items):
+        self._items = items
+        self._linenrs = [item.linenr for item in items]
+    
+    def getTwoItems(self, linenr):
+        """ getTwoItems(linenr)
+        Return the two items just above and below the given linenr.
+        Either can be None.
+        """
+        i1 = bisect.bisect_left(self._linenrs, linenr)
+        i2 = bisect.bisect_right(self._linenrs, linenr)
+        object1 = self._items[i1-1] if i1 > 0 else None
+        object2 = self._items[i2] if i2 < len(self._items) else None
+        return object1, object2
+    
+    def getScope(self, linenr):
+        """ getScope(linenr)
+        Get the innermost class or def that contains the given line,
+        or None if the line is at module level.
+        """
+        i = bisect.bisect_right(self._linenrs, linenr)
+        if not i:
+            return None
+        # Any object that contains the line is a parent of the last
+        # object that starts before it
+        item = self._items[i-1]
+        while item.type != 'root' and item.linenr2 <= linenr:
+            item = item.parent
+        if item.type != 'root':
+            return item
+    
+    def getScopes(self, linenr):
+        """ getScopes(linenr)
+        Get the list of classes and defs that contain the given line,
+        starting with the outermost.
+        """
+        scopes = []
+        item = self.getScope(linenr)
+        while item is not None and item.type != 'root':
+            scopes.insert(0, item)
+            item = item.parent
+        return scopes
+
+
 class FictiveObject:
     """ An un-instantiated object.
     type can be class, def, import, cell, todo
@@ -630,9 +1116,98 @@ class FictiveObject:
         self.indent = indent
         self.name = name
         self.sig = ''  # for functions and methods
-    
+
+
+def shiftedCopy(item, delta, parent, importList):
+    """ shiftedCopy(item, delta, parent, importList)
+    Copy the given FictiveObject and its children, shifting the line
+    numbers by delta. Copied imports are appended to importList.
+    """
+    newItem = copy.copy(item)
+    newItem.parent = parent
+    if delta:
+        newItem.linenr += delta
+        if newItem.linenr2 != 9999999:
+            newItem.linenr2 += delta
+    newItem.children = [shiftedCopy(child, delta, newItem, importList)
+                        for child in item.children]
+    if newItem.type == 'import':
+        importList.append(newItem)
+    return newItem
+
+
+def countObjects(item, scopes=None):
+    """ countObjects(item, scopes=None)
+    Count the given FictiveObject and all its (grand)children. If a list
+    is given, the classes and defs are appended to it, in order of line.
+    """
+    count = 1
+    for child in item.children:
+        if scopes is not None and child.type in ['class', 'def']:
+            scopes.append(child)
+        count += countObjects(child, scopes)
+    return count
+
+
+def mergeDirtyRanges(dirty1, dirty2):
+    """ mergeDirtyRanges(dirty1, dirty2)
+    Combine two (nStart, nEnd, oStart, oEnd) ranges of changed lines,
+    where dirty2 describes a change made after dirty1. Returns None
+    if either is None (i.e. unknown).
+    """
+    if dirty1 is None or dirty2 is None:
+        return None
+    nStart1, nEnd1, oStart1, oEnd1 = dirty1
+    nStart2, nEnd2, oStart2, oEnd2 = dirty2
+    # Get the range that contains both, in the text between the changes
+    start = min(nStart1, oStart2)
+    end = max(nEnd1, oEnd2)
+    # Lines before the range did not move, lines after it did
+    return start, end + (nEnd2 - oEnd2), start, end - (nEnd1 - oEnd1)
+
 
 namechars = 'abcdefghijklmnopqrstuvwxyz_0123456789'
+def insertLeafs(root, flatList, leafs):
+    """ insertLeafs(root, flatList, leafs)
+    Insert the leafs (cells, todos, imports) in the tree of classes and 
+    defs. flatList is the list of classes and defs, sorted by line number.
+    """
+    
+    # Insert the leafs in the object just above them. Sort afterwards
+    # to get them in the right place among the other children.
+    index = ScopeIndex(flatList)
+    parents = {}
+    for leaf in leafs:
+        ob1, ob2 = index.getTwoItems(leaf.linenr)
+        if ob1 is None: # also if ob2 is None 
+            # insert in root
+            ob1 = root
+        elif ob2 is None:
+            ob2parent = root
+        else:
+            ob2parent = ob2.parent
+            
+        # get the object IN which to insert it: ob1
+        while ob1 is not root:
+            canGoDeeper = ob1 is not ob2parent
+            shouldGoDeeper = ob1.indent >= leaf.indent 
+            shouldGoDeeper = shouldGoDeeper or ob1.linenr2 < leaf.linenr
+            if canGoDeeper and shouldGoDeeper:
+                ob1 = ob1.parent                
+            else:
+                break
+            
+        # insert into ob1
+        ob1.children.append(leaf)
+        leaf.parent = ob1
+        parents[id(ob1)] = ob1
+        
+    # A leaf on the same line as a class or def goes before it
+    for ob in parents.values():
+        ob.children.sort(key=lambda item: 
+                            (item.linenr, item.type in ['class', 'def']))
+
+
 def IsValidName(name):
     """ Given a string, checks whether it is a 
     valid name (dots are not valid!)
@@ -656,107 +1231,34 @@ def ParseImport(names):
         yield name
 
 
-def findString(text, s, i):
-    """ findString(text, s)
-    Find s in text, but only if s is not in a string or commented
-    Helper function for washMultilineStrings """
-    
-    while True:
-        i = _findString(text, s, i)
-        if i<-1:
-            i = -i+1
-        else:
-            break
-    return i
-
-
-def _findString(text, s, i):
-    """ Helper function of findString, which is called recursively
-    until a match is found, or it is clear there is no match. """
-    
-    # Find occurance
-    i2 = text.find(s, i)
-    if i2<0:
-        return -1
-    
-    # Find newline  (if none, we're done)
-    i1 = text.rfind('\n', 0, i2)
-    if i1<0:
-        return i2
-    
-    # Extract the part on the line up to the match
-    line = text[i1:i2]
-    
-    # Count quotes, we're done if we found none
-    if not line.count('"') and not line.count("'") and not line.count('#'):
-        return i2
-    
-    # So we found quotes, now really count them ...
-    prev = ''
-    inString = '' # this is a boolean combined with a flag which quote was used
-    isComment = False
-    for c in line:
-        if c == '#':
-            if not inString:
-                isComment = True
-                break
-        elif c in "\"\'":
-            if not inString:
-                inString = c
-            elif prev != '\\':
-                if inString == c:
-                    inString = '' # exit string
-                else:
-                    pass # the other quote can savely be used inside this string
-        prev = c
-    
-    # If we are in a string, this match is false ...
-    if inString or isComment:
-        return -i2 # indicate failure and where to continue
+# Regular expression to find comments, strings and multiline strings. The 
+# comments and normal strings are matched so that quotes inside them are 
+# skipped. Normal strings cannot span lines.
+washPattern  = r'(\'\'\'[\s\S]*?(?:\'\'\'|\Z)|"""[\s\S]*?(?:"""|\Z))' # Multiline
+washPattern += r'|#[^\n]*' # Comment
+washPattern += r'|\'(?:[^\'\\\n]|\\.)*\'?' # Single-quoted string
+washPattern += r'|"(?:[^"\\\n]|\\.)*"?' # Double-quoted string
+washPattern = re.compile(washPattern)
+nonWhitePattern = re.compile(r'\S')
+
+
+def _washMatch(match):
+    """ Helper function for washMultilineStrings. """
+    s = match.group(1)
+    if s is None:
+        return match.group(0)
     else:
-        return i2 # all's right
-    
+        # Leave only the first two quotes of the start of the string
+        return s[:2] + nonWhitePattern.sub(' ', s[2:])
+
 
 def washMultilineStrings(text):
     """ washMultilineStrings(text)
     Replace all text within multiline strings with dummy chars
-    so that it is not parsed.
+    so that it is not parsed. This is done in a single pass over 
+    the text, so it takes linear time.
     """ 
-    i=0
-    s1 = "'''"
-    s2 = '"""' 
-    while i<len(text):
-        # Detect start of a multiline comment (there are two versions)
-        i1 = findString(text, s1, i)
-        i2 = findString(text, s2, i)
-        # Stop if nothing found ...
-        if i1 == -1 and i2 == -1:
-            break
-        else:
-            # Make no result be very large
-            if i1==-1:
-                i1 = 2**60
-            if i2==-1:
-                i2 = 2**60
-            # Find end of the multiline comment
-            if i1 < i2:
-                i3 = i1+3
-                i4 = text.find(s1, i3)
-            else:
-                i3 = i2+3
-                i4 = text.find(s2, i3)
-            # No end found -> take all text, unclosed string!
-            if i4==-1:
-                i4 = 2**32
-            # Leave only the first two quotes of the start of the comment
-            i3 -= 1
-            i4 += 3
-            # Replace all non-newline chars 
-            tmp = re.sub(r'\S', ' ', text[i3:i4])
-            text = text[:i3] + tmp + text[i3+len(tmp):]
-            # Prepare for next round
-            i = i4+1
-    return text
+    return washPattern.sub(_washMatch, text)
 
 """ 
 ## testing skipping of multiline strings
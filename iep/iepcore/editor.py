@@ -276,7 +276,7 @@ class IepEditor(BaseTextCtrl):
         self.modificationChanged.connect(self._onModificationChanged)
         
         # To see whether the doc has changed to update the parser.
-        self.textChanged.connect(self._onModified)
+        self.document().contentsChange.connect(self._onContentsChange)
         
         # This timer is used to hide the marker that shows which code is executed
         self._showRunCursorTimer = QtCore.QTimer()
@@ -418,8 +418,10 @@ class IepEditor(BaseTextCtrl):
         for the editorStack to update the modification notice."""
         self.somethingChanged.emit()
         
-    def _onModified(self):
-        iep.parser.parseThis(self)
+    def _onContentsChange(self, position, charsRemoved, charsAdded):
+        """Handler for the contentsChange signal. Let the parser update
+        the structure, given which part of the document changed."""
+        iep.parser.parseThis(self, (position, charsRemoved, charsAdded))
     
     def dropEvent(self, event):
         """ Drop files in the list. """        
@@ -583,6 +585,49 @@ class IepEditor(BaseTextCtrl):
 
     
     
+    def gotoDefinition(self):
+        """ gotoDefinition()
+        Go to the definition of the name under the cursor. The name is 
+        looked up in this file, and in the modules of the user's projects.
+        """
+        
+        # Get the (dotted) name under the cursor
+        cursor = self.textCursor()
+        text = cursor.block().text()
+        i1 = i2 = cursor.positionInBlock()
+        while i1 > 0 and (text[i1-1].isalnum() or text[i1-1] in '_.'):
+            i1 -= 1
+        while i2 < len(text) and (text[i2].isalnum() or text[i2] == '_'):
+            i2 += 1
+        name = text[i1:i2].strip('.')
+        if not name:
+            return
+        
+        # Is it defined in this file?
+        for type in ['class', 'def']:
+            item = iep.parser._getFictiveItem(name, type, self, True)
+            if item:
+                self.gotoLine(item.linenr)
+                return
+        
+        # Is it defined in one of the projects?
+        definition = None
+        if iep.symbolIndex is not None:
+            fullName = iep.symbolIndex.getFullName(name, self)
+            if fullName:
+                definition = iep.symbolIndex.getDefinition(fullName)
+        if not definition:
+            print('Could not find the definition of "%s".' % name)
+            return
+        
+        # Go there
+        filename, linenr = definition
+        result = iep.editors.loadFile(filename)
+        if result:
+            result._editor.gotoLine(linenr)
+            result._editor.setFocus()
+    
+    
     ## Introspection processing methods
     
     def processCallTip(self, cto):
@@ -594,6 +639,13 @@ class IepEditor(BaseTextCtrl):
         
         # Try obtaining calltip from the source
         sig = iep.parser.getFictiveSignature(cto.name, self, True)
+        
+        # Try obtaining calltip from the modules in the user's projects
+        if not sig and iep.symbolIndex is not None:
+            fullName = iep.symbolIndex.getFullName(cto.name, self)
+            if fullName:
+                sig = iep.symbolIndex.getSignature(fullName)
+        
         if sig:
             # Done
             cto.finish(sig)
@@ -646,6 +698,13 @@ class IepEditor(BaseTextCtrl):
                 else:
                     nameForShell = className
                     break
+            
+            # Names from the modules in the user's projects, so that these
+            # need not be imported in the shell
+            if iep.symbolIndex is not None:
+                fullName = iep.symbolIndex.getFullName(nameForShell, self)
+                if fullName:
+                    aco.addNames(iep.symbolIndex.getMembers(fullName))
          
         # If there's a shell, let it finish the autocompletion
         shell = iep.shells.getCurrentShell()
@@ -1252,6 +1252,10 @@ class EditorTabs(QtGui.QWidget):
         print("saved file: {} ({})".format(filename, editor.lineEndingsHumanReadable))
         self._tabs.updateItems()
         
+        # The file may be part of a project
+        if iep.symbolIndex is not None:
+            iep.symbolIndex.update()
+        
         # todo: this is where we once detected whether the file being saved was a style file.
         
         # Notify done
@@ -1339,6 +1343,8 @@ class EditorTabs(QtGui.QWidget):
                         break
             else:
                 self._tabs.removeTab(editor)
+            # The parser can forget about this editor
+            iep.parser.forget(editor)
         return result
      
     def closeAllFiles(self):
@@ -12,9 +12,15 @@ This module implements the interface between IEP and the kernel.
 
 import os, sys, time
 import subprocess
+import socket
+import tempfile
+import shutil
+import shlex
 import signal
 import threading
 import ctypes
+import codecs
+import select
 
 from pyzolib import ssdf
 import yoton
@@ -23,6 +29,17 @@ import iep # local IEP (can be on a different box than where the user is)
 
 # Important: the yoton event loop should run somehow!
 
+# The number of bytes to read from the kernel's stdout at once, and the
+# maximum number of bytes and time (in seconds) to collect output before
+# sending it to the IDE.
+STREAM_READ_SIZE = 2**16
+STREAM_MAX_CHUNK = 2**20
+STREAM_MAX_DELAY = 0.01
+
+# The time (in seconds) after a kernel is created to wait before starting
+# new kernels for the pool, so that they do not slow down its startup.
+POOL_FILL_DELAY = 2.0
+
 class KernelInfo(ssdf.Struct):
     """ KernelInfo
     
@@ -96,6 +113,18 @@ class KernelInfo(ssdf.Struct):
         # - '$PYTHONSTARTUP' uses the code in that file. Broker replaces this.
         self.startupScript = ''
         
+        # When to send the buffered output of the kernel to the shell: 
+        # "maxSize, maxDelay", i.e. when this many characters are buffered
+        # or this many milliseconds after the first text was written.
+        # The output is also send before each prompt. "0, 0" disables
+        # buffering.
+        self.outputFlush = '8192, 30'
+        
+        # Modules to import in advance, comma separated (Linux only). If
+        # given, kernels are forked from a template process that has
+        # imported these modules, so that they start up quickly.
+        self.preloadModules = ''
+        
         
         # Load info from ssdf struct. Make sure they are all strings
         if info:
@@ -120,7 +149,13 @@ class KernelInfo(ssdf.Struct):
         return ssdf.saves(self)
 
 
-def getCommandFromKernelInfo(info, port):
+def getCommandFromKernelInfo(info, port, script='start.py'):
+    """ getCommandFromKernelInfo(info, port, script='start.py')
+    
+    Get the command to run the given script of the kernel. The port
+    (or a string with other arguments) is passed as argument.
+    
+    """
     info = KernelInfo(info)
     
     # Apply default exe
@@ -133,7 +168,7 @@ def getCommandFromKernelInfo(info, port):
         exe = '"{}"'.format(exe)
     
     # Get start script
-    startScript = os.path.join( iep.iepDir, 'iepkernel', 'start.py')
+    startScript = os.path.join( iep.iepDir, 'iepkernel', script)
     startScript = '"{}"'.format(startScript)
     
     # Build command
@@ -183,6 +218,21 @@ def getEnvFromKernelInfo(info):
     return env
 
 
+def getPoolKeyFromKernelInfo(info):
+    """ getPoolKeyFromKernelInfo(info)
+    
+    Get the key by which prestarted kernels are pooled. Kernels with the
+    same executable, Python path and preloaded modules are interchangeable,
+    because the rest of the info is only send to a kernel when it is used.
+    The same key is used for fork servers.
+    
+    """
+    info = KernelInfo(info)
+    modules = [m.strip() for m in info.preloadModules.split(',') if m.strip()]
+    pythonPath = getEnvFromKernelInfo(info)['PYTHONPATH']
+    return info.exe, pythonPath, ','.join(modules)
+
+
 
 class KernelBroker:
     """ KernelBroker(info)
@@ -219,7 +269,9 @@ class KernelBroker:
         self._kernelCon = None
         self._ctrl_broker = None
         
-        # Create yoton-based timer
+        # Create yoton-based timer (to wait for clients to connect, and to
+        # clean up when they are gone). The exit of the kernel process is
+        # detected by a ProcessWatcher.
         self._timer = yoton.Timer(0.2, oneshot=False)
         self._timer.bind(self.mainLoopIter)
         
@@ -247,6 +299,7 @@ class KernelBroker:
         
         # Create control channel so that the IDE can control restarting etc.
         self._ctrl_broker = yoton.SubChannel(ct, 'ctrl-broker')
+        self._ctrl_broker.received.bind(self._onControlMessage)
         
         # Status channel to pass startup parameters to the kernel
         self._stat_startup = yoton.StateChannel(ct, 'stat-startup', yoton.OBJECT)
@@ -276,6 +329,10 @@ class KernelBroker:
         self._kernelCon = None
         self._terminator = None
         self._streamReader = None
+        self._watcher = None
+        
+        # Whether the kernel has been started without sending it the info
+        self._prestarted = False
         
         if destroy==True:
             
@@ -285,9 +342,9 @@ class KernelBroker:
             self._timer = None
             
             # Clean up this kernelbroker instance
-            L = self._manager._kernels
-            while self in L:
-                L.remove(self)
+            for L in [self._manager._kernels, self._manager._pool]:
+                while self in L:
+                    L.remove(self)
             
             # Remove references
             #
@@ -318,22 +375,54 @@ class KernelBroker:
     def startKernel(self):
         """ startKernel()
         
-        Launch the kernel in a subprocess, and connect to it via the
-        context and two Pypes.
+        Launch the kernel (unless it was prestarted), and send it the
+        info, so that it can start up.
         
         """
         
-        # Create channels
-        self._create_channels()
+        # Launch
+        prestarted = self._prestarted
+        if not prestarted:
+            self._launchKernel()
+        self._prestarted = False
         
-        # Create info dict
+        # Create info dict (a prestarted kernel does not count the time
+        # that it waited in the pool as startup time)
         info = {}
         for key in self._info:
             info[key] = self._info[key]
+        info['prestarted'] = prestarted
         
         # Send info stuff so that the kernel has access to the information
         self._stat_startup.send(info)
         
+        # Reset some variables
+        self._pending_restart = None
+    
+    
+    def prestartKernel(self):
+        """ prestartKernel()
+        
+        Launch the kernel without sending it the info. The kernel connects
+        and then waits until startKernel() is called, which is done as
+        soon as a client connects.
+        
+        """
+        self._launchKernel()
+        self._prestarted = True
+    
+    
+    def _launchKernel(self):
+        """ _launchKernel()
+        
+        Launch the kernel in a subprocess, and connect to it via the
+        context and two Pypes.
+        
+        """
+        
+        # Create channels
+        self._create_channels()
+        
         # Get directory to start process in
         cwd = iep.iepDir
         
@@ -346,8 +435,14 @@ class KernelBroker:
         command = getCommandFromKernelInfo(self._info, self._kernelCon.port1)
         env = getEnvFromKernelInfo(self._info)
         
-        # Start process
-        self._process = subprocess.Popen(   command, shell=True, 
+        # Start process, by forking it from a fork server if modules are
+        # to be preloaded (and we can)
+        self._process = None
+        if self._info.preloadModules.strip() and sys.platform.startswith('linux'):
+            forkServer = self._manager.getForkServer(self._info)
+            self._process = forkServer.launch(self._kernelCon.port1)
+        if self._process is None:
+            self._process = subprocess.Popen(   command, shell=True, 
                                             env=env, cwd=cwd,
                                             stdin=subprocess.PIPE,  # Fixes issue 165
                                             stdout=subprocess.PIPE, 
@@ -367,12 +462,13 @@ class KernelBroker:
         self._streamReader = StreamReader(self._process,
                                     self._strm_raw, self._strm_broker)
         
-        # Start streamreader and timer
+        # Create watcher to be notified when the process exits
+        self._watcher = ProcessWatcher(self._process, self._onProcessExited)
+        
+        # Start streamreader, watcher and timer
         self._streamReader.start()
+        self._watcher.start()
         self._timer.start()
-        
-        # Reset some variables
-        self._pending_restart = None
     
     
     def hostConnectionForIDE(self, address='localhost'):
@@ -422,6 +518,35 @@ class KernelBroker:
             self.terminate('because connecton was lost', 'KILL', 0.5)
     
     
+    def _onProcessExited(self, process, returncode):
+        """ _onProcessExited(process, returncode)
+        
+        Called (in the main thread) by the ProcessWatcher when the
+        process has exited.
+        
+        """
+        # Ignore the process of a kernel that was already cleaned up
+        if process is self._process:
+            self._onKernelDied(returncode)
+    
+    
+    def _onControlMessage(self, channel):
+        """ _onControlMessage(channel)
+        
+        Handle the control messages from the IDE.
+        
+        """
+        for msg in channel.recv_all():
+            if msg == 'INT':
+                self._commandInterrupt()
+            elif msg == 'TERM':
+                self._commandTerminate()
+            elif msg.startswith('RESTART'):
+                self._commandRestart(msg)
+            else:
+                pass # Message is not for us
+    
+    
     def _onKernelDied(self, returncode=0):
         """ _onKernelDied()
         
@@ -472,8 +597,8 @@ class KernelBroker:
         """
         
         # The terminatation procedure is started by creating
-        # a KernelTerminator instance. This instance's iteration method
-        # iscalled from _mailLoopIter().
+        # a KernelTerminator instance. This instance schedules its
+        # next actions until the process has exited.
         self._terminator = KernelTerminator(self, reason, action, timeout)
     
     
@@ -491,6 +616,8 @@ class KernelBroker:
         """ mainLoopIter()
         
         Periodically called. Kind of the main loop iteration for this kernel.
+        It starts the kernel when a client connects, and cleans up when
+        there is no process and there are no clients.
         
         """
         
@@ -517,29 +644,12 @@ class KernelBroker:
         
         # If we have a process ...
         if self._process:
-            # Test if process is dead
-            process_returncode = self._process.poll()
-            if process_returncode is not None:
-                self._onKernelDied(process_returncode)
-                return
-            # Are we in the process of terminating?
-            elif self.isTerminating():
-                self._terminator.next()
+            # Prestarted kernel that is now used?
+            if self._prestarted and hasClients:
+                self.startKernel()
         elif self.isTerminating():
             # We cannot have a terminator if we have no process
             self._terminator = None
-        
-        # handle control messages
-        if self._ctrl_broker:
-            for msg in self._ctrl_broker.recv_all():
-                if msg == 'INT':
-                    self._commandInterrupt()
-                elif msg == 'TERM':
-                    self._commandTerminate()
-                elif msg.startswith('RESTART'):
-                    self._commandRestart(msg)
-                else:
-                    pass # Message is not for us
     
     
     def _commandInterrupt(self):
@@ -595,10 +705,12 @@ class KernelBroker:
 class KernelTerminator:
     """ KernelTerminator(broker, reason='user terminated', action='TERM', timeout=0.0)
     
-    Simple class to help terminating the kernel. It has a next() method 
-    that should be periodically called. It keeps track whether the timeout
-    has passed and will undertake increaslingly ruder actions to terminate
-    the kernel.
+    Simple class to help terminating the kernel. It undertakes 
+    increaslingly ruder actions to terminate the kernel, scheduling each 
+    action for when the timeout of the previous one has passed. This 
+    stops when the broker no longer has this terminator (e.g. because the
+    kernel died). If the terminator is not set at the broker, call next()
+    to take the action when its time has come.
     
     """
     def __init__(self, broker, reason='by user', action='TERM', timeout=0.0):
@@ -618,14 +730,29 @@ class KernelTerminator:
         self._timeout = time.time() + timeout
         if not timeout:
             self.next() 
+        elif action != 'NOTHING':
+            yoton.call_later(self._onTimeout, timeout, self._timeout)
+    
     
+    def _onTimeout(self, t):
+        # Take the scheduled action, if it is still current
+        if self._broker._terminator is self and self._timeout == t:
+            self.next(True)
     
-    def next(self):
+    
+    def timeLeft(self):
+        """ timeLeft()
+        Get the time (in seconds) until the next action.
+        """
+        return max(0.0, self._timeout - time.time())
+    
+    
+    def next(self, force=False):
         
         # Get action
         action = self._next_action
         
-        if time.time() < self._timeout:
+        if time.time() < self._timeout and not force:
             # Time did not pass yet
             pass
         
@@ -686,6 +813,11 @@ class StreamReader(threading.Thread):
     This needs to be done in a separate thread because reading from
     a PYPE blocks.
     
+    The output is read in chunks of whatever is available (rather than
+    per line), and the output that becomes available within a short 
+    time is sent in a single message, so that bursts of output can 
+    be handled.
+    
     """
     def __init__(self, process, strm_raw, strm_broker):
         threading.Thread.__init__(self)
@@ -695,27 +827,249 @@ class StreamReader(threading.Thread):
         self._strm_broker = strm_broker
         self.deamon = True
         self._exit = False
+        
+        # Decode incrementally, since a chunk can end halfway a character
+        self._decoder = codecs.getincrementaldecoder('utf-8')('ignore')
+        
+        # Select does not work for pipes on Windows
+        self._useSelect = not sys.platform.startswith('win')
     
     def stop(self, timeout=1.0):
         self._exit = True
         self.join(timeout)
     
     def run(self):
+        fd = self._process.stdout.fileno()
         while not self._exit:
-            time.sleep(0.1)
             # Read any stdout/stderr messages and route them via yoton.
-            msg = self._process.stdout.readline() # <-- Blocks here
-            if not isinstance(msg, str):
-                msg = msg.decode('utf-8', 'ignore')
+            data = self._read(fd) # <-- Blocks here
+            if data is None:
+                break # Stopped
+            msg = self._decoder.decode(data, not data)
             try:
                 self._strm_raw.send(msg)
             except IOError:
                 pass # Channel is closed
             # Process dead?
-            if not msg:# or self._process.poll() is not None:
+            if not data:
                 break            
         #self._strm_broker.send('streamreader exit\n')
     
+    def _read(self, fd):
+        """ _read(fd)
+        Wait for data to become available, and read all data that becomes
+        available within STREAM_MAX_DELAY seconds (up to STREAM_MAX_CHUNK
+        bytes). Returns b'' at the end of the stream, and None if the 
+        reader was stopped.
+        """
+        
+        # Wait for data, checking regularly whether we should stop
+        if self._useSelect:
+            while not select.select([fd], [], [], 0.5)[0]:
+                if self._exit:
+                    return None
+        try:
+            data = os.read(fd, STREAM_READ_SIZE)
+        except OSError:
+            return b'' # Pipe is closed
+        
+        # Read more for as long as data becomes available soon
+        if self._useSelect and data:
+            chunks, n = [data], len(data)
+            deadline = time.time() + STREAM_MAX_DELAY
+            try:
+                while n < STREAM_MAX_CHUNK:
+                    timeout = max(0, deadline - time.time())
+                    if not select.select([fd], [], [], timeout)[0]:
+                        break
+                    data = os.read(fd, STREAM_READ_SIZE)
+                    if not data:
+                        break # End of stream, reported on the next call
+                    chunks.append(data)
+                    n += len(data)
+            except OSError:
+                pass
+            data = b''.join(chunks)
+        return data
+    
+
+class ProcessWatcher(threading.Thread):
+    """ ProcessWatcher(process, callback)
+    
+    Waits for the process to exit, and then calls the callback with the
+    process and its returncode, via the yoton event loop (i.e. in the
+    main thread). Use wait() to wait for the exit in the current thread.
+    
+    """
+    def __init__(self, process, callback):
+        threading.Thread.__init__(self)
+        
+        self._process = process
+        self._callback = callback
+        self._exited = threading.Event()
+        self.daemon = True
+    
+    def wait(self, timeout=None):
+        """ wait(timeout=None)
+        Wait until the process has exited, or the timeout has passed.
+        Returns whether the process has exited.
+        """
+        self._exited.wait(timeout)
+        return self._exited.is_set()
+    
+    def run(self):
+        try:
+            returncode = self._process.wait()
+        except Exception:
+            returncode = -1 # Should not happen
+        self._exited.set()
+        yoton.call_later(self._callback, 0, self._process, returncode)
+
+
+
+class ForkServer:
+    """ ForkServer(info, modules)
+    
+    Runs iepkernel/forkserver.py, a process that imports the given modules
+    (comma separated) and then forks a kernel for each launch. These
+    kernels thus start up quickly. Linux only.
+    
+    """
+    def __init__(self, info, modules):
+        self._dir = tempfile.mkdtemp(prefix='iep_forkserver_')
+        self._count = 0
+        
+        # Create the socket to send requests to. It is created here, so
+        # that requests can be made while the server is starting up.
+        self._address = os.path.join(self._dir, 'socket')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self._address)
+        listener.listen(16)
+        
+        # Start process. It stops when its stdin is closed. The modules
+        # are quoted, since the command is run by the shell.
+        args = '%i %s' % (listener.fileno(), shlex.quote(modules))
+        command = getCommandFromKernelInfo(info, args, 'forkserver.py')
+        env = getEnvFromKernelInfo(info)
+        self._process = subprocess.Popen(   command, shell=True,
+                                            env=env, cwd=iep.iepDir,
+                                            stdin=subprocess.PIPE,
+                                            pass_fds=[listener.fileno()]
+                                        )
+        listener.close()
+    
+    def isAlive(self):
+        return self._process.poll() is None
+    
+    def launch(self, port):
+        """ launch(port)
+        Fork a kernel that connects to the given port. Returns a 
+        ForkedProcess, or None if that failed.
+        """
+        if not self.isAlive():
+            return None
+        self._count += 1
+        fifo = os.path.join(self._dir, 'kernel%i' % self._count)
+        try:
+            os.mkfifo(fifo)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self._address)
+            sock.sendall(('%i %s\n' % (port, fifo)).encode('utf-8'))
+            sock.setblocking(False)
+        except (OSError, socket.error):
+            return None
+        return ForkedProcess(sock, fifo)
+    
+    def close(self):
+        try:
+            self._process.stdin.close()
+        except Exception:
+            pass
+        shutil.rmtree(self._dir, True)
+
+
+
+class ForkedProcess:
+    """ ForkedProcess(sock, fifo)
+    
+    A kernel process that was forked by a fork server. Implements the
+    part of the subprocess.Popen interface that the broker uses. The
+    server sends the pid and the returncode over the given socket. The
+    output of the kernel is read from the fifo.
+    
+    """
+    def __init__(self, sock, fifo):
+        self._sock = sock
+        self._fifo = fifo
+        self._file = None
+        self._data = ''
+        self._serverGone = False
+        self.pid = None
+        self.returncode = None
+        self.stdout = self # For the stream reader
+    
+    def fileno(self):
+        # Open the fifo; blocks until the kernel has opened it. If the
+        # fifo is already removed (the fork failed), read nothing.
+        if self._file is None:
+            try:
+                self._file = open(self._fifo, 'rb', 0)
+            except (IOError, OSError):
+                self._file = open(os.devnull, 'rb', 0)
+        return self._file.fileno()
+    
+    def poll(self):
+        if self.returncode is not None:
+            return self.returncode
+        # Receive from the server
+        try:
+            data = self._sock.recv(1024)
+        except socket.error:
+            return None # Nothing received
+        if data:
+            self._data += data.decode('utf-8')
+        elif self.pid is None:
+            self.returncode = -1 # Server died before forking
+        else:
+            # Server died, check whether the kernel is still alive
+            self._serverGone = True
+            try:
+                os.kill(self.pid, 0)
+            except OSError:
+                self.returncode = -1
+            return self.returncode
+        # Process messages
+        while '\n' in self._data:
+            line, self._data = self._data.split('\n', 1)
+            key, value = line.split(' ', 1)
+            if key == 'pid':
+                self.pid = int(value)
+            elif key == 'exit':
+                self.returncode = int(value)
+        # Clean up when the kernel has exited
+        if self.returncode is not None:
+            self._sock.close()
+            try:
+                # Make sure that the stream reader does not wait forever
+                fd = os.open(self._fifo, os.O_WRONLY | os.O_NONBLOCK)
+                os.close(fd)
+            except OSError:
+                pass
+            try:
+                os.remove(self._fifo)
+            except OSError:
+                pass
+        return self.returncode
+    
+    def wait(self):
+        while self.poll() is None:
+            if self._serverGone:
+                time.sleep(0.5) # The exit will not be reported anymore
+            else:
+                select.select([self._sock], [], [])
+        return self.returncode
+
+
 
 class Kernelmanager:
     """ Kernelmanager
@@ -737,6 +1091,16 @@ class Kernelmanager:
         
         # Init list of kernels
         self._kernels = []
+        
+        # Init list of prestarted kernels that are not used yet (each 
+        # has a _poolKey attribute), and the timer to fill it
+        self._pool = []
+        self._poolInfo = None
+        
+        # Init dict of fork servers (by pool key)
+        self._forkServers = {}
+        self._poolTimer = yoton.Timer(POOL_FILL_DELAY, oneshot=True)
+        self._poolTimer.bind(self._fillPool)
     
     
     def createKernel(self, info, name=None):
@@ -752,20 +1116,92 @@ class Kernelmanager:
             i = len(self._kernels) + 1
             name = 'kernel %i' % i
         
-        # Create kernel
-        kernel = KernelBroker(self, info, name)
+        # Use a prestarted kernel, or create one
+        kernel = self._takeFromPool(info)
+        if kernel is not None:
+            kernel._originalInfo = KernelInfo(info)
+            kernel._info = ssdf.copy(kernel._originalInfo)
+            kernel._name = name
+        else:
+            kernel = KernelBroker(self, info, name)
         self._kernels.append(kernel)
         
         # Host a connection for the ide
         port = kernel.hostConnectionForIDE()
         
         # Tell broker to start as soon as the IDE connects with the broker
-        kernel.startKernelIfConnected()
+        # (a prestarted kernel does that by itself)
+        if not kernel._prestarted:
+            kernel.startKernelIfConnected()
+        
+        # Prestart kernels for the next shell or restart, in a while
+        if iep.config.advanced.kernelPoolSize > 0:
+            self._poolInfo = info
+            self._poolTimer.start()
         
         # Done
         return port
     
     
+    def hasIdleKernel(self, info):
+        """ hasIdleKernel(info)
+        
+        Get whether there is a prestarted kernel that can be used for a
+        kernel with the given info.
+        
+        """
+        key = getPoolKeyFromKernelInfo(info)
+        for kernel in self._pool:
+            if kernel._poolKey == key and kernel._process is not None:
+                return True
+        return False
+    
+    
+    def _takeFromPool(self, info):
+        """ _takeFromPool(info)
+        
+        Get a prestarted kernel for the given info and remove it from 
+        the pool. Returns None if there is none.
+        
+        """
+        key = getPoolKeyFromKernelInfo(info)
+        for kernel in self._pool:
+            if kernel._poolKey == key and kernel._process is not None:
+                self._pool.remove(kernel)
+                return kernel
+        return None
+    
+    
+    def getForkServer(self, info):
+        """ getForkServer(info)
+        
+        Get the fork server for the given info, starting it if necessary.
+        
+        """
+        key = getPoolKeyFromKernelInfo(info)
+        forkServer = self._forkServers.get(key, None)
+        if forkServer is None or not forkServer.isAlive():
+            forkServer = self._forkServers[key] = ForkServer(info, key[2])
+        return forkServer
+    
+    
+    def _fillPool(self):
+        """ _fillPool()
+        
+        Prestart kernels for the info of the last created kernel, until
+        the pool has as many as set in the config (advanced.kernelPoolSize).
+        
+        """
+        info = self._poolInfo
+        key = getPoolKeyFromKernelInfo(info)
+        count = len([kernel for kernel in self._pool if kernel._poolKey == key])
+        for i in range(iep.config.advanced.kernelPoolSize - count):
+            kernel = KernelBroker(self, info, 'prestarted kernel')
+            kernel._poolKey = key
+            kernel.prestartKernel()
+            self._pool.append(kernel)
+    
+    
     def getKernelList(self):
         
         # Get info of each kernel as an ssdf struct
@@ -787,16 +1223,22 @@ class Kernelmanager:
         When this function returns, all kernels will be terminated.
         
         """
-        for kernel in [kernel for kernel in self._kernels]:
+        for kernel in self._kernels + self._pool:
             
             # Try closing the process gently: by closing stdin
             terminator = KernelTerminator(kernel, 'for closing down')
             
-            # Terminate
+            # Terminate, waiting for the process to exit until it is time
+            # for the next action
             while (kernel._kernelCon and kernel._kernelCon.is_connected and 
-                    kernel._process and (kernel._process.poll() is None) ):
-                time.sleep(0.02)
+                    kernel._watcher and not kernel._watcher.wait(
+                                        min(1.0, terminator.timeLeft())) ):
                 terminator.next()
             
             # Clean up
             kernel._reset(True)
+        
+        # Stop fork servers
+        for forkServer in self._forkServers.values():
+            forkServer.close()
+        self._forkServers = {}
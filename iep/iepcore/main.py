@@ -135,7 +135,7 @@ class MainWindow(QtGui.QMainWindow):
         # Delayed imports
         from iep.iepcore.editorTabs import EditorTabs
         from iep.iepcore.shellStack import ShellStackWidget
-        from iep.iepcore import codeparser
+        from iep.iepcore import codeparser, symbolindex
         from iep.tools import ToolManager
         
         # Instantiate tool manager
@@ -146,6 +146,12 @@ class MainWindow(QtGui.QMainWindow):
             iep.parser = codeparser.Parser()
             iep.parser.start()
         
+        # Instantiate and start the indexer of the user's projects
+        if iep.symbolIndex is None:
+            iep.symbolIndex = symbolindex.SymbolIndex()
+            iep.symbolIndex.start()
+            iep.symbolIndex.update()
+        
         # Create editor stack and make the central widget
         iep.editors = EditorTabs(self)
         self.setCentralWidget(iep.editors)
@@ -333,6 +339,11 @@ class MainWindow(QtGui.QMainWindow):
             tool = iep.toolManager.getTool(toolname) 
             tool.close()
         
+        # Stop indexing, and close the index (after the current file)
+        if iep.symbolIndex is not None:
+            symbolIndex, iep.symbolIndex = iep.symbolIndex, None
+            symbolIndex.stop()
+        
         # Stop all threads (this should really only be daemon threads)
         import threading
         for thread in threading.enumerate():
@@ -606,6 +606,8 @@ class EditMenu(Menu):
             icons.text_align_justify, self._editItemCallback, "justifyText")
         self.addItem(translate("menu", "Go to line ::: Go to a specific line number."), 
             None, self._editItemCallback, "gotoLinePopup")
+        self.addItem(translate("menu", "Go to definition ::: Go to the definition of the name under the cursor."), 
+            None, self._editItemCallback, "gotoDefinition")
         self.addItem(translate("menu", "Delete line ::: Delete the selected line."), 
             None, self._editItemCallback, "deleteLines")
         self.addSeparator()
@@ -901,6 +903,8 @@ class ShellContextMenu(ShellMenu):
             icons.paste_plain, self._editItemCallback, "paste")
         self.addItem(translate("menu", "Select all ::: Select all text."), 
             icons.sum, self._editItemCallback, "selectAll")
+        self.addItem(translate("menu", "Find in output ::: Find text in the output, including older output that is no longer shown."), 
+            icons.find, self._editItemCallback, "findTextPopup")
     
     def getShell(self):
         """ Shell actions of this menu operate on the shell specified in the constructor """
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012, the IEP development team
+#
+# IEP is distributed under the terms of the (new) BSD License.
+# The full license can be found in 'license.txt'.
+
+
+""" Module scrollback
+
+Implements a compact store for the lines of output that no longer fit
+in the document of a shell. The lines are stored in chunks, which are
+compressed once they are full. Appending lines thus has a constant cost
+per line, and millions of lines take little memory.
+
+"""
+
+import zlib
+
+
+# Number of lines per chunk
+CHUNK_SIZE = 1024
+
+
+class ScrollbackStore:
+    """ ScrollbackStore(maxLines=0)
+    
+    Stores lines of text. Lines are appended at the end, and can be
+    obtained by their index. If maxLines is given, the oldest chunks
+    are discarded when the store has more lines. The indices of the
+    lines do not change when this happens; firstIndex is the index of
+    the first line that is still available.
+    
+    """
+    
+    def __init__(self, maxLines=0):
+        self._maxLines = maxLines
+        self.clear()
+    
+    
+    def clear(self):
+        """ clear()
+        Remove all lines.
+        """
+        self._chunks = [] # Compressed chunks
+        self._current = [] # Lines of the chunk that is being filled
+        self._firstChunk = 0 # Number of discarded chunks
+        self._cache = -1, None # Last uncompressed chunk
+    
+    
+    def __len__(self):
+        n = self._firstChunk + len(self._chunks)
+        return n * CHUNK_SIZE + len(self._current)
+    
+    
+    @property
+    def firstIndex(self):
+        """ The index of the first available line.
+        """
+        return self._firstChunk * CHUNK_SIZE
+    
+    
+    def append(self, lines):
+        """ append(lines)
+        Append a list of lines (strings without newlines).
+        """
+        current = self._current
+        current.extend(lines)
+        # Compress full chunks
+        i = 0
+        while len(current) - i >= CHUNK_SIZE:
+            text = '\n'.join(current[i:i+CHUNK_SIZE])
+            self._chunks.append(zlib.compress(text.encode('utf-8')))
+            i += CHUNK_SIZE
+        del current[:i]
+        # Discard oldest chunks
+        if self._maxLines:
+            while len(self) - self.firstIndex > self._maxLines + CHUNK_SIZE:
+                self._chunks.pop(0)
+                self._firstChunk += 1
+    
+    
+    def _getChunk(self, i):
+        """ _getChunk(i)
+        Get the lines of the chunk with the given index.
+        """
+        if i == self._firstChunk + len(self._chunks):
+            return self._current
+        elif self._cache[0] == i:
+            return self._cache[1]
+        else:
+            text = zlib.decompress(self._chunks[i - self._firstChunk])
+            lines = text.decode('utf-8').split('\n')
+            self._cache = i, lines
+            return lines
+    
+    
+    def getLines(self, i1, i2):
+        """ getLines(i1, i2)
+        Get the lines from index i1 up to (not including) i2. Lines that
+        are not available are omitted.
+        """
+        i1, i2 = max(i1, self.firstIndex), min(i2, len(self))
+        lines = []
+        while i1 < i2:
+            chunk = self._getChunk(i1 // CHUNK_SIZE)
+            j1 = i1 % CHUNK_SIZE
+            j2 = min(CHUNK_SIZE, j1 + i2 - i1)
+            lines.extend(chunk[j1:j2])
+            i1 += j2 - j1
+        return lines
+    
+    
+    def find(self, needle, i2):
+        """ find(needle, i2)
+        Find the last line before index i2 that contains the given text
+        (case insensitive). Returns the index of the line, or -1.
+        """
+        needle = needle.lower()
+        i2 = min(i2, len(self))
+        while i2 > self.firstIndex:
+            i = (i2 - 1) // CHUNK_SIZE
+            lines = self._getChunk(i)[:i2 - i * CHUNK_SIZE]
+            text = '\n'.join(lines).lower()
+            pos = text.rfind(needle)
+            if pos >= 0:
+                return i * CHUNK_SIZE + text.count('\n', 0, pos)
+            i2 = i * CHUNK_SIZE
+        return -1
@@ -19,27 +19,56 @@ code in it.
 from iep.codeeditor.qt import QtCore, QtGui
 Qt = QtCore.Qt
 
-import os, sys, time, subprocess
+import os, sys, time, subprocess, tempfile, hashlib
+from collections import deque, OrderedDict
 import yoton
 import iep
+from iep import translate
 from pyzolib import ssdf
 
 from iep.codeeditor.highlighter import Highlighter
 from iep.codeeditor import parsers
 
 from iep.iepcore.baseTextCtrl import BaseTextCtrl
+from iep.iepcore.scrollback import ScrollbackStore
 from iep.iepcore.iepLogging import print
 from iep.iepcore.kernelbroker import KernelInfo, Kernelmanager
 from iep.iepcore.menu import ShellContextMenu
 
 
 
-# Interval for polling messages. Timer for each kernel. I found
-# that this one does not affect performance much
-POLL_TIMER_INTERVAL = 30 # 30 ms 33Hz
+# Time to wait after a message arrives before processing the messages,
+# so that bursts of output are processed in one go. Also the interval
+# at which messages are processed while more messages are pending.
+POLL_COALESCE_INTERVAL = 10 # 10 ms
 
-# Maximum number of lines in the shell
+# Output flood protection. Output is written for at most FLOOD_WRITE_TIME
+# seconds per poll. If more stdout/stderr output is pending than can be 
+# written in FLOOD_DELAY seconds, it is suppressed: only the last lines 
+# are shown, below a marker that links to a file with the suppressed 
+# output. The flood ends when no output arrives for FLOOD_END_DELAY seconds.
+# No more messages are received while FLOOD_MAX_PENDING characters are
+# pending, which blocks the kernel (stdout and stderr are in sync mode).
+FLOOD_WRITE_TIME = 0.02
+FLOOD_DELAY = 1.0
+FLOOD_END_DELAY = 0.5
+FLOOD_UPDATE_INTERVAL = 0.2
+FLOOD_TAIL_LINES = 20
+FLOOD_MAX_PENDING = 2**22 # 4M characters
+FLOOD_MAX_FILESIZE = 2**26 # 64 MB
+
+# Maximum number of lines in the shell. Older lines are moved to a
+# scrollback store (in batches of 10%), from which they are paged in 
+# (per PAGE_LINES) when the user scrolls to the top.
 MAXBLOCKCOUNT = iep.config.advanced.shellMaxLines
+MAXSTOREDLINES = iep.config.advanced.shellMaxStoredLines
+PAGE_LINES = 1000
+
+# The number of sources (of code that was run) that the kernel keeps, by
+# their hash. The same as in the kernel, so that sources that the kernel
+# has need not be send again. If the kernel lacks a source after all, it
+# asks for it, and waits with running code until it has it.
+CODE_CACHE_SIZE = 32
 
 
 # todo: we could make command shells to, with autocompletion and coloring...
@@ -227,6 +256,9 @@ class BaseShell(BaseTextCtrl):
         # variables we need
         self._more = False
         
+        # Whether the last output ended with a carriage return
+        self._pendingCR = False
+        
         # We use two cursors to keep track of where the prompt is
         # cursor1 is in front, and cursor2 is at the end of the prompt.
         # They can be in the same position.
@@ -260,8 +292,12 @@ class BaseShell(BaseTextCtrl):
         # Unfortunately, QPlainTextEdit does not.
         self.setWordWrapMode(QtGui.QTextOption.WrapAnywhere)
         
-        # Limit number of lines
-        self.setMaximumBlockCount(MAXBLOCKCOUNT)
+        # Limit number of lines. Lines that are removed from the document
+        # are stored in the scrollback store. The first _pagedIn lines
+        # of the document are copies of the last lines in the store.
+        self._scrollback = ScrollbackStore(MAXSTOREDLINES)
+        self._pagedIn = 0
+        self.verticalScrollBar().valueChanged.connect(self._onScroll)
         
         # Keep track of position, so we can disable editing if the cursor
         # is before the prompt
@@ -451,6 +487,9 @@ class BaseShell(BaseTextCtrl):
     
     def clearScreen(self):
         """ Clear all the previous output from the screen. """
+        # Also clear the older output
+        self._scrollback.clear()
+        self._pagedIn = 0
         # Select from beginning of prompt to start of document
         self._cursor1.clearSelection()
         self._cursor1.movePosition(self._cursor1.Start, A_KEEP) # Keep anchor
@@ -478,76 +517,125 @@ class BaseShell(BaseTextCtrl):
     
     
     def _handleBackspaces_split(self, text):
+        """ _handleBackspaces_split(text)
         
-        # while NOT a backspace at first position, or none found
-        i = 9999999999999
-        while i>0:
-            i = text.rfind('\b',0,i)
-            if i>0 and text[i-1]!='\b':
-                text = text[0:i-1] + text[i+1:]
+        Apply the backspaces in the given text (in linear time). Returns
+        the number of backspaces that are left at the start, and the 
+        resulting text.
+        
+        """
+        pieces = text.split('\b')
+        chars = list(pieces[0])
+        n = 0
+        for piece in pieces[1:]:
+            if chars:
+                chars.pop()
+            else:
+                n += 1
+            chars.extend(piece)
+        return n, ''.join(chars)
+    
+    
+    def _handleControlChars(self, text):
+        """ _handleControlChars(text)
+        
+        Apply the carriage returns and backspaces in the given text (in 
+        linear time). Text that follows a carriage return replaces the 
+        current line, as is done for progress bars. Backspaces do not 
+        remove newlines. In the result, a leading '\r' means that the 
+        current line in the shell must be cleared, leading backspaces 
+        remove characters from the current line in the shell (but not
+        the newline before it), and a trailing '\r' means that the next 
+        text replaces the last line. If the text starts with a newline or
+        carriage return, applying this function to a text followed by 
+        the result gives the same as applying it to the text followed by
+        the original text.
         
-        # Strip the backspaces at the start
-        text2 = text.lstrip('\b')
-        n = len(text) - len(text2)
+        """
         
-        # Done
-        return n, text2
+        # Quick exit
+        if '\r' not in text and '\b' not in text:
+            return text
+        
+        lines = text.replace('\r\n', '\n').split('\n')
+        for i in range(len(lines)):
+            line = lines[i]
+            clear = pending = False
+            # Keep only the last part that is not empty
+            if '\r' in line:
+                parts = line.split('\r')
+                j = len(parts) - 1
+                while j > 0 and not parts[j]:
+                    j -= 1
+                clear = j > 0
+                pending = j < len(parts) - 1
+                line = parts[j]
+            # Apply backspaces
+            if '\b' in line:
+                n, line = self._handleBackspaces_split(line)
+                if i == 0 and not clear:
+                    line = '\b' * n + line
+            # Mark the start of the first line, and the end of the last.
+            # A cleared line that is empty gets a backspace, so that its
+            # mark is not mistaken for a trailing '\r'.
+            if i == 0 and clear:
+                line = '\r' + (line or '\b')
+            if i == len(lines) - 1 and pending:
+                line = line + '\r'
+            lines[i] = line
+        
+        return '\n'.join(lines)
     
     
     def _handleBackspacesOnList(self, texts):
         """ _handleBackspacesOnList(texts)
         
-        Handle backspaces on a list of messages. When printing
-        progress, many messages will simply replace each-other, which
-        means we can process them much more effectively than when they're
-        combined in a list.
+        Handle backspaces and carriage returns on a list of messages. When
+        printing progress, many messages will simply replace each-other, 
+        which means we can process them much more effectively than when 
+        they're combined in a list.
         
         """
-        # Init number of backspaces at the start
-        N = 0
-        
-        for i in range(len(texts)):
-            
-            # Remove backspaces in text and how many are left
-            n, text = self._handleBackspaces_split(texts[i])
-            texts[i] = text
-            
-            # Use remaining backspaces to remove backspaces in earlier texts
-            while n and i > 0:
-                i -= 1
-                text = texts[i]
-                if len(text) > n:
-                    texts[i] = text[:-n]
-                    n = 0
-                else:
-                    texts[i] = ''
-                    n -= len(text)
-            N += n
-        
-        # Insert tabs for start
-        if N:
-            texts[0] = '\b'*N + texts[0]
-        
-        # Return with empy elements popped
-        return [t for t in texts if t]
+        # The text before the first newline or carriage return is kept as
+        # is: if its own backspaces erase it, it must still replace the
+        # last line when that ended with a carriage return.
+        text = ''.join(texts)
+        i = min([i for i in (text.find('\r'), text.find('\n')) if i >= 0] 
+                or [len(text)])
+        text = text[:i] + self._handleControlChars(text[i:])
+        if text:
+            return [text]
+        else:
+            return []
     
     
     def _handleBackspaces(self, text):
-        """ Apply backspaces in the string itself and if there are
-        backspaces left at the start of the text, remove the appropriate
-        amount of characters from the text.
-        
-        Returns the new text.
+        """ Apply carriage returns and backspaces in the text itself, and
+        to the last line of the shell. Returns the text to insert.
         """
-        # take care of backspaces
-        if '\b' in text:
-            # Remove backspaces and get how many were at the beginning
-            nb, text = self._handleBackspaces_split(text)
-            if nb:
-                # Select what we remove and delete that
-                self._cursor1.clearSelection()
-                self._cursor1.movePosition(self._cursor1.Left, A_KEEP, nb)
-                self._cursor1.removeSelectedText()
+        
+        # Take care of a carriage return at the end of the previous text
+        if self._pendingCR:
+            text = '\r' + text
+        text = self._handleControlChars(text)
+        self._pendingCR = text.endswith('\r')
+        if self._pendingCR:
+            text = text[:-1]
+        
+        self._cursor1.clearSelection()
+        if text.startswith('\r'):
+            # Clear the last line, so the new text replaces it
+            text = text[1:]
+            self._cursor1.movePosition(self._cursor1.StartOfBlock, A_KEEP)
+            self._cursor1.removeSelectedText()
+        if text.startswith('\b'):
+            # Select what we remove and delete that (backspaces do not
+            # remove the newline before the current line)
+            nb = len(text) - len(text.lstrip('\b'))
+            text = text[nb:]
+            nb = min(nb, self._cursor1.positionInBlock())
+            self._cursor1.movePosition(self._cursor1.Left, A_KEEP, nb)
+            self._cursor1.removeSelectedText()
         
         # Return result
         return text
@@ -637,17 +725,139 @@ class BaseShell(BaseTextCtrl):
         self._cursor1.setKeepPositionOnInsert(True)
         self._cursor2.setKeepPositionOnInsert(True)
         
+        # Move old lines out of the document
+        n = self._trimDocument()
+        
         # Make sure that cursor is visible (only when cursor is at edit line)
         if not self.isReadOnly():
             self.ensureCursorVisible()
         
         # Scroll along with the text if lines are popped from the top
-        elif self.blockCount() == MAXBLOCKCOUNT:
-            n = text.count('\n')
+        elif n:
             sb = self.verticalScrollBar()
             sb.setValue(sb.value()-n) 
     
     
+    ## Scrollback
+    
+    def _trimDocument(self):
+        """ _trimDocument()
+        
+        If the document has too many lines, move the oldest lines to the
+        scrollback store. Lines that were paged in are kept while the user
+        is not looking at the end. Returns the number of removed lines.
+        
+        """
+        
+        # Get how many lines to remove. Do this in batches, because 
+        # removing a few lines at a time is relatively expensive.
+        sb = self.verticalScrollBar()
+        maxCount = MAXBLOCKCOUNT
+        if sb.value() < sb.maximum():
+            maxCount += self._pagedIn
+        n = self.blockCount() - maxCount
+        if n <= MAXBLOCKCOUNT // 10:
+            return 0
+        n += MAXBLOCKCOUNT // 10
+        
+        # Collect the text of these lines
+        lines = []
+        block = self.document().begin()
+        for i in range(n):
+            lines.append(block.text())
+            block = block.next()
+        
+        # Store the lines that are not in the store yet
+        nPaged = min(n, self._pagedIn)
+        self._pagedIn -= nPaged
+        self._scrollback.append(lines[nPaged:])
+        
+        # Remove the lines
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.setPosition(block.position(), A_KEEP)
+        cursor.removeSelectedText()
+        return n
+    
+    
+    def _pageIn(self, n):
+        """ _pageIn(n)
+        
+        Insert (at most) n older lines from the scrollback store at the
+        top of the document. Returns the number of inserted lines.
+        
+        """
+        
+        # Get lines
+        store = self._scrollback
+        i2 = len(store) - self._pagedIn
+        lines = store.getLines(i2 - n, i2)
+        if not lines:
+            return 0
+        
+        # Insert them at the start, keeping the view where it is
+        sb = self.verticalScrollBar()
+        value = sb.value()
+        cursor = QtGui.QTextCursor(self.document())
+        cursor.insertText('\n'.join(lines) + '\n', QtGui.QTextCharFormat())
+        self._pagedIn += len(lines)
+        sb.setValue(value + len(lines))
+        return len(lines)
+    
+    
+    def _onScroll(self, value):
+        """ Page in older lines when the user scrolls to the top. 
+        """
+        if value == 0 and self.verticalScrollBar().maximum() > 0:
+            self._pageIn(PAGE_LINES)
+    
+    
+    def findText(self, needle):
+        """ findText(needle)
+        
+        Find the given text in the output, searching backward from the 
+        text cursor (case insensitive). The older lines in the scrollback
+        store are searched too, and paged in if necessary. Returns whether
+        the text was found.
+        
+        """
+        
+        # Search the document
+        if self.find(needle, QtGui.QTextDocument.FindBackward):
+            return True
+        
+        # Search the store
+        store = self._scrollback
+        i = store.find(needle, len(store) - self._pagedIn)
+        if i < 0:
+            return False
+        
+        # Page in up to the line that was found, it is then the first line
+        self._pageIn(len(store) - self._pagedIn - i)
+        block = self.document().begin()
+        col = block.text().lower().rfind(needle.lower())
+        cursor = QtGui.QTextCursor(block)
+        cursor.setPosition(block.position() + col, A_MOVE)
+        cursor.setPosition(block.position() + col + len(needle), A_KEEP)
+        self.setTextCursor(cursor)
+        return True
+    
+    
+    def findTextPopup(self):
+        """ findTextPopup()
+        Ask the user for a text to find in the output of the shell.
+        """
+        needle = QtGui.QInputDialog.getText(self, 
+                            translate('shell', 'Find'),
+                            translate('shell', 'Find text in the output:'),
+                            text=self.textCursor().selectedText(),
+                        )
+        if isinstance(needle, tuple):
+            needle = needle[0] if needle[1] else ''
+        if needle and not self.findText(needle):
+            QtGui.QMessageBox.information(self, translate('shell', 'Find'),
+                            translate('shell', 'Text not found.'))
+    
+    
     ## Executing stuff
     
     def processLine(self, line=None, execute=True):
@@ -699,6 +909,219 @@ class BaseShell(BaseTextCtrl):
 
 
 
+class OutputFlood:
+    """ OutputFlood(sub, cursor)
+    
+    Keeps track of the output of a stream that is suppressed because the 
+    kernel produces it faster than the shell can display it. The 
+    suppressed text is stored in a temporary file (up to a maximum size), 
+    and the last lines are kept, to be shown below a marker. The given 
+    cursor marks the start of the marker in the shell.
+    
+    """
+    
+    def __init__(self, sub, cursor):
+        self.sub = sub
+        self.cursor = cursor
+        self.lineCount = 0
+        self.tail = ''
+        self.lastUpdate = 0
+        # Create file to store the output in
+        fd, self.filename = tempfile.mkstemp(prefix='iep_output_', 
+                                                            suffix='.txt')
+        self._file = os.fdopen(fd, 'w', encoding='utf-8', errors='replace')
+        self._fileSize = 0
+    
+    def add(self, text):
+        """ Add output to the flood. 
+        """
+        self.lineCount += text.count('\n')
+        # Store in file
+        if self._file is not None:
+            if self._fileSize + len(text) < FLOOD_MAX_FILESIZE:
+                self._file.write(text)
+                self._fileSize += len(text)
+            else:
+                self._file.write('\n\n[Output truncated]\n')
+                self.close()
+        # Keep the last lines
+        tail = self.tail + text
+        i = len(tail)
+        for iter in range(FLOOD_TAIL_LINES+1):
+            i = tail.rfind('\n', 0, i)
+            if i < 0:
+                break
+        self.tail = tail[i+1:]
+    
+    def getMarker(self):
+        """ Get the text of the marker. 
+        """
+        n = self.lineCount - self.tail.count('\n')
+        return '[%i lines suppressed, click to view]\n' % n
+    
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+    
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+
+class IntrospectionFuture:
+    """ IntrospectionFuture(kind, name)
+    
+    The future for an introspection request that is returned by the
+    IntrospectionScheduler. It has the same interface as the yoton 
+    futures, so it can be used in the same way.
+    
+    """
+    
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+        self._source = None # The yoton future
+        self._callbacks = []
+        self._done = False
+        self._cancelled = False
+        self._result = None
+        self._exception = None
+    
+    def done(self):
+        return self._done
+    
+    def cancelled(self):
+        return self._cancelled
+    
+    def result(self):
+        return self._result
+    
+    def exception(self):
+        return self._exception
+    
+    def add_done_callback(self, fn):
+        if self._done:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+    
+    def cancel(self):
+        if self._done:
+            return False
+        self._cancelled = True
+        self._setDone()
+        return True
+    
+    def _setDone(self, result=None, exception=None):
+        self._done = True
+        self._result, self._exception = result, exception
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+
+class IntrospectionScheduler:
+    """ IntrospectionScheduler(request)
+    
+    Schedules the introspection requests of a shell, using the given
+    yoton ReqChannel. There is at most one request per kind (e.g. 'dir',
+    'signature', 'doc'): a new request cancels the previous one of the
+    same kind, so that the results for text that the user has moved 
+    past are dropped. The requests are sent at the next iteration of 
+    the event loop, and requests for the same name are then combined 
+    into one round trip.
+    
+    """
+    
+    # The kinds that the kernel can combine in one request
+    COMBINABLE = ('dir', 'signature', 'doc')
+    
+    def __init__(self, request):
+        self._request = request
+        self._current = {} # kind -> IntrospectionFuture
+        self._pending = []
+    
+    
+    def request(self, kind, name):
+        """ request(kind, name)
+        
+        Post a request for the given kind of information about the given 
+        name. Returns an IntrospectionFuture.
+        
+        """
+        # Cancel the previous request of this kind
+        future = self._current.get(kind, None)
+        if future is not None:
+            future.cancel()
+            # Also cancel the request at yoton if no-one needs it anymore
+            source = future._source
+            if source is not None:
+                if all([f.done() for f in source._futures]):
+                    source.cancel()
+        
+        # Schedule new request
+        future = IntrospectionFuture(kind, name)
+        self._current[kind] = future
+        self._pending.append(future)
+        if len(self._pending) == 1:
+            QtCore.QTimer.singleShot(0, self._send)
+        return future
+    
+    
+    def _send(self):
+        """ Send the pending requests, combining requests for the 
+        same name.
+        """
+        pending, self._pending = self._pending, []
+        groups = []
+        for future in pending:
+            if future.done():
+                continue # Cancelled
+            for group in groups:
+                if (group[0].name == future.name and 
+                        group[0].kind in self.COMBINABLE and 
+                        future.kind in self.COMBINABLE):
+                    group.append(future)
+                    break
+            else:
+                groups.append([future])
+        
+        for group in groups:
+            if len(group) == 1:
+                future = group[0]
+                source = getattr(self._request, future.kind)(future.name)
+            else:
+                kinds = [future.kind for future in group]
+                source = self._request.introspect(group[0].name, kinds)
+            source._futures = group
+            for future in group:
+                future._source = source
+            source.add_done_callback(self._onDone)
+    
+    
+    def _onDone(self, source):
+        """ Pass the result of a yoton future to our futures.
+        """
+        for future in source._futures:
+            if self._current.get(future.kind, None) is future:
+                self._current.pop(future.kind)
+            if future.done():
+                continue
+            elif source.cancelled():
+                future.cancel()
+            elif source.exception():
+                future._setDone(exception=source.exception())
+            elif len(source._futures) > 1:
+                result = source.result() or {}
+                future._setDone(result.get(future.kind, None))
+            else:
+                future._setDone(source.result())
+
+
+
 class PythonShell(BaseShell):
     """ The PythonShell class implements the python part of the shell
     by connecting to a remote process that runs a Python interpreter.
@@ -730,19 +1153,27 @@ class PythonShell(BaseShell):
         self._currentCTO = None
         self._currentACO = None
         
-        # Write buffer to store messages in for writing
-        self._write_buffer = None
-        
-        # Create timer to keep polling any results
-        # todo: Maybe use yoton events to process messages as they arrive.
-        # I tried this briefly, but it seemd to be less efficient because 
-        # messages are not so much bach-processed anymore. We should decide
-        # on either method.
+        # Write buffer to store messages in for writing, the number of 
+        # characters in it, and the estimated write speed (chars per second)
+        self._write_buffer = deque()
+        self._write_buffer_size = 0
+        self._write_speed = 1e6
+        
+        # For output flood protection (see OutputFlood)
+        self._flood = None
+        self._floodFiles = []
+        self._floodTimer = QtCore.QTimer(self)
+        self._floodTimer.setInterval(int(FLOOD_END_DELAY*1000))  # ms
+        self._floodTimer.setSingleShot(True)
+        self._floodTimer.timeout.connect(self._endFlood)
+        
+        # Create timer to process messages. The timer is started when 
+        # messages arrive (see _onReceived), so that an idle shell does 
+        # not wake up the GUI, and messages are still batch-processed.
         self._timer = QtCore.QTimer(self)
-        self._timer.setInterval(POLL_TIMER_INTERVAL)  # ms
-        self._timer.setSingleShot(False)
+        self._timer.setInterval(POLL_COALESCE_INTERVAL)  # ms
+        self._timer.setSingleShot(True)
         self._timer.timeout.connect(self.poll)
-        self._timer.start()
         
         # Add context menu
         self._menu = ShellContextMenu(shell=self, parent=self)
@@ -768,16 +1199,20 @@ class PythonShell(BaseShell):
         self._keywords = []
         self._startup_info = {}
         self._start_time = 0
+        self._request_time = time.time()
         
         # (re)set import attempts
         self._importAttempts[:] = []
         
+        # The messages of code that was run, by the hash of the source
+        self._sentCode = OrderedDict()
+        
         # Update
         self.stateChanged.emit(self)
     
     
-    def connectToKernel(self, info):
-        """ connectToKernel()
+    def connectToKernel(self, info, scriptFile=None):
+        """ connectToKernel(info, scriptFile=None)
         
         Create kernel and connect to it.
         
@@ -812,32 +1247,42 @@ class PythonShell(BaseShell):
         self._stat_startup = yoton.StateChannel(ct, 'stat-startup', yoton.OBJECT)
         self._stat_startup.received.bind(self._onReceivedStartupInfo)
         
-        # Create introspection request channel
+        # Create introspection request channel, and the object to 
+        # schedule requests with
         self._request = yoton.ReqChannel(ct, 'reqp-introspect')
+        self._introspection = IntrospectionScheduler(self._request)
         
         # Connect! The broker will only start the kernel AFTER
         # we connect, so we do not miss out on anything.
-        slot = iep.localKernelManager.createKernel(finishKernelInfo(info))
+        info = finishKernelInfo(info, scriptFile)
+        slot = iep.localKernelManager.createKernel(info)
         self._brokerConnection = ct.connect('localhost:%i'%slot)
         self._brokerConnection.closed.bind(self._onConnectionClose)
         
-        # todo: see polling vs events
-#         # Detect incoming messages 
-#         for c in [self._strm_out, self._strm_err, self._strm_raw, 
-#                 self._strm_echo, self._strm_prompt, self._strm_broker,
-#                 self._strm_action,
-#                 self._stat_interpreter, self._stat_debug]:
-#             c.received.bind(self.poll)
+        # Detect incoming messages. The received signals are emitted 
+        # in the yoton event loop, which is embedded in the Qt event loop.
+        for c in [self._strm_out, self._strm_err, self._strm_raw, 
+                self._strm_echo, self._strm_prompt, self._strm_broker,
+                self._strm_action,
+                self._stat_interpreter, self._stat_debug]:
+            c.received.bind(self._onReceived)
         
     
     def _onReceivedStartupInfo(self, channel):
         startup_info = channel.recv()
         
+        # Log how long the startup took (the kernel sends the startup
+        # info again, with the timings, when it is done)
+        times = startup_info.get('startupTimes', None)
+        if times and times != self._startup_info.get('startupTimes', None):
+            self._logStartupTimes(times)
+        
         # Store the whole dict
         self._startup_info = startup_info
         
-        # Store when we received this
-        self._start_time = time.time()
+        # Store when we received this (the first time)
+        if not self._start_time:
+            self._start_time = time.time()
         
         # Set version
         version = startup_info.get('version', None)
@@ -859,6 +1304,22 @@ class PythonShell(BaseShell):
         self.stateChanged.emit(self)
     
     
+    def _logStartupTimes(self, times):
+        """ _logStartupTimes(times)
+        Print the duration of the phases of the kernel startup, and of 
+        the slowest imports, in the logger.
+        """
+        lines = ['Startup of shell "%s" took %1.2f s (%1.2f s since requested):' % (
+                self._info.name, times['total'], time.time() - self._request_time)]
+        for name, t in times['phases']:
+            lines.append('    %-32s %6.3f s' % (name, t))
+        if times['imports']:
+            lines.append('  Slowest imports (own and cumulative time):')
+            for name, t, total in times['imports']:
+                lines.append('    %-32s %6.3f s %6.3f s' % (name, t, total))
+        print('\n'.join(lines))
+    
+    
     ## Introspection processing methods
     
     
@@ -877,7 +1338,7 @@ class PythonShell(BaseShell):
         self._currentCTO = cto
         
         # Post request
-        future = self._request.signature(cto.name)
+        future = self._introspection.request('signature', cto.name)
         future.add_done_callback(self._processCallTip_response)
         future.cto = cto
     
@@ -938,7 +1399,7 @@ class PythonShell(BaseShell):
         self._currentACO = aco
         
         # Post request
-        future = self._request.dir(aco.name)
+        future = self._introspection.request('dir', aco.name)
         future.add_done_callback(self._processAutoComp_response)
         future.aco = aco
     
@@ -990,7 +1451,7 @@ class PythonShell(BaseShell):
                     # To be sure, decrease the experiration date on the buffer
                     aco.setBuffer(timeout=1)
                     # Repost request
-                    future = self._request.signature(aco.name)
+                    future = self._introspection.request('dir', aco.name)
                     future.add_done_callback(self._processAutoComp_response)
                     future.aco = aco
         else:
@@ -1069,49 +1530,85 @@ class PythonShell(BaseShell):
             lines2.append( line )
         
         
-        # Send message
+        # Send message. Leave out the source if the kernel has it.
         text = "\n".join(lines2)
-        msg = {'source':text, 'fname':fname, 'lineno':lineno, 'cellName': cellName}
-        self._ctrl_code.send(msg)
+        hash = hashlib.sha1(text.encode('utf-8')).hexdigest()
+        msg = {'source':text, 'hash':hash, 'fname':fname, 'lineno':lineno, 
+                'cellName': cellName}
+        if self._sentCode.pop(hash, None) is not None:
+            msg2 = msg.copy()
+            msg2['source'] = None
+            self._ctrl_code.send(msg2)
+        else:
+            self._ctrl_code.send(msg)
+        # Keep the message, discard the least recently run
+        self._sentCode[hash] = msg
+        if len(self._sentCode) > CODE_CACHE_SIZE:
+            self._sentCode.popitem(False)
     
     
     ## The polling methods and terminating methods
     
+    def _onReceived(self, channel):
+        """ Called when any of the channels has received messages.
+        Schedule a poll, unless one is already scheduled.
+        """
+        if not self._timer.isActive():
+            self._timer.start()
+    
+    
+    def _hasPendingMessages(self):
+        """ Get whether there are messages that poll() did not process.
+        """
+        if self._write_buffer:
+            return True
+        sub = yoton.select_sub_channel(self._strm_out, self._strm_err, 
+                                self._strm_echo, self._strm_raw,
+                                self._strm_broker, self._strm_prompt,
+                                self._strm_action )
+        return sub is not None
+    
+    
     def poll(self, channel=None):
         """ poll()
-        To keep the shell up-to-date.
-        Call this periodically. 
+        To keep the shell up-to-date. Called (via a short timer) when 
+        messages are received. Processes the messages for at most 
+        FLOOD_WRITE_TIME seconds, and schedules another call if more 
+        messages are pending.
         """
         
-        if self._write_buffer:
-            # There is still data in the buffer
-            sub, M = self._write_buffer
-        else:
+        # Receive messages. If we have too many pending messages, we 
+        # leave them at yoton, so that the kernel is slowed down.
+        while self._write_buffer_size < FLOOD_MAX_PENDING:
             # Check what subchannel has the latest message pending
             sub = yoton.select_sub_channel(self._strm_out, self._strm_err, 
                                 self._strm_echo, self._strm_raw,
                                 self._strm_broker, self._strm_prompt )
+            if sub is None:
+                break
             # Read messages from it
-            if sub:
-                M = sub.recv_selected()
-                #M = [sub.recv()] # Slow version (for testing)
-                # Optimization: handle backspaces on stack of messages
-                if sub is self._strm_out:
-                    M = self._handleBackspacesOnList(M)
-            # New prompt?
-            if sub is self._strm_prompt:
-                self.stateChanged.emit(self)
-        
-        # Write all pending messages that are later than any other message
-        if sub:
-            # Select messages to process
-            N = 256
-            M, buffer = M[:N], M[N:]
-            # Buffer the rest
-            if buffer:
-                self._write_buffer = sub, buffer
-            else:
-                self._write_buffer = None
+            M = sub.recv_selected()
+            #M = [sub.recv()] # Slow version (for testing)
+            # Optimization: handle backspaces on stack of messages
+            if sub is self._strm_out:
+                M = self._handleBackspacesOnList(M)
+            # Buffer
+            if M:
+                self._write_buffer.append((sub, M))
+                self._write_buffer_size += sum([len(m) for m in M])
+        
+        # Write pending messages
+        t0 = time.time()
+        while self._write_buffer and time.time() - t0 < FLOOD_WRITE_TIME:
+            sub, M = self._write_buffer.popleft()
+            if self._flood and self._flood.sub is not sub:
+                self._endFlood()
+            if sub is self._strm_out or sub is self._strm_err:
+                M = self._writeOutput(sub, M, FLOOD_WRITE_TIME-(time.time()-t0))
+                if M:
+                    self._write_buffer.appendleft((sub, M))
+                continue
+            self._write_buffer_size -= sum([len(m) for m in M])
             # Get how to deal with prompt
             prompt = 0
             if sub is self._strm_echo:
@@ -1124,11 +1621,17 @@ class PythonShell(BaseShell):
                 color = '#000'
             elif sub is self._strm_raw:
                 color = '#888888' # Halfway
-            elif sub is self._strm_err:
-                color = '#F00'
             # Write
             self.write(''.join(M), prompt, color)
+            # New prompt?
+            if sub is self._strm_prompt:
+                self.stateChanged.emit(self)
         
+        # Show progress of the flood
+        if self._flood:
+            if time.time() - self._flood.lastUpdate > FLOOD_UPDATE_INTERVAL:
+                self._updateFlood()
+            self._floodTimer.start()
         
         # Do any actions?
         action = self._strm_action.recv(False)
@@ -1136,6 +1639,17 @@ class PythonShell(BaseShell):
             if action.startswith('open '):
                 fname = action.split(' ',1)[1]
                 iep.editors.loadFile(fname)
+            elif action.startswith('resend '):
+                # The kernel does not have the source of the code to run,
+                # and waits for it. Tell it if we do not have it either.
+                hash = action.split(' ',1)[1]
+                msg = self._sentCode.get(hash, None)
+                if msg is not None:
+                    msg = msg.copy()
+                else:
+                    msg = {'source':None, 'hash':hash}
+                msg['resent'] = True
+                self._ctrl_code.send(msg)
             else:
                 print('Unkown action: %s' % action)
         
@@ -1150,6 +1664,141 @@ class PythonShell(BaseShell):
         if state != self._debugState:
             self._debugState = state
             self.debugStateChanged.emit(self)
+        
+        # Process remaining messages in a next round
+        if self._hasPendingMessages():
+            self._timer.start()
+    
+    
+    def _writeOutput(self, sub, M, timeLeft):
+        """ _writeOutput(sub, M, timeLeft)
+        
+        Write messages from stdout or stderr, as far as possible in the
+        given time, and return the messages that are not written. If 
+        the shell cannot keep up, the output is added to the flood.
+        
+        """
+        
+        # Are we flooded? The flood ends when the output arrives slower 
+        # than we can write it.
+        pending = self._write_buffer_size
+        if not self._flood:
+            if pending > self._write_speed * FLOOD_DELAY:
+                self._startFlood(sub)
+        elif pending < self._write_speed * FLOOD_WRITE_TIME:
+            self._endFlood()
+        
+        # Add to flood
+        if self._flood:
+            text = ''.join(M)
+            self._write_buffer_size -= len(text)
+            self._flood.add(text.replace('\b', ''))
+            return []
+        
+        # Select the messages that we can write in time
+        maxChars = max(1024, int(self._write_speed * timeLeft))
+        n, i = 0, 0
+        while i < len(M) and n < maxChars:
+            n += len(M[i])
+            i += 1
+        M, rest = M[:i], M[i:]
+        text = ''.join(M)
+        self._write_buffer_size -= len(text)
+        
+        # Write and update the write speed estimate
+        color = None
+        if sub is self._strm_err:
+            color = '#F00'
+        t0 = time.time()
+        self.write(text, 0, color)
+        t1 = time.time()
+        if len(text) > 1024 and t1 > t0:
+            speed = len(text) / (t1 - t0)
+            self._write_speed = 0.8 * self._write_speed + 0.2 * speed
+        return rest
+    
+    
+    def _startFlood(self, sub):
+        """ Start suppressing the output of the given stream. 
+        """
+        # Make the marker start on a new line
+        if not self._cursor1.atBlockStart():
+            self.write('\n')
+        # Create cursor that stays at the start of the marker
+        cursor = QtGui.QTextCursor(self._cursor1)
+        cursor.setKeepPositionOnInsert(True)
+        self._flood = OutputFlood(sub, cursor)
+        self._floodFiles.append(self._flood.filename)
+    
+    
+    def _updateFlood(self):
+        """ Show the marker and the last lines of the flood, replacing 
+        the previous marker and lines.
+        """
+        flood = self._flood
+        flood.lastUpdate = time.time()
+        # Remove what we wrote previously
+        self._cursor1.clearSelection()
+        self._cursor1.setPosition(flood.cursor.position(), A_KEEP)
+        self._cursor1.removeSelectedText()
+        # Write the marker, which links to the file
+        format = QtGui.QTextCharFormat()
+        format.setAnchor(True)
+        format.setAnchorHref(flood.filename)
+        format.setForeground(QtGui.QColor('#00F'))
+        format.setFontUnderline(True)
+        self._cursor1.setKeepPositionOnInsert(False)
+        self._cursor2.setKeepPositionOnInsert(False)
+        self._cursor1.insertText(flood.getMarker(), format)
+        self._cursor1.setKeepPositionOnInsert(True)
+        self._cursor2.setKeepPositionOnInsert(True)
+        # Write the last lines
+        color = None
+        if flood.sub is self._strm_err:
+            color = '#F00'
+        self.write(flood.tail, 0, color)
+    
+    
+    def _endFlood(self):
+        """ Called when the flood is over (i.e. there is no more output 
+        or other messages arrive).
+        """
+        if self._flood:
+            self._updateFlood()
+            self._flood.close()
+            self._flood = None
+        self._floodTimer.stop()
+    
+    
+    def _discardOutput(self):
+        """ End any output flood, and discard the output that has been 
+        received but not yet written (e.g. of a kernel that is replaced).
+        """
+        self._endFlood()
+        self._write_buffer.clear()
+        self._write_buffer_size = 0
+        self._pendingCR = False
+    
+    
+    def mouseReleaseEvent(self, event):
+        """ Open the suppressed output when a flood marker is clicked. 
+        """
+        BaseShell.mouseReleaseEvent(self, event)
+        if event.button() != QtCore.Qt.LeftButton:
+            return
+        if self.textCursor().hasSelection():
+            return
+        # Check the characters at both sides of the mouse
+        cursor = self.cursorForPosition(event.pos())
+        hrefs = [cursor.charFormat().anchorHref()]
+        cursor.movePosition(cursor.Right, A_MOVE)
+        hrefs.append(cursor.charFormat().anchorHref())
+        for href in hrefs:
+            if href and href in self._floodFiles:
+                if self._flood and self._flood.filename == href:
+                    self._flood.flush()
+                iep.editors.loadFile(href)
+                break
     
     
     def interrupt(self):
@@ -1170,6 +1819,20 @@ class PythonShell(BaseShell):
         # Get info
         info = finishKernelInfo(self._info, scriptFile)
         
+        if iep.localKernelManager.hasIdleKernel(info):
+            # Connect to a prestarted kernel. The broker of the current
+            # kernel terminates it when we disconnect.
+            self.terminate()
+            self._context.flush()
+            self._brokerConnection.closed.unbind(self._onConnectionClose)
+            self._context.close()
+            self._discardOutput()
+            self.write('\nKernel process replaced for restart.\n\n', 0, '#000')
+            self.write('\b', 2)
+            self.resetVariables()
+            self.connectToKernel(self._info, scriptFile)
+            return
+        
         # Create message and send
         msg = 'RESTART\n' + ssdf.saves(info)
         self._ctrl_broker.send(msg)
@@ -1212,6 +1875,14 @@ class PythonShell(BaseShell):
             self._context.flush() # Important, make sure the message is send!
             self._context.close()
         
+        # Remove files with suppressed output
+        self._endFlood()
+        for fname in self._floodFiles:
+            try:
+                os.remove(fname)
+            except Exception:
+                pass
+        
         # Adios
         iep.shells.removeShell(self)
     
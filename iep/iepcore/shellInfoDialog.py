@@ -295,6 +295,16 @@ class ShellInfo_startDir(ShellInfoLineEdit):
     pass
 
 
+
+class ShellInfo_outputFlush(ShellInfoLineEdit):
+    pass
+
+
+
+class ShellInfo_preloadModules(ShellInfoLineEdit):
+    pass
+
+
 ## The dialog class and container with tabs
 
 
@@ -305,7 +315,9 @@ class ShellInfoTab(QtGui.QWidget):
                     translate('shell', 'gui ::: The GUI toolkit to integrate (for interactive plotting, etc.).'), 
                     translate('shell', 'pythonPath ::: A list of directories to search for modules and packages. Write each path on a new line, or separate with the default seperator for this OS.'), 
                     translate('shell', 'startupScript ::: The script to run at startup (not in script mode).'), 
-                    translate('shell', 'startDir ::: The start directory (not in script mode).')
+                    translate('shell', 'startDir ::: The start directory (not in script mode).'),
+                    translate('shell', 'outputFlush ::: When to send output to the shell: "maxSize, maxDelay", i.e. when this many characters are buffered, or this many milliseconds after printing. Use "0, 0" to send all output immediately.'),
+                    translate('shell', 'preloadModules ::: Modules to import in advance, separated by commas (Linux only). Kernels are then started from a process that has imported them, so that (re)starting takes little time.')
                 ]
     
     def __init__(self, parent):
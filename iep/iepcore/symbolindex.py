@@ -0,0 +1,571 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012, the IEP development team
+#
+# IEP is distributed under the terms of the (new) BSD License.
+# The full license can be found in 'license.txt'.
+
+""" Module symbolindex
+
+Keeps an index of the classes and functions that are defined in the
+modules of the user's projects (the starred directories of the file
+browser and the projects of the project manager). This enables
+introspection of modules that are not open in an editor and not
+imported in the shell: autocompletion, calltips and going to the
+definition of a name.
+
+The index is stored in an SQLite database in the application data
+directory. It is updated in a separate thread, which only analyzes
+the files that were modified since they were last indexed. If 
+parserUseProcess is set, the files are parsed in a worker process.
+
+"""
+
+import os, time, threading, sqlite3, tokenize
+import multiprocessing, concurrent.futures
+import iep
+from iep.iepcore.codeparser import analyzeWithAst
+
+
+# The version of the database layout. The index is rebuilt when it changes.
+SCHEMA_VERSION = 1
+
+# The maximum number of files, and the maximum size of a file, to index
+MAX_FILES = 20000
+MAX_FILE_SIZE = 1000000
+
+# The maximum time (in seconds) to pause after analyzing a file in the 
+# thread. The thread pauses as long as the analysis took (up to this time), 
+# so that it does not keep the GUI busy when it indexes many files.
+MAX_PAUSE = 0.1
+
+
+class SymbolIndex(threading.Thread):
+    """ SymbolIndex(filename=None)
+    Thread that indexes the symbols in the modules of the user's projects.
+    This class is also the interface to the index; its methods to query
+    the index can be used from any thread.
+    """
+    
+    def __init__(self, filename=None):
+        threading.Thread.__init__(self)
+        
+        # The directories to index, and whether they should be scanned.
+        # The first scan starts when update() is called.
+        self._roots = []
+        self._update = False
+        
+        # The time (in seconds) between checks for modified files
+        self._interval = max(1.0, float(iep.config.advanced.symbolIndexInterval))
+        
+        # Whether to analyze the files in a worker process. The process 
+        # pool is created when it is first needed.
+        self._useProcess = bool(iep.config.advanced.parserUseProcess)
+        self._pool = None
+        
+        # Lock for the database connection, which is shared between threads.
+        # The condition is used to wake up the thread.
+        self._lock = threading.RLock()
+        self._condition = threading.Condition(self._lock)
+        
+        # Open database
+        if filename is None:
+            filename = os.path.join(iep.appDataDir, 'symbolindex.sqlite')
+        try:
+            self._db = sqlite3.connect(filename, check_same_thread=False)
+            self._createTables()
+        except sqlite3.Error as err:
+            print('Could not open the symbol index: ' + str(err))
+            self._db = None
+        
+        # Set deamon
+        self.daemon = True
+        self._exit = False
+    
+    
+    def stop(self, timeout=1.0):
+        """ stop(timeout=1.0)
+        Stop the thread and close the database. Can be called more than once.
+        """
+        with self._condition:
+            self._exit = True
+            self._condition.notify()
+        self.join(timeout)
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        self.close()
+    
+    
+    def close(self):
+        """ close()
+        Commit the changes and close the database. If the thread is still
+        busy, it does not write to the database after this.
+        """
+        with self._lock:
+            if self._db is not None:
+                try:
+                    self._db.commit()
+                    self._db.close()
+                except sqlite3.Error:
+                    pass
+                self._db = None
+    
+    
+    def _createTables(self):
+        """ _createTables()
+        Create the tables, dropping the old ones if their layout is outdated.
+        """
+        db = self._db
+        if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            db.execute('DROP TABLE IF EXISTS files')
+            db.execute('DROP TABLE IF EXISTS symbols')
+            db.execute('PRAGMA user_version = %i' % SCHEMA_VERSION)
+        db.execute('''CREATE TABLE IF NOT EXISTS files (
+                        path TEXT PRIMARY KEY, module TEXT, mtime REAL)''')
+        db.execute('''CREATE TABLE IF NOT EXISTS symbols (
+                        path TEXT, module TEXT, parent TEXT, name TEXT,
+                        type TEXT, linenr INTEGER, sig TEXT,
+                        supers TEXT, members TEXT)''')
+        db.execute('CREATE INDEX IF NOT EXISTS files_module ON files(module)')
+        db.execute('''CREATE INDEX IF NOT EXISTS symbols_name
+                        ON symbols(module, parent, name)''')
+        db.execute('CREATE INDEX IF NOT EXISTS symbols_path ON symbols(path)')
+        db.commit()
+    
+    
+    def update(self):
+        """ update()
+        Get the directories of the user's projects and let the thread
+        check for modified files. Should be called from the main thread.
+        """
+        roots = getProjectDirs()
+        with self._condition:
+            self._roots = roots
+            self._update = True
+            self._condition.notify()
+    
+    
+    ## Queries
+    
+    
+    def getFullName(self, name, editor):
+        """ getFullName(name, editor)
+        Get the full name (i.e. including the module name) of the given
+        name as used in the source of the given editor, using the imports
+        in that source. Returns None if the name is not imported.
+        """
+        
+        # Get the (base part of the) name that is imported
+        importNames, importLines = iep.parser.getFictiveImports(editor)
+        baseName = name
+        while baseName not in importNames:
+            if '.' not in baseName:
+                return None
+            baseName = baseName.rsplit('.', 1)[0]
+        fullName = getImportedName(importLines[baseName], baseName,
+                                   self._getPackage(editor))
+        if fullName:
+            return fullName + name[len(baseName):]
+        return None
+    
+    
+    def getMembers(self, fullName):
+        """ getMembers(fullName)
+        Get the names of the members of the given module or class.
+        Returns an empty list if the name is not in the index.
+        """
+        module, rest = self._splitName(fullName)
+        if module is None or '.' in rest:
+            return []
+        
+        with self._lock:
+            if not rest:
+                # Names defined in the module, and its submodules
+                names = [row[0] for row in self._db.execute('''SELECT name
+                            FROM symbols WHERE module=? AND parent=?''',
+                            (module, ''))]
+                for row in self._db.execute('''SELECT module FROM files
+                            WHERE module LIKE ?''', (module + '.%',)):
+                    name = row[0][len(module)+1:]
+                    if row[0].startswith(module + '.') and '.' not in name:
+                        names.append(name)
+                return names
+            
+            # Members of the class and of its bases in the same module
+            names, classNames, done = [], [rest], set()
+            while classNames:
+                className = classNames.pop(0)
+                if className in done:
+                    continue # circular bases
+                done.add(className)
+                row = self._db.execute('''SELECT supers, members FROM symbols
+                            WHERE module=? AND parent=? AND name=? AND
+                            type=?''', (module, '', className, 'class')
+                            ).fetchone()
+                if row:
+                    classNames.extend(row[0].split(','))
+                    names.extend(row[1].split(','))
+            return [name for name in names if name]
+    
+    
+    def getSignature(self, fullName):
+        """ getSignature(fullName)
+        Get the signature of the given function, method or class (from
+        its __init__ method). Returns None if the name is not in the index.
+        """
+        module, rest = self._splitName(fullName)
+        if not rest:
+            return None
+        parent, tmp, name = rest.rpartition('.')
+        
+        with self._lock:
+            row = self._db.execute('''SELECT type, sig FROM symbols
+                        WHERE module=? AND parent=? AND name=?''',
+                        (module, parent, name)).fetchone()
+            if row and row[0] == 'class':
+                row = self._db.execute('''SELECT type, sig FROM symbols
+                        WHERE module=? AND parent=? AND name=?''',
+                        (module, rest, '__init__')).fetchone()
+        
+        if row:
+            return '{}({})'.format(name, row[1])
+        else:
+            return None
+    
+    
+    def getDefinition(self, fullName):
+        """ getDefinition(fullName)
+        Get where the given module, class or function is defined, as
+        a (filename, linenr) tuple. Returns None if it is not in the index.
+        """
+        module, rest = self._splitName(fullName)
+        if module is None:
+            return None
+        parent, tmp, name = rest.rpartition('.')
+        
+        with self._lock:
+            if not rest:
+                row = self._db.execute('''SELECT path, 1 FROM files
+                            WHERE module=?''', (module,)).fetchone()
+            else:
+                row = self._db.execute('''SELECT path, linenr FROM symbols
+                            WHERE module=? AND parent=? AND name=?''',
+                            (module, parent, name)).fetchone()
+        
+        return tuple(row) if row else None
+    
+    
+    def _splitName(self, fullName):
+        """ _splitName(fullName)
+        Split the given name in the name of an indexed module and the
+        rest. Names that a module imports are followed to the module that
+        defines them. Returns (None, '') if no module in the index matches.
+        """
+        if self._db is None:
+            return None, ''
+        for i in range(10): # limit the number of imports to follow
+            module, rest = self._splitName1(fullName)
+            if not rest:
+                break
+            # Is the first part of the rest imported in the module?
+            name, dot, rest2 = rest.partition('.')
+            with self._lock:
+                row = self._db.execute('''SELECT sig FROM symbols WHERE
+                            module=? AND parent=? AND name=? AND type=?''',
+                            (module, '', name, 'import')).fetchone()
+            if not row:
+                break
+            fullName = row[0] + dot + rest2
+        return module, rest
+    
+    
+    def _splitName1(self, fullName):
+        """ Helper for _splitName. """
+        parts = fullName.split('.')
+        with self._lock:
+            for i in range(len(parts), 0, -1):
+                module = '.'.join(parts[:i])
+                row = self._db.execute('SELECT 1 FROM files WHERE module=?',
+                                        (module,)).fetchone()
+                if row:
+                    return module, '.'.join(parts[i:])
+        return None, ''
+    
+    
+    def _getPackage(self, editor):
+        """ _getPackage(editor)
+        Get the name of the package of the file in the given editor, which
+        is needed to resolve relative imports. Returns None if unknown.
+        """
+        if self._db is None or not editor._filename:
+            return None
+        path = os.path.normcase(os.path.abspath(editor._filename))
+        with self._lock:
+            row = self._db.execute('SELECT module FROM files WHERE path=?',
+                                    (path,)).fetchone()
+        return getPackage(row[0], path) if row else None
+    
+    
+    ## Indexing
+    
+    
+    def run(self):
+        """ run()
+        The main loop. Checks for modified files when an update is
+        requested, and every once in a while.
+        """
+        
+        if self._db is None:
+            return
+        
+        try:
+            while True:
+                with self._condition:
+                    if not (self._update or self._exit):
+                        self._condition.wait(self._interval)
+                    if self._exit:
+                        return
+                    self._update = False
+                    roots = self._roots
+                self._scan(roots)
+        except AttributeError:
+            pass # when python exits, modules can be None...
+    
+    
+    def _scan(self, roots):
+        """ _scan(roots)
+        Find the modules in the given directories, index the files that
+        were modified, and remove the files that no longer exist.
+        """
+        
+        # Get the files in the index
+        with self._lock:
+            if self._db is None:
+                return
+            indexed = dict(self._db.execute('SELECT path, mtime FROM files'))
+        
+        # Find modules
+        files = {}
+        for root in roots:
+            findModules(root, files)
+        
+        # Index modified files
+        count = 0
+        for path, (module, mtime) in files.items():
+            if self._exit:
+                return
+            if indexed.pop(path, None) != mtime:
+                self._indexFile(path, module, mtime)
+                count += 1
+                if count % 100 == 0:
+                    with self._lock:
+                        if self._db is not None:
+                            self._db.commit()
+        
+        # Remove files that no longer exist, or that are no longer in a project
+        with self._lock:
+            if self._db is None:
+                return
+            for path in indexed:
+                self._db.execute('DELETE FROM files WHERE path=?', (path,))
+                self._db.execute('DELETE FROM symbols WHERE path=?', (path,))
+            self._db.commit()
+    
+    
+    def _indexFile(self, path, module, mtime):
+        """ _indexFile(path, module, mtime)
+        Analyse the given file and store its symbols in the database.
+        Files that cannot be analyzed are stored without symbols.
+        """
+        
+        # Analyse the file
+        rows = []
+        result = self._analyzeFile(path)
+        
+        # Get the classes and functions, and the methods of classes. The
+        # imports are stored too, with the full imported name as signature.
+        if result:
+            package = getPackage(module, path)
+            for item in result[0].children:
+                if item.type == 'import':
+                    fullName = getImportedName(item.text, item.name, package)
+                    if fullName:
+                        rows.append((path, module, '', item.name, item.type,
+                                    item.linenr, fullName, '', ''))
+                if item.type not in ['class', 'def']:
+                    continue
+                supers = ','.join(getattr(item, 'supers', []))
+                members = ','.join(getattr(item, 'members', []))
+                rows.append((path, module, '', item.name, item.type,
+                            item.linenr, item.sig, supers, members))
+                if item.type == 'class':
+                    for sub in item.children:
+                        if sub.type == 'def':
+                            rows.append((path, module, item.name, sub.name,
+                                        sub.type, sub.linenr, sub.sig, '', ''))
+        
+        # Store
+        with self._lock:
+            if self._db is None:
+                return
+            self._db.execute('DELETE FROM symbols WHERE path=?', (path,))
+            self._db.executemany('INSERT INTO symbols VALUES (?,?,?,?,?,?,?,?,?)',
+                                 rows)
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?)',
+                             (path, module, mtime))
+    
+    
+    def _analyzeFile(self, path):
+        """ _analyzeFile(path)
+        Analyse the given file in the worker process, or in this thread if
+        the worker process is not used. In the latter case, pause after 
+        the analysis, so that the GUI can keep up.
+        """
+        
+        # Analyze in the worker process. Use spawn, because forking a 
+        # process that runs Qt and several threads is not safe.
+        if self._useProcess:
+            try:
+                if self._pool is None:
+                    context = multiprocessing.get_context('spawn')
+                    self._pool = concurrent.futures.ProcessPoolExecutor(1, 
+                                                            mp_context=context)
+                return self._pool.submit(analyzeFile, path).result()
+            except Exception as err:
+                if self._exit:
+                    return False
+                print('Could not index in a worker process: ' + str(err))
+                self._useProcess = False
+        
+        # Analyze here
+        t0 = time.time()
+        result = analyzeFile(path)
+        time.sleep(min(MAX_PAUSE, time.time() - t0))
+        return result
+
+
+
+## Helper functions
+
+
+def getProjectDirs():
+    """ getProjectDirs()
+    Get the directories of the user's projects: the starred directories
+    of the file browser and the projects of the project manager.
+    """
+    dirs = []
+    tools = iep.config.tools
+    if 'iepfilebrowser2' in tools:
+        for d in getattr(tools.iepfilebrowser2, 'starredDirs', []):
+            dirs.append(str(d.path))
+    if 'iepprojectmanager' in tools:
+        for project in getattr(tools.iepprojectmanager, 'projects', []):
+            dirs.append(str(project.path))
+    
+    # Normalize and remove duplicates
+    roots = []
+    for d in dirs:
+        d = os.path.normcase(os.path.abspath(d))
+        if os.path.isdir(d) and d not in roots:
+            roots.append(d)
+    return roots
+
+
+def findModules(root, files):
+    """ findModules(root, files)
+    Find the Python modules in the given directory and its subdirectories
+    and add them to the given dict, which maps paths to (moduleName, mtime)
+    tuples. Directories that cannot be imported from are skipped.
+    """
+    
+    # If the root itself is a package, the modules are in that package
+    package = []
+    path = root
+    while os.path.isfile(os.path.join(path, '__init__.py')):
+        path, name = os.path.split(path)
+        package.insert(0, name)
+    
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d.isidentifier()]
+        parts = package + os.path.relpath(dirpath, root).split(os.sep)
+        parts = [part for part in parts if part != '.']
+        for filename in filenames:
+            name, ext = os.path.splitext(filename)
+            if ext not in ('.py', '.pyw') or not name.isidentifier():
+                continue
+            if len(files) >= MAX_FILES:
+                return
+            path = os.path.join(dirpath, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            if st.st_size > MAX_FILE_SIZE:
+                continue
+            module = parts + ([] if name == '__init__' else [name])
+            if module:
+                files[os.path.normcase(path)] = '.'.join(module), st.st_mtime
+
+
+def analyzeFile(path):
+    """ analyzeFile(path)
+    Read the given file and analyse it using analyzeWithAst(). Returns 
+    False if the file cannot be read or parsed. This function can run in 
+    a worker process.
+    """
+    try:
+        with tokenize.open(path) as f:
+            text = f.read()
+    except (OSError, SyntaxError, LookupError, UnicodeDecodeError):
+        return False
+    return analyzeWithAst(text.split('\n'))
+
+
+def getPackage(module, path):
+    """ getPackage(module, path)
+    Get the name of the package that the given module (with the given
+    filename) is part of. For a package, that is the package itself.
+    """
+    if os.path.basename(path).split('.')[0] == '__init__':
+        return module
+    else:
+        return module.rpartition('.')[0]
+
+
+def getImportedName(line, name, package=None):
+    """ getImportedName(line, name, package=None)
+    Get the full name of what the given import line imports as the given
+    name. Relative imports are resolved using the name of the package
+    of the importing module. Returns None if this cannot be resolved.
+    """
+    
+    # Get module and the imported names
+    if line.startswith('import '):
+        module, names = '', line[7:]
+    elif line.startswith('from '):
+        module, tmp, names = line[5:].partition(' import ')
+        module = module.strip()
+        # Resolve relative import, going up one package for each extra dot
+        if module.startswith('.'):
+            if package is None:
+                return None
+            parts = package.split('.') if package else []
+            level = len(module) - len(module.lstrip('.'))
+            if level - 1 > len(parts):
+                return None
+            parts = parts[:len(parts)-(level-1)]
+            if module.lstrip('.'):
+                parts.append(module.lstrip('.'))
+            module = '.'.join(parts)
+        if not module:
+            return None
+        module += '.'
+    else:
+        return None
+    
+    # Find what was imported as the name
+    for part in names.strip('()\\ ').split(','):
+        importedName, tmp, alias = part.partition(' as ')
+        importedName = importedName.strip(' ()')
+        if (alias.strip() or importedName) == name:
+            return module + importedName
+    return None
@@ -21,4 +21,6 @@ def printDirect(msg):
     the Python banner is one example.
     """
     import sys
+    from iepkernel.streams import flushAll
+    flushAll() # Keep the order of the output
     sys._iepInterpreter.context._strm_out.send(msg)
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012, the IEP development team
+#
+# IEP is distributed under the terms of the (new) BSD License.
+# The full license can be found in 'license.txt'.
+
+
+""" iepkernel/forkserver.py
+
+A template process for kernels (Linux only). It imports a list of modules
+once, and then forks a kernel for each request. Because the modules are
+already imported, a kernel that uses them starts up quickly.
+
+Usage: python forkserver.py <fd> <modules>
+
+The fd is that of a listening UNIX socket created by the broker, and
+modules is a comma separated list of modules to import. Each request is
+a connection over which the broker sends "<port> <fifo>\\n", where port is
+the port for the kernel to connect to, and fifo the filename of the fifo
+to write stdout and stderr to. The server answers "pid <pid>\\n" and, when
+the kernel exits, "exit <returncode>\\n". The server exits when its stdin
+is closed.
+
+"""
+
+import os, sys, socket, select, signal, traceback
+
+# The script that starts a kernel
+START_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                            'start.py')
+
+
+def main(fd, modules):
+    
+    # Import modules
+    for name in modules.split(','):
+        if name:
+            try:
+                __import__(name)
+            except Exception:
+                value = sys.exc_info()[1]
+                sys.stderr.write('Fork server could not import %s: %s\n' %
+                                                            (name, value))
+    
+    # Get the socket that the broker listens on
+    listener = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(fd)
+    
+    # Ctrl-c in the terminal should not stop us
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    
+    # Wake up when a kernel exits
+    wakeup_r, wakeup_w = os.pipe()
+    def onChild(signum, frame):
+        os.write(wakeup_w, 'x'.encode('ascii'))
+    signal.signal(signal.SIGCHLD, onChild)
+    
+    # Connections to the broker, by pid of the kernel
+    connections = {}
+    
+    while True:
+        
+        # Wait for something to happen
+        try:
+            readable = select.select([listener, wakeup_r, 0], [], [])[0]
+        except (select.error, OSError):
+            continue # Interrupted by a signal
+        
+        # Stop when the broker is gone
+        if 0 in readable:
+            if not os.read(0, 512):
+                break
+        
+        # Tell the broker which kernels have exited
+        if wakeup_r in readable:
+            os.read(wakeup_r, 512)
+        while connections:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError:
+                break
+            if not pid:
+                break
+            if os.WIFEXITED(status):
+                returncode = os.WEXITSTATUS(status)
+            else:
+                returncode = -os.WTERMSIG(status)
+            conn = connections.pop(pid, None)
+            if conn is not None:
+                send(conn, 'exit %i\n' % returncode)
+                conn.close()
+        
+        # Fork a kernel
+        if listener in readable:
+            conn = None
+            try:
+                conn = listener.accept()[0]
+                port, fifo = receiveLine(conn).split(' ', 1)
+                pid = os.fork()
+            except Exception:
+                value = sys.exc_info()[1]
+                sys.stderr.write('Fork server could not fork: %s\n' % value)
+                # Tell the broker, so that it does not wait forever
+                if conn is not None:
+                    send(conn, 'exit -1\n')
+                    conn.close()
+                continue
+            if pid == 0:
+                # In the kernel
+                listener.close()
+                for c in connections.values():
+                    c.close()
+                os.close(wakeup_r)
+                os.close(wakeup_w)
+                runKernel(int(port), fifo)
+            else:
+                send(conn, 'pid %i\n' % pid)
+                connections[pid] = conn
+
+
+def send(conn, text):
+    try:
+        conn.sendall(text.encode('ascii'))
+    except socket.error:
+        pass # Broker is gone
+
+
+def receiveLine(conn):
+    data = ''
+    while not data.endswith('\n'):
+        part = conn.recv(1024).decode('utf-8')
+        if not part:
+            break
+        data += part
+    return data.strip()
+
+
+def runKernel(port, fifo):
+    """ runKernel(port, fifo)
+    Run the start script in a fresh __main__ module, with the output going
+    to the given fifo. Does not return.
+    """
+    
+    # Restore signal handlers
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    
+    # Redirect stdin, stdout and stderr
+    fd = os.open(fifo, os.O_WRONLY)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(fd, 0)
+    os.close(fd)
+    
+    # Kernels should not produce the same random numbers
+    if 'random' in sys.modules:
+        sys.modules['random'].seed()
+    if 'numpy.random' in sys.modules:
+        try:
+            sys.modules['numpy.random'].seed()
+        except Exception:
+            pass
+    
+    # Run
+    returncode = 0
+    try:
+        try:
+            main = type(sys)('__main__')
+            main.__file__ = START_SCRIPT
+            sys.modules['__main__'] = main
+            sys.argv = [START_SCRIPT, str(port)]
+            code = compile(open(START_SCRIPT, 'rb').read(), START_SCRIPT, 'exec')
+            exec(code, main.__dict__)
+        except SystemExit:
+            code = sys.exc_info()[1].code
+            if isinstance(code, int):
+                returncode = code
+            elif code is not None:
+                sys.stderr.write(str(code) + '\n')
+                returncode = 1
+        except:
+            traceback.print_exc()
+            returncode = 1
+    finally:
+        try:
+            import atexit
+            atexit._run_exitfuncs()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        except Exception:
+            pass
+        os._exit(returncode)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]), (sys.argv[2:] or [''])[0])
@@ -16,15 +16,17 @@ occur in any othe packages to prevent import clashes.
 
 """
 
-import os, sys, time
+import os, sys, time, threading
 import struct
 from codeop import CommandCompiler
+from collections import deque
 import traceback
 import keyword
 import inspect # Must be in this namespace
 
 import yoton
 from iepkernel import guiintegration, printDirect
+from iepkernel.streams import flushAll
 from iepkernel.magic import Magician
 
 # Init last traceback information
@@ -32,6 +34,15 @@ sys.last_type = None
 sys.last_value = None
 sys.last_traceback = None
 
+# The number of sources (by hash) and code objects to keep, so that code
+# that is run again need not be send and compiled again (see shell.py)
+CODE_CACHE_SIZE = 32
+
+# The maximum amount of source (in characters) that is kept to reproduce
+# tracebacks, and the number of compilations to keep per source
+EXECUTED_SOURCE_SIZE = 2**24 # 16M characters
+EXECUTED_SOURCE_RUNS = 8
+
 # Set Python version as a float and get some names
 PYTHON_VERSION = sys.version_info[0] + sys.version_info[1]/10.0
 if PYTHON_VERSION < 3:
@@ -58,7 +69,14 @@ class IepInterpreter:
       * introspector: the introspector instance (a subclassed yoton.RepChannel)
       * magician: the object that handles the magic commands
       * guiApp: a wrapper for the integrated GUI application
-      * sleeptime: the amount of time (in seconds) to sleep at each iteration
+      * sleeptime: the interval (in seconds) at which the events of the GUI
+        toolkit are processed while waiting for commands
+      * idletime: the maximum time (in seconds) to wait for commands when
+        no GUI toolkit is integrated
+      * executionCount: incremented before and after executing code, so
+        that the introspector knows when its caches are invalid
+      * startupTimer: measures the phases of the startup (see timing.py),
+        None when the startup is done
     
     """
     
@@ -92,12 +110,26 @@ class IepInterpreter:
         # Init datase to store source code that we execute
         self._codeCollection = ExecutedSourceCollection()
         
+        # Init cache for the sources that the IDE sent and their code objects,
+        # and the queue of code that waits for its source (see _takeCode())
+        self._codeCache = CompiledCodeCache()
+        self._heldCode = deque()
+        self.executionCount = 0
+        
+        # Set by start.py, the report is send with the first prompt
+        self.startupTimer = None
+        
         # Init buffer to deal with multi-line command in the shell
         self._buffer = []
         
         # Init sleep time. 0.001 result in 0% CPU usage at my laptop (Windows),
-        # but 8% CPU usage at my older laptop (on Linux).
+        # but 8% CPU usage at my older laptop (on Linux). The interpreter
+        # wakes up as soon as a message arrives, so this is only used to
+        # keep a GUI toolkit responsive (or to poll the channels if waiting
+        # for messages is not supported). Without GUI toolkit, we only wake
+        # up every idletime seconds to check whether we're still connected.
         self.sleeptime = 0.01 # 100 Hz
+        self.idletime = 1.0
         
         # Create compiler
         self._compile = CommandCompiler()
@@ -143,6 +175,12 @@ class IepInterpreter:
         while self.context._stat_startup.recv() is None:
             time.sleep(0.02)
         self.startup_info = startup_info = self.context._stat_startup.recv().copy()
+        if startup_info.get('prestarted', False):
+            # We waited in the pool of prestarted kernels
+            if self.startupTimer is not None:
+                self.startupTimer.reset()
+        else:
+            self._markStartupPhase('waiting for startup info')
         
         # Set startup info (with additional info)
         builtins = __builtins__
@@ -153,6 +191,9 @@ class IepInterpreter:
         startup_info['keywords'] = keyword.kwlist
         self.context._stat_startup.send(startup_info)
         
+        # Set how the output is buffered: "maxSize, maxDelay" (chars, ms)
+        self._setOutputFlush(startup_info.get('outputFlush', ''))
+        
         # Write Python banner (to stdout)
         NBITS = 8 * struct.calcsize("P")
         platform = sys.platform
@@ -191,6 +232,7 @@ class IepInterpreter:
             tb = None
             guiError = 'Failed to integrate event loop for %s: %s' % (
                 guiName, str(value))
+        self._markStartupPhase('GUI integration')
         
         # Write IEP part of banner (including what GUI loop is integrated)
         if True:
@@ -281,6 +323,40 @@ class IepInterpreter:
                 self._scriptToRunOnStartup = filename
     
     
+    def _markStartupPhase(self, name):
+        """ _markStartupPhase(name)
+        Mark the end of a phase of the startup.
+        """
+        if self.startupTimer is not None:
+            self.startupTimer.mark(name)
+    
+    
+    def _sendStartupTimes(self):
+        """ _sendStartupTimes()
+        Stop the startup timer and send its report to the IDE, along 
+        with the startup info.
+        """
+        timer, self.startupTimer = self.startupTimer, None
+        self.startup_info['startupTimes'] = timer.stop()
+        self.context._stat_startup.send(self.startup_info.copy())
+    
+    
+    def _setOutputFlush(self, policy):
+        """ _setOutputFlush(policy)
+        Set the flush policy of the buffered stdout and stderr. The policy
+        is a string "maxSize, maxDelay", with maxDelay in milliseconds. 
+        """
+        try:
+            maxSize, maxDelay = [float(i) for i in policy.split(',')]
+        except ValueError:
+            if policy.strip():
+                printDirect('Invalid output flush policy: %r\n' % policy)
+            return
+        for file in [sys.stdout, sys.stderr]:
+            if hasattr(file, 'setFlushPolicy'):
+                file.setFlushPolicy(maxSize, maxDelay / 1000.0)
+    
+    
     def _mainloop(self):
         """ The actual main loop of the interpreter.
         """
@@ -292,6 +368,9 @@ class IepInterpreter:
         strm_prompt = self.context._strm_prompt
         stat_interpreter = self.context._stat_interpreter
         
+        # Get event that is set when a message arrives (or None)
+        newMessage = getMessageEvent(ctrl_command, ctrl_code)
+        
         # To keep track of whether to send a new prompt, and whether more
         # code is expected.
         more = 0
@@ -306,11 +385,17 @@ class IepInterpreter:
                     stat_interpreter.send('Busy') 
                     self._scriptToRunOnStartup, tmp = None, self._scriptToRunOnStartup
                     self.runfile(tmp)
+                    self._markStartupPhase('running ' + os.path.basename(tmp))
                 
                 # Set status and prompt?
                 # Prompt is allowed to be an object with __str__ method
                 if newPrompt:
                     newPrompt = False
+                    # Send any buffered output before the prompt
+                    flushAll()
+                    # Report how long the startup took (the first time)
+                    if self.startupTimer is not None:
+                        self._sendStartupTimes()
                     # Write prompt (note that the second "if" is not an "elif"!
                     preamble = ''
                     if self._dbFrames:
@@ -337,11 +422,20 @@ class IepInterpreter:
                     # Exit from main loop
                     break
                 
-                # Get channel to take a message from
+                # Get channel to take a message from. Clear the event 
+                # first, so that we cannot miss a message.
+                if newMessage is not None:
+                    newMessage.clear()
                 ch = yoton.select_sub_channel(ctrl_command, ctrl_code)
                 
                 if ch is None:
-                    pass # No messages waiting
+                    # No messages waiting, wait for one (or poll)
+                    if newMessage is None:
+                        time.sleep(self.sleeptime)
+                    elif self.guiApp:
+                        newMessage.wait(self.sleeptime)
+                    else:
+                        newMessage.wait(self.idletime)
                 
                 elif ch is ctrl_command:
                     # Read command 
@@ -362,9 +456,10 @@ class IepInterpreter:
                             self._resetbuffer()
                 
                 elif ch is ctrl_code:
-                    # Read larger block of code (dict)
+                    # Read larger block of code (dict), and run the code
+                    # that can be run now
                     msg = ctrl_code.recv(False)
-                    if msg:
+                    for msg in self._takeCode(msg):
                         # Notify what we're doing
                         # (runlargecode() sends on stdin-echo)
                         stat_interpreter.send('Busy')
@@ -382,9 +477,6 @@ class IepInterpreter:
                 # Keep GUI toolkit up to date
                 if self.guiApp:
                     self.guiApp.processEvents()
-                
-                # Wait for a bit at each round
-                time.sleep(self.sleeptime) # 50 ms
             
             
             except KeyboardInterrupt:
@@ -475,12 +567,56 @@ class IepInterpreter:
         return False
     
     
+    def _takeCode(self, msg):
+        """ _takeCode(msg)
+        
+        Take a message received on ctrl-code, and yield the messages of
+        which the code can be run now. The IDE leaves out the source if 
+        it expects that we have it. If we do not, we ask the IDE to send
+        it again, and hold back this message and the ones that follow,
+        so that code is run in the order in which it was sent.
+        
+        """
+        held = self._heldCode
+        if not msg:
+            pass
+        elif msg.get('resent', False):
+            # The answer to our request for a source
+            if held and held[0]['hash'] == msg['hash']:
+                if msg['source'] is None:
+                    held.popleft()
+                    sys.stderr.write('Could not run the code, because its '
+                            'source is no longer available. Please run it '
+                            'again.\n')
+                else:
+                    held[0]['source'] = msg['source']
+        else:
+            held.append(msg)
+        
+        # Yield the messages that can be run, in order
+        while held:
+            msg = held[0]
+            if msg.get('source', None) is None:
+                msg['source'] = self._codeCache.getSource(msg['hash'])
+                if msg['source'] is None:
+                    # Ask the IDE to send it (once)
+                    if not msg.get('requested', False):
+                        msg['requested'] = True
+                        action = 'resend %s' % msg['hash']
+                        self.context._strm_action.send(action)
+                    return
+            yield held.popleft()
+    
+    
     def runlargecode(self, msg):
         """ To execute larger pieces of code. """
         
         # Get information
         source, fname, lineno = msg['source'], msg['fname'], msg['lineno']
         cellName = msg.get('cellName', '')
+        hash = msg.get('hash', None)
+        if hash:
+            self._codeCache.storeSource(hash, source)
         source += '\n'
         
         # Construct notification message
@@ -505,18 +641,26 @@ class IepInterpreter:
         if lineno:
             fname = "%s+%i" % (fname, lineno)
         
-        # Try compiling the source
+        # Try compiling the source, unless it was compiled before. The
+        # flags are included in the key because of future statements.
+        flags = getattr(self._compile.compiler, 'flags', 0)
+        codeKey = hash, fname, flags
         code = None
-        try:            
-            # Compile
-            code = self.compilecode(source, fname, "exec")          
-            
-        except (OverflowError, SyntaxError, ValueError):
-            self.showsyntaxerror(fname)
-            return
+        if hash:
+            code = self._codeCache.getCode(codeKey)
+        if code is None:
+            try:            
+                # Compile
+                code = self.compilecode(source, fname, "exec")          
+                
+            except (OverflowError, SyntaxError, ValueError):
+                self.showsyntaxerror(fname)
+                return
+            if code and hash:
+                self._codeCache.storeCode(codeKey, code)
         
         if code:
-            # Store the source using the (id of the) code object as a key
+            # Store the source for the code object (and those it contains)
             self._codeCollection.storeSource(code, source)
             # Execute the code
             self.execcode(code)
@@ -553,7 +697,7 @@ class IepInterpreter:
             return
         
         if code:
-            # Store the source using the (id of the) code object as a key
+            # Store the source for the code object (and those it contains)
             self._codeCollection.storeSource(code, source)
             # Execute the code
             self.execcode(code)
@@ -609,17 +753,21 @@ class IepInterpreter:
         
         The globals variable is used when in debug mode.
         """
+        self.executionCount += 1
         try:
-            if self._dbFrames:
-                exec(code, self.globals, self.locals)
-            else:
-                exec(code, self.locals)
-        except Exception:
-            time.sleep(0.2) # Give stdout some time to send data
-            self.showtraceback()
-        except KeyboardInterrupt: # is a BaseException, not an Exception
-            time.sleep(0.2)
-            self.showtraceback()
+            try:
+                if self._dbFrames:
+                    exec(code, self.globals, self.locals)
+                else:
+                    exec(code, self.locals)
+            except Exception:
+                time.sleep(0.2) # Give stdout some time to send data
+                self.showtraceback()
+            except KeyboardInterrupt: # is a BaseException, not an Exception
+                time.sleep(0.2)
+                self.showtraceback()
+        finally:
+            self.executionCount += 1
     
     
     ## Writing and error handling
@@ -810,15 +958,137 @@ class IepInterpreter:
         return fname, lineno
 
 
-class ExecutedSourceCollection(dict):
-    """ Stores the source of executed pieces of code, so that the right 
+def getMessageEvent(*channels):
+    """ getMessageEvent(*channels)
+    
+    Get a threading.Event that is set when a message arrives at any of
+    the given sub channels, so that the interpreter can sleep until 
+    there is something to do. Yoton has no public API for this, so 
+    we hook into the push() method of the incoming queues (which is
+    called from the yoton io thread). Returns None if this is not 
+    possible, in which case the channels should be polled.
+    
+    """
+    
+    # Check if all queues can be hooked
+    for channel in channels:
+        queue = getattr(channel, '_q_in', None)
+        if not hasattr(queue, 'push'):
+            return None
+    
+    # Wrap the push methods
+    event = threading.Event()
+    for channel in channels:
+        def push(package, push=channel._q_in.push):
+            push(package)
+            event.set()
+        channel._q_in.push = push
+    return event
+
+
+class ExecutedSourceCollection:
+    """ ExecutedSourceCollection(maxSize=EXECUTED_SOURCE_SIZE)
+    
+    Stores the source of executed pieces of code, so that the right 
     traceback can be reproduced when an error occurs.
-    The codeObject produced by compiling the source is used as a 
-    reference.
+    The code objects produced by compiling the source (including those
+    of the functions and classes defined in it) are used as a reference.
+    They are kept alive, so that their ids are not reused. Identical 
+    sources are stored once. When the sources take more than maxSize
+    characters, the least recently used are discarded.
+    
     """
-    def _getId(self, codeObject):
-        id_ = str(id(codeObject)) + '_' + codeObject.co_filename
+    
+    def __init__(self, maxSize=EXECUTED_SOURCE_SIZE):
+        self._maxSize = maxSize
+        self._entries = {} # source -> [tick, list of lists of code objects]
+        self._sources = {} # id(code object) -> source
+        self._tick = 0
+        self.size = 0 # Total number of characters of the sources
+    
     def storeSource(self, codeObject, source):
-        self[self._getId(codeObject)] = source
+        # Get entry
+        self._tick += 1
+        entry = self._entries.get(source, None)
+        if entry is None:
+            entry = self._entries[source] = [self._tick, []]
+            self.size += len(source)
+        entry[0] = self._tick
+        # Register the code objects, and those that they contain
+        codes, todo = [], [codeObject]
+        while todo:
+            co = todo.pop()
+            if id(co) not in self._sources:
+                self._sources[id(co)] = source
+                codes.append(co)
+                for ob in co.co_consts:
+                    if isinstance(ob, type(codeObject)):
+                        todo.append(ob)
+        if codes:
+            entry[1].append(codes)
+        # Limit the number of compilations of this source
+        while len(entry[1]) > EXECUTED_SOURCE_RUNS:
+            for co in entry[1].pop(0):
+                self._sources.pop(id(co), None)
+        # Limit the total size, but keep the last source
+        while self.size > self._maxSize and len(self._entries) > 1:
+            oldest = min([(e[0], s) for s, e in self._entries.items()])
+            self._discard(oldest[1])
+    
+    def _discard(self, source):
+        entry = self._entries.pop(source)
+        for codes in entry[1]:
+            for co in codes:
+                self._sources.pop(id(co), None)
+        self.size -= len(source)
+    
     def getSource(self, codeObject):
-        return self.get(self._getId(codeObject), '')
+        source = self._sources.get(id(codeObject), '')
+        if source:
+            self._tick += 1
+            self._entries[source][0] = self._tick
+        return source
+
+
+class CompiledCodeCache:
+    """ CompiledCodeCache(maxItems=CODE_CACHE_SIZE)
+    
+    Keeps the sources that the IDE sent (by their hash) and the code 
+    objects compiled from them, so that code that is run again needs
+    not be send nor compiled again. The least recently used items are
+    discarded.
+    
+    """
+    
+    def __init__(self, maxItems=CODE_CACHE_SIZE):
+        self._maxItems = maxItems
+        self._sources = {}
+        self._codes = {}
+        self._tick = 0
+    
+    def _get(self, d, key):
+        item = d.get(key, None)
+        if item is None:
+            return None
+        self._tick += 1
+        d[key] = self._tick, item[1]
+        return item[1]
+    
+    def _set(self, d, key, value):
+        self._tick += 1
+        d[key] = self._tick, value
+        if len(d) > self._maxItems:
+            oldest = min([(item[0], key) for key, item in d.items()])
+            del d[oldest[1]]
+    
+    def getSource(self, hash):
+        return self._get(self._sources, hash)
+    
+    def storeSource(self, hash, source):
+        self._set(self._sources, hash, source)
+    
+    def getCode(self, key):
+        return self._get(self._codes, key)
+    
+    def storeCode(self, key, code):
+        self._set(self._codes, key, code)
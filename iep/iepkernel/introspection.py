@@ -13,12 +13,90 @@ try:
 except ImportError:
     import _thread as thread # Python 3
 
+try:
+    from collections import ChainMap # Python 3.3+
+except ImportError:
+    ChainMap = None
+
+try:
+    import reprlib # Python 3
+except ImportError:
+    import repr as reprlib # Python 2
+
+from collections import deque
+
+
+# The time (in seconds) that the namespace and the objects looked up in 
+# it are cached. Event loop callbacks (e.g. of a GUI toolkit) can change 
+# the namespace without the execution count changing.
+INTROSPECTION_CACHE_TIME = 1.0
+
+# The maximum number of variables per page of the workspace listing, and
+# the time budgets (in seconds) for a page and for the repr of one variable
+WORKSPACE_PAGE_SIZE = 500
+WORKSPACE_PAGE_TIME = 0.2
+WORKSPACE_REPR_TIME = 0.05
+
+# The maximum number of objects to visit to determine the size of a variable
+WORKSPACE_SIZE_OBJECTS = 1000
+
+# Immutable scalar types, of which the description does not change as long
+# as the variable refers to the same object. Containers are not included;
+# even immutable ones can hold mutable elements, which changes their size.
+STABLE_TYPES = (type(None), bool, int, float, complex, str)
+try:
+    STABLE_TYPES += (long, unicode) # Python 2
+except NameError:
+    STABLE_TYPES += (bytes,) # Python 3
+
+# To summarize objects; containers and strings are abbreviated before
+# their repr is built
+_summarizer = reprlib.Repr()
+_summarizer.maxstring = _summarizer.maxother = 80
+
 
 class IepIntrospector(yoton.RepChannel):
     """ This is a RepChannel object that runs a thread to respond to 
     requests from the IDE.
     """
     
+    def __init__(self, *args, **kwargs):
+        yoton.RepChannel.__init__(self, *args, **kwargs)
+        
+        # State of the workspace listing: the name of the namespace, the
+        # description of each variable as last send, and the variables
+        # that remain to be checked in the current round
+        self._wsName = None
+        self._wsSnapshot = {}
+        self._wsPending = []
+        
+        # Types for which repr() turned out to be too slow
+        self._slowReprTypes = set()
+    
+    
+    def _checkCache(self):
+        """ _checkCache()
+        
+        Clear the cached namespace and objects if code has been executed
+        since they were cached, if the namespace has changed (e.g.
+        when debugging), or if they are older than INTROSPECTION_CACHE_TIME.
+        While code is running (the execution count is odd), nothing is 
+        cached.
+        
+        """
+        interpreter = sys._iepInterpreter
+        key = (interpreter.executionCount, 
+                id(interpreter.locals), id(interpreter.globals))
+        now = time.time()
+        if (getattr(self, '_cacheKey', None) != key or 
+                interpreter.executionCount % 2 or 
+                now - self._cacheTime > INTROSPECTION_CACHE_TIME):
+            self._cacheKey = key
+            self._cacheTime = now
+            self._cachedNameSpace = None
+            self._cachedObjects = {}
+    
+    
     def _getNameSpace(self, name=''):
         """ _getNameSpace(name='')
         
@@ -27,14 +105,22 @@ class IepIntrospector(yoton.RepChannel):
         
         """
         
-        # Get namespace
-        NS1 = sys._iepInterpreter.locals
-        NS2 = sys._iepInterpreter.globals
-        if not NS2:
-            NS = NS1
-        else:
-            NS = NS2.copy()
-            NS.update(NS1)
+        # Get namespace. In debug mode, locals and globals are combined 
+        # in a view (or a copy on older Pythons), which is cached until 
+        # code is executed.
+        self._checkCache()
+        NS = self._cachedNameSpace
+        if NS is None:
+            NS1 = sys._iepInterpreter.locals
+            NS2 = sys._iepInterpreter.globals
+            if not NS2:
+                NS = NS1
+            elif ChainMap is not None:
+                NS = ChainMap(NS1, NS2)
+            else:
+                NS = NS2.copy()
+                NS.update(NS1)
+            self._cachedNameSpace = NS
         
         # Look up a name?
         if not name:
@@ -42,7 +128,7 @@ class IepIntrospector(yoton.RepChannel):
         else:
             try:
                 # Get object
-                ob = eval(name, None, NS)
+                ob = self._getObject(name, True)
                 
                 # Get namespace for this object
                 if isinstance(ob, dict):
@@ -66,6 +152,38 @@ class IepIntrospector(yoton.RepChannel):
                 return {}
     
     
+    def _getObject(self, name, moduleGlobals=False):
+        """ _getObject(name, moduleGlobals=False)
+        
+        Get the object with the given name by evaluating it in the 
+        namespace. If moduleGlobals is True, the globals of this module
+        are used too (so that e.g. sys can always be introspected). 
+        The result (or the failure) is cached, see _checkCache().
+        
+        """
+        self._checkCache()
+        key = name, moduleGlobals
+        try:
+            isError, ob = self._cachedObjects[key]
+        except KeyError:
+            NS = self._getNameSpace()
+            try:
+                if moduleGlobals:
+                    ob = eval(name, None, NS)
+                else:
+                    ob = eval(name, {}, NS)
+                isError = False
+            except Exception:
+                # Do not keep the exception, its traceback refers to frames
+                value = sys.exc_info()[1]
+                ob = '%s: %s' % (value.__class__.__name__, str(value))
+                isError = True
+            self._cachedObjects[key] = isError, ob
+        if isError:
+            raise LookupError('Cannot evaluate %r (%s)' % (name, ob))
+        return ob
+    
+    
     def _getSignature(self, objectName):
         """ _getSignature(objectName)
         
@@ -85,26 +203,28 @@ class IepIntrospector(yoton.RepChannel):
         objectNames = ['.'.join(parts[-i:]) for i in range(1,len(parts)+1)]
         
         # find out what kind of function, or if a function at all!
-        NS = self._getNameSpace()
-        fun1 = eval("inspect.isbuiltin(%s)"%(objectName), None, NS)
-        fun2 = eval("inspect.isfunction(%s)"%(objectName), None, NS)
-        fun3 = eval("inspect.ismethod(%s)"%(objectName), None, NS)
+        ob0 = ob = self._getObject(objectName, True)
+        fun1 = inspect.isbuiltin(ob)
+        fun2 = inspect.isfunction(ob)
+        fun3 = inspect.ismethod(ob)
         fun4 = False
         fun5 = False
         if not (fun1 or fun2 or fun3):
             # Maybe it's a class with an init?
-            if eval("hasattr(%s,'__init__')"%(objectName), None, NS):
+            if hasattr(ob, '__init__'):
                 objectName += ".__init__"
-                fun4 = eval("inspect.ismethod(%s)"%(objectName), None, NS)
+                ob = ob.__init__
+                fun4 = inspect.ismethod(ob)
             #  Or a callable object?
-            elif eval("hasattr(%s,'__call__')"%(objectName), None, NS):
+            elif hasattr(ob, '__call__'):
                 objectName += ".__call__"
-                fun5 = eval("inspect.ismethod(%s)"%(objectName), None, NS)
+                ob = ob.__call__
+                fun5 = inspect.ismethod(ob)
         
         sigs = ""
         if True:
             # the first line in the docstring is usually the signature
-            tmp = eval("%s.__doc__"%(objectNames[-1]), {}, NS )
+            tmp = ob0.__doc__
             sigs = ''
             if tmp:
                 sigs = tmp.splitlines()[0].strip()
@@ -140,8 +260,10 @@ class IepIntrospector(yoton.RepChannel):
                 # Use intospection
                 
                 # collect
-                tmp = eval("inspect.getargspec(%s)"%(objectName), None, NS)
-                args, varargs, varkw, defaults = tmp
+                getargspec = getattr(inspect, 'getfullargspec', None)
+                if getargspec is None:
+                    getargspec = inspect.getargspec # Python 2
+                args, varargs, varkw, defaults = getargspec(ob)[:4]
                 
                 # prepare defaults
                 if defaults == None:
@@ -183,16 +305,18 @@ class IepIntrospector(yoton.RepChannel):
         #sys.__stdout__.write('handling '+objectName+'\n')
         #sys.__stdout__.flush()
         
-        # Get namespace
-        NS = self._getNameSpace()
+        # Get object
+        try:
+            ob = self._getObject(objectName)
+        except Exception:
+            return []
         
         # Init names
         names = set()
         
         # Obtain all attributes of the class
         try:
-            command = "dir(%s.__class__)" % (objectName)
-            d = eval(command, {}, NS)
+            d = dir(ob.__class__)
         except Exception:            
             pass
         else:
@@ -200,8 +324,7 @@ class IepIntrospector(yoton.RepChannel):
         
         # Obtain instance attributes
         try:
-            command = "%s.__dict__.keys()" % (objectName)
-            d = eval(command, {}, NS)
+            d = ob.__dict__.keys()
         except Exception:            
             pass
         else:
@@ -210,8 +333,7 @@ class IepIntrospector(yoton.RepChannel):
         # That should be enough, but in case __dir__ is overloaded,
         # query that as well
         try:
-            command = "dir(%s)" % (objectName)
-            d = eval(command, {}, NS)
+            d = dir(ob)
         except Exception:            
             pass
         else:
@@ -221,59 +343,134 @@ class IepIntrospector(yoton.RepChannel):
         return list(names)
     
     
+    def _describe(self, name, val, size=True):
+        """ _describe(name, val, size=True)
+        
+        Get the description of a variable: a list with the name, type, 
+        kind, size and repr. If size is False, the size is omitted.
+        
+        """
+        # Determine type
+        typeName = type(val).__name__
+        # Determine kind
+        kind = typeName
+        if typeName != 'type':
+            if hasattr(val, '__array__') and hasattr(val, 'dtype'):
+                kind = 'array'
+            elif isinstance(val, list):
+                kind = 'list'
+            elif isinstance(val, tuple):
+                kind = 'tuple'
+        # Determine representation
+        if kind == 'array':
+            tmp = 'x'.join([str(s) for s in val.shape])
+            if tmp:
+                repres = '<array %s %s>' % (tmp, val.dtype.name)
+            elif val.size:
+                tmp = str(float(val))
+                if 'int' in val.dtype.name:
+                    tmp = str(int(val))
+                repres = '<array scalar %s (%s)>' % (val.dtype.name, tmp)
+            else:
+                repres = '<array empty %s>' % (val.dtype.name)
+        elif kind == 'list':
+            repres = '<list with %i elements>' % len(val)
+        elif kind == 'tuple':
+            repres = '<tuple with %i elements>' % len(val)
+        elif type(val) in self._slowReprTypes:
+            repres = '<%s object>' % typeName
+        else:
+            t0 = time.time()
+            repres = _summarizer.repr(val)
+            if time.time() - t0 > WORKSPACE_REPR_TIME:
+                self._slowReprTypes.add(type(val))
+            if len(repres) > 80:
+                repres = repres[:77] + '...'
+        # Done
+        if size:
+            return [name, typeName, kind, self._sizeOf(val), repres]
+        else:
+            return [name, typeName, kind, repres]
+    
+    
+    def _sizeOf(self, val):
+        """ _sizeOf(val)
+        
+        Get the approximate number of bytes that an object takes, as a
+        string. For arrays and buffers, nbytes is used. For containers,
+        the elements are included; if there are too many, their size is
+        estimated from the first ones, and the result is prefixed with '~'.
+        Returns an empty string if the size cannot be determined.
+        
+        """
+        getsizeof = getattr(sys, 'getsizeof', None) # Python 2.6+
+        seen = set()
+        budget = [WORKSPACE_SIZE_OBJECTS]
+        exact = [True]
+        
+        def measure(ob):
+            if id(ob) in seen:
+                return 0
+            seen.add(id(ob))
+            budget[0] -= 1
+            # Arrays and buffers
+            if hasattr(ob, '__array__') or type(ob).__name__ == 'memoryview':
+                nbytes = getattr(ob, 'nbytes', None)
+                if nbytes is not None:
+                    return int(nbytes)
+            size = getsizeof(ob)
+            # Containers
+            if isinstance(ob, dict):
+                elements = ob.items()
+            elif isinstance(ob, (list, tuple, set, frozenset, deque)):
+                elements = ob
+            else:
+                return size
+            n, count, total = len(ob), 0, 0
+            for el in elements:
+                if budget[0] <= 0:
+                    break
+                if isinstance(ob, dict):
+                    total += measure(el[0]) + measure(el[1])
+                else:
+                    total += measure(el)
+                count += 1
+            if count < n:
+                exact[0] = False
+                if count:
+                    total = total * n // count
+            return size + total
+        
+        if getsizeof is None and not hasattr(val, 'nbytes'):
+            return ''
+        try:
+            size = measure(val)
+        except Exception:
+            return ''
+        if exact[0]:
+            return str(size)
+        else:
+            return '~' + str(size)
+    
+    
     def dir2(self, objectName):
         """ dir2(objectName)
         
         Get variable names in currently active namespace plus extra information.
         Returns a list with strings, which each contain a (comma separated)
-        list of elements: name, type, kind, repr.
+        list of elements: name, type, kind, repr. (See also dir2diff.)
         
         """ 
         try:
-            name = ''
             names = ['','']
-            def storeInfo(name, val):
-                # Determine type
-                typeName = type(val).__name__
-                # Determine kind
-                kind = typeName
-                if typeName != 'type':
-                    if hasattr(val, '__array__') and hasattr(val, 'dtype'):
-                        kind = 'array'
-                    elif isinstance(val, list):
-                        kind = 'list'
-                    elif isinstance(val, tuple):
-                        kind = 'tuple'
-                # Determine representation
-                if kind == 'array':
-                    tmp = 'x'.join([str(s) for s in val.shape])
-                    if tmp:
-                        repres = '<array %s %s>' % (tmp, val.dtype.name)
-                    elif val.size:
-                        tmp = str(float(val))
-                        if 'int' in val.dtype.name:
-                            tmp = str(int(val))
-                        repres = '<array scalar %s (%s)>' % (val.dtype.name, tmp)
-                    else:
-                        repres = '<array empty %s>' % (val.dtype.name)
-                elif kind == 'list':
-                    repres = '<list with %i elements>' % len(val)
-                elif kind == 'tuple':
-                    repres = '<tuple with %i elements>' % len(val)
-                else:
-                    repres = repr(val)
-                    if len(repres) > 80:
-                        repres = repres[:77] + '...'
-                # Store
-                tmp = ','.join([name, typeName, kind, repres])
-                names.append(tmp)
             
             # Get locals
             NS = self._getNameSpace(objectName)
             for name in NS.keys():
                 if not name.startswith('__'):
                     try:
-                        storeInfo(name, NS[name])
+                        parts = self._describe(name, NS[name], False)
+                        names.append(','.join(parts))
                     except Exception:
                         pass
             
@@ -283,6 +480,91 @@ class IepIntrospector(yoton.RepChannel):
             return []
     
     
+    def dir2diff(self, objectName, reset=False):
+        """ dir2diff(objectName, reset=False)
+        
+        Get the variables in the currently active namespace that changed
+        since the previous call. The description of a variable is a comma
+        separated string with the name, type, kind, size (in bytes, or an
+        estimate prefixed with '~') and repr. Returns a dict with
+        the name of the namespace, 'reset' (if True, all previous variables
+        should be discarded), 'changed' (a list of descriptions), 'removed'
+        (a list of names) and 'complete'. If the changes do not fit in one 
+        page (limited in size and time), 'complete' is False, and the next
+        call gives the rest.
+        
+        """
+        
+        # Start over?
+        if reset or objectName != self._wsName:
+            self._wsName = objectName
+            self._wsSnapshot = {}
+            self._wsPending = []
+            reset = True
+        snapshot = self._wsSnapshot
+        
+        # Get namespace
+        try:
+            NS = self._getNameSpace(objectName)
+            names = [name for name in list(NS.keys()) 
+                            if not name.startswith('__')]
+        except Exception:
+            NS, names = {}, []
+        
+        changed, removed = [], []
+        
+        # Start a new round? Then we can detect removed variables
+        if not self._wsPending:
+            nameSet = set(names)
+            for name in list(snapshot.keys()):
+                if name not in nameSet:
+                    del snapshot[name]
+                    removed.append(name)
+            names.sort()
+            names.reverse()
+            self._wsPending = names
+        
+        # Check variables until the page is full or the time is up
+        t0 = time.time()
+        count = sys._iepInterpreter.executionCount
+        pending = self._wsPending
+        while pending:
+            if len(changed) >= WORKSPACE_PAGE_SIZE:
+                break
+            if time.time() - t0 > WORKSPACE_PAGE_TIME:
+                break
+            name = pending.pop()
+            try:
+                val = NS[name]
+            except Exception:
+                if snapshot.pop(name, None) is not None:
+                    removed.append(name)
+                continue
+            # Skip if the variable has not changed: it refers to the same
+            # object and either its type is stable or no code has run
+            old = snapshot.get(name, None)
+            if old is not None and old[0] == id(val):
+                if old[1] is val or old[2] == count:
+                    continue
+            # Describe
+            try:
+                des = ','.join(self._describe(name, val))
+            except Exception:
+                continue
+            # Store (keep a reference only to immutable scalars, so the 
+            # identity check is reliable; other objects are not kept alive)
+            ref = None
+            if isinstance(val, STABLE_TYPES):
+                ref = val
+            snapshot[name] = id(val), ref, count, des
+            if old is None or old[3] != des:
+                changed.append(des)
+        
+        # Done
+        return {'name': objectName, 'reset': reset, 'changed': changed,
+                'removed': removed, 'complete': not pending}
+    
+    
     def signature(self, objectName):
         """ signature(objectName)
         
@@ -303,35 +585,34 @@ class IepIntrospector(yoton.RepChannel):
         
         """
         
-        # Get namespace
-        NS = self._getNameSpace()
-        
         try:
             
+            # Get object
+            ob = self._getObject(objectName)
+            
             # collect docstring
             h_text = ''
             # Try using the class (for properties)
             try:
-                className = eval("%s.__class__.__name__"%(objectName), {}, NS)
-                if '.' in objectName:
-                    tmp = objectName.rsplit('.',1)
-                    tmp[1] += '.'
-                else:
-                    tmp = [objectName, '']
+                className = ob.__class__.__name__
                 if className not in ['type', 'module', 'builtin_function_or_method']:
-                    cmd = "%s.__class__.%s__doc__"
-                    h_text = eval(cmd % (tmp[0],tmp[1]), {}, NS)
+                    if '.' in objectName:
+                        parentName, attr = objectName.rsplit('.',1)
+                        parent = self._getObject(parentName)
+                        h_text = getattr(parent.__class__, attr).__doc__
+                    else:
+                        h_text = ob.__class__.__doc__
             except Exception:
                 pass
             
             # Normal doc
             if not h_text:
-                h_text = eval("%s.__doc__"%(objectName), {}, NS )
+                h_text = ob.__doc__
             
             # collect more data            
-            h_repr = eval("repr(%s)"%(objectName), {}, NS )
+            h_repr = repr(ob)
             try:
-                h_class = eval("%s.__class__.__name__"%(objectName), {}, NS )
+                h_class = ob.__class__.__name__
             except Exception:
                 h_class = "unknown"
             
@@ -365,6 +646,21 @@ class IepIntrospector(yoton.RepChannel):
         return text
     
     
+    def introspect(self, objectName, kinds):
+        """ introspect(objectName, kinds)
+        
+        Get several kinds of information (e.g. 'dir', 'signature' and 
+        'doc') for the same object in one request. Returns a dict that
+        maps each kind to the result of the corresponding method.
+        
+        """
+        result = {}
+        for kind in kinds:
+            if kind in ('dir', 'signature', 'doc'):
+                result[kind] = getattr(self, kind)(objectName)
+        return result
+    
+    
     def eval(self, command):
         """ eval(command)
         
@@ -43,8 +43,12 @@ reqp-introspect (OBJECT): To query information from the kernel (and for interrup
 import os
 import sys
 import time
+from iepkernel.timing import StartupTimer
+startupTimer = StartupTimer() # Measure how long the startup takes
 import yoton
 import __main__ # we will run code in the __main__.__dict__ namespace
+from iepkernel.streams import BufferedFileWrapper
+startupTimer.mark('kernel imports')
 
 
 ## Make connection object and get channels
@@ -73,11 +77,15 @@ ct._stat_startup = yoton.StateChannel(ct, 'stat-startup', yoton.OBJECT)
 # error occurs here, it will be printed in the shell.
 port = int(sys.argv[1])
 ct.connect('localhost:'+str(port), timeout=1.0)
+startupTimer.mark('connecting')
 
-# Create file objects for stdin, stdout, stderr
+# Create file objects for stdin, stdout, stderr. The output is buffered;
+# the interpreter sets the flush policy that is given in the startup info.
+# The buffered text is send as one message (chunksize 0).
 sys.stdin = yoton.FileWrapper( ct._ctrl_command, echo=ct._strm_echo )
-sys.stdout = yoton.FileWrapper( ct._strm_out, 256 )
-sys.stderr = yoton.FileWrapper( ct._strm_err, 256 )
+sys.stdout = BufferedFileWrapper( ct._strm_out, 0 )
+sys.stderr = BufferedFileWrapper( ct._strm_err, 0 )
+startupTimer.mark('stream replacement')
 
 
 ## Set Excepthook
@@ -120,11 +128,16 @@ __iep__.context = ct
 # Create introspection req channel (store at interpreter instance)
 __iep__.introspector = IepIntrospector(ct, 'reqp-introspect')
 
+# Store the startup timer, the interpreter marks the remaining phases
+__iep__.startupTimer = startupTimer
+startupTimer.mark('interpreter creation')
+
 
 ## Clean up
 
 # Delete local variables
-del yoton, IepInterpreter, IepIntrospector, iep_excepthook
+del yoton, BufferedFileWrapper, IepInterpreter, IepIntrospector, iep_excepthook
+del StartupTimer, startupTimer
 del ct, port
 del os, sys, time
 
@@ -141,9 +154,18 @@ try:
     __iep__.interact()
     
 finally:
+    # Stop timing imports, in case the startup did not finish (e.g. the
+    # startup script raised SystemExit)
+    try:
+        if __iep__.startupTimer is not None:
+            __iep__.startupTimer.stop()
+    except Exception:
+        pass
     # Restore original streams, so that SystemExit behaves as intended
     import sys
     try:   
+        from iepkernel.streams import flushAll
+        flushAll()
         sys.stdout, sys.stderr = sys.__stdout__, sys.__stderr__
     except Exception:
         pass
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012, the IEP development team
+#
+# IEP is distributed under the terms of the (new) BSD License.
+# The full license can be found in 'license.txt'.
+
+
+""" Module streams
+
+Implements the file objects that replace stdout and stderr in the kernel.
+The written text is buffered, so that a loop of small print statements
+does not result in a flood of tiny messages. The buffer is flushed when
+it exceeds a certain size, a short while after the first text is written,
+and when the interpreter sends a new prompt.
+
+"""
+
+import sys, time, threading
+import yoton
+
+try:
+    _stringTypes = basestring # Python 2
+except NameError:
+    _stringTypes = str # Python 3
+
+
+# All buffered file wrappers share a lock, and a thread that flushes them
+_lock = threading.RLock()
+_condition = threading.Condition(_lock)
+_wrappers = []
+_thread = None
+
+
+class BufferedFileWrapper(yoton.FileWrapper):
+    """ BufferedFileWrapper(channel, chunksize=0, maxSize=8192, maxDelay=0.03)
+    
+    A yoton FileWrapper that buffers the written text. The buffer is
+    flushed when it holds maxSize characters, or maxDelay seconds after
+    text was written to an empty buffer. If either is zero, the text is
+    send right away. Writing to a wrapper first flushes the other
+    wrappers, so that the order of stdout and stderr output is retained.
+    
+    """
+    
+    def __init__(self, channel, chunksize=0, maxSize=8192, maxDelay=0.03):
+        yoton.FileWrapper.__init__(self, channel, chunksize)
+        self._buffer = []
+        self._bufferSize = 0
+        self._deadline = None
+        self.setFlushPolicy(maxSize, maxDelay)
+        _wrappers.append(self)
+    
+    
+    def setFlushPolicy(self, maxSize, maxDelay):
+        """ setFlushPolicy(maxSize, maxDelay)
+        Set the maximum amount of characters to buffer, and the maximum
+        time (in seconds) to hold on to the text.
+        """
+        self.flush()
+        self._maxSize = int(maxSize)
+        self._maxDelay = float(maxDelay)
+    
+    
+    def write(self, s):
+        # Check the type now; a wrong type in the buffer would break all
+        # flushes that follow
+        if not isinstance(s, _stringTypes):
+            if hasattr(s, 'decode'):
+                s = s.decode('utf-8', 'replace') # bytes on Python 3
+            else:
+                raise ValueError('Can only write strings to %s.' % 
+                                                    self.__class__.__name__)
+        if self._maxSize <= 0 or self._maxDelay <= 0:
+            flushAll()
+            yoton.FileWrapper.write(self, s)
+            return
+        _lock.acquire()
+        try:
+            # Make sure that the output of other streams comes first
+            for wrapper in _wrappers:
+                if wrapper is not self and wrapper._buffer:
+                    wrapper._flush()
+            # Buffer
+            self._buffer.append(s)
+            self._bufferSize += len(s)
+            if self._bufferSize >= self._maxSize:
+                self._flush()
+            elif self._deadline is None:
+                self._deadline = time.time() + self._maxDelay
+                _startThread()
+                _condition.notify()
+        finally:
+            _lock.release()
+    
+    
+    def flush(self):
+        _lock.acquire()
+        try:
+            self._flush()
+        finally:
+            _lock.release()
+    
+    
+    def _flush(self):
+        # Should be called with the lock held
+        self._deadline = None
+        if self._buffer:
+            buffer, self._buffer, self._bufferSize = self._buffer, [], 0
+            yoton.FileWrapper.write(self, ''.join(buffer))
+
+
+def flushAll():
+    """ flushAll()
+    Flush the buffers of all buffered file wrappers.
+    """
+    _lock.acquire()
+    try:
+        for wrapper in _wrappers:
+            try:
+                wrapper._flush()
+            except Exception:
+                _reportError()
+    finally:
+        _lock.release()
+
+
+def _reportError():
+    """ Write the current exception to the original stderr, since the 
+    streams of the kernel may be what fails.
+    """
+    try:
+        value = sys.exc_info()[1]
+        sys.__stderr__.write('Error flushing output: %s\n' % str(value))
+    except Exception:
+        pass
+
+
+def _startThread():
+    """ Start the thread that flushes the buffers when their time is up.
+    """
+    global _thread
+    if _thread is None:
+        _thread = threading.Thread(target=_flushLoop, name='iep-flush')
+        if hasattr(threading.Thread, 'daemon'):
+            _thread.daemon = True
+        else:
+            _thread.setDaemon(True) # Python < 2.6
+        _thread.start()
+
+
+def _flushLoop():
+    _lock.acquire()
+    try:
+        try:
+            while True:
+                # Get the first deadline
+                deadlines = [w._deadline for w in _wrappers
+                                if w._deadline is not None]
+                if not deadlines:
+                    _condition.wait()
+                    continue
+                delay = min(deadlines) - time.time()
+                if delay > 0:
+                    _condition.wait(delay)
+                    continue
+                # Flush the buffers whose time is up. An error (e.g. 
+                # because the channel is closed) should not stop us.
+                now = time.time()
+                for wrapper in _wrappers:
+                    if wrapper._deadline is not None and wrapper._deadline <= now:
+                        try:
+                            wrapper._flush()
+                        except Exception:
+                            _reportError()
+        except Exception:
+            pass # Interpreter is shutting down
+    finally:
+        _lock.release()
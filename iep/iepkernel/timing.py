@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# Copyright (C) 2012, the IEP development team
+#
+# IEP is distributed under the terms of the (new) BSD License.
+# The full license can be found in 'license.txt'.
+
+
+""" Module timing
+
+Implements a timer for the startup of the kernel. It records how long
+each phase of the startup takes, and how long the modules that are
+imported in the meantime take to import. The report is send to the IDE
+via the stat-startup channel.
+
+"""
+
+import sys, time, threading
+
+try:
+    import __builtin__ as builtins # Python 2
+except ImportError:
+    import builtins # Python 3
+
+
+# The number of slowest imports to report
+NUMBER_OF_IMPORTS = 10
+
+# threading.currentThread is deprecated since Python 2.6
+_currentThread = getattr(threading, 'current_thread', None) or \
+                    threading.currentThread
+
+
+class StartupTimer:
+    """ StartupTimer()
+    
+    Measures the time of the phases of the startup. Call mark(name) at
+    the end of each phase, and stop() when done. Until then, the imports
+    done in the main thread are timed too (like "python -X importtime").
+    
+    """
+    
+    def __init__(self):
+        self._t0 = self._t1 = time.time()
+        self._phases = []
+        
+        # Imports: for each module the time spent importing it (excluding
+        # the modules it imports), and the total time
+        self._imports = {}
+        self._stack = [] # Time spent on nested imports, per level
+        self._thread = _currentThread()
+        self._originalImport = builtins.__import__
+        builtins.__import__ = self._import
+    
+    
+    def _import(self, name, *args, **kwargs):
+        if name in sys.modules or _currentThread() is not self._thread:
+            return self._originalImport(name, *args, **kwargs)
+        t0 = time.time()
+        self._stack.append(0.0)
+        try:
+            return self._originalImport(name, *args, **kwargs)
+        finally:
+            total = time.time() - t0
+            nested = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += total
+            own, total0 = self._imports.get(name, (0.0, 0.0))
+            self._imports[name] = own + total - nested, total0 + total
+    
+    
+    def reset(self):
+        """ reset()
+        Start timing anew (e.g. when a prestarted kernel is taken into
+        use), forgetting the phases and imports so far.
+        """
+        self._t0 = self._t1 = time.time()
+        self._phases = []
+        self._imports = {}
+    
+    
+    def mark(self, name):
+        """ mark(name)
+        Mark the end of the phase with the given name.
+        """
+        t = time.time()
+        self._phases.append((name, t - self._t1))
+        self._t1 = t
+    
+    
+    def stop(self):
+        """ stop()
+        Stop timing imports, and get the report: a dict with the total
+        time, the phases (a list of (name, seconds) tuples), and the
+        slowest imports (a list of (name, seconds, total seconds) tuples).
+        Can safely be called more than once.
+        """
+        if builtins.__import__ == self._import:
+            builtins.__import__ = self._originalImport
+        imports = [(v[1], v[0], k) for k, v in self._imports.items()]
+        imports.sort()
+        imports.reverse()
+        imports = [(k, own, total) for total, own, k in imports]
+        return {'total': time.time() - self._t0,
+                'phases': self._phases,
+                'imports': imports[:NUMBER_OF_IMPORTS] }
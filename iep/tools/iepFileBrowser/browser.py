@@ -140,6 +140,9 @@ class Browser(QtGui.QWidget):
         self.parent().config.starredDirs.append(newProject)
         # Update list
         self._projects.updateProjectList()
+        # Update the index of the symbols in the projects
+        if iep.symbolIndex is not None:
+            iep.symbolIndex.update()
     
     def removeStarredDir(self, path):
         """ Remove the given path from the starred directories.
@@ -153,6 +156,9 @@ class Browser(QtGui.QWidget):
                 starredDirs.remove(d)
         # Update list
         self._projects.updateProjectList()
+        # Update the index of the symbols in the projects
+        if iep.symbolIndex is not None:
+            iep.symbolIndex.update()
     
     def test(self, sort=False):
         items = []
@@ -196,7 +196,7 @@ class IepInteractiveHelp(QtGui.QWidget):
         # Get shell and ask for the documentation
         shell = iep.shells.getCurrentShell()
         if shell and name:
-            future = shell._request.doc(name)
+            future = shell._introspection.request('doc', name)
             future.add_done_callback(self.queryDoc_response)
         elif not name:
             self.setText(initText)
@@ -302,10 +302,14 @@ class ProjectsModel(QtCore.QAbstractListModel):
     def add(self,project):
         self.config.projects.append(project)
         self.reset()
+        if iep.symbolIndex is not None:
+            iep.symbolIndex.update()
         return self.config.projects.index(project)
     def remove(self,project):
         self.config.projects.remove(project)
         self.reset()
+        if iep.symbolIndex is not None:
+            iep.symbolIndex.update()
     def projectFromIndex(self,index):
         return self.config.projects[index.row()]
     def projectFromRow(self,row):
@@ -5,7 +5,7 @@
 # The full license can be found in 'license.txt'.
 
 
-import time
+import time, difflib
 from iep.codeeditor.qt import QtCore, QtGui
 import iep
 
@@ -40,7 +40,7 @@ class IepSourceStructure(QtGui.QWidget):
         self._slider.setPageStep(1)
         self._slider.setRange(1,9)
         self._slider.setValue(self._config.level)
-        self._slider.valueChanged.connect(self.updateStructure)
+        self._slider.valueChanged.connect(self.onSliderChanged)
         
         # Create options button
         #self._options = QtGui.QPushButton(self)
@@ -59,7 +59,6 @@ class IepSourceStructure(QtGui.QWidget):
         # Create tree widget        
         self._tree = QtGui.QTreeWidget(self)
         self._tree.setHeaderHidden(True)
-        self._tree.itemCollapsed.connect(self.updateStructure) # keep expanded
         self._tree.itemClicked.connect(self.onItemClick)
         
         # Create two sizers
@@ -81,6 +80,11 @@ class IepSourceStructure(QtGui.QWidget):
         # Init current-file name
         self._currentEditorId = 0
         
+        # The item of the current line, and whether to expand the items
+        # according to the level on the next update
+        self._selectedItem = None
+        self._resetExpansion = False
+        
         # Bind to events
         iep.editors.currentChanged.connect(self.onEditorsCurrentChanged)
         iep.editors.parserDone.connect(self.updateStructure)
@@ -135,6 +139,7 @@ class IepSourceStructure(QtGui.QWidget):
         # Get editor and clear list
         editor = iep.editors.getCurrentEditor()        
         self._tree.clear()
+        self._selectedItem = None
         
         if editor is None:
             # Set editor id
@@ -152,6 +157,12 @@ class IepSourceStructure(QtGui.QWidget):
             self.updateStructure()
     
     
+    def onSliderChanged(self):
+        """ Show the items up to the selected level. """
+        self._resetExpansion = True
+        self.updateStructure()
+    
+    
     def onItemClick(self, item):
         """ Go to the right line in the editor and give focus. """
         
@@ -181,7 +192,7 @@ class IepSourceStructure(QtGui.QWidget):
             return
         
         # Something to show
-        result = iep.parser._getResult()
+        result = iep.parser._getResult(editor)
         if result is None:
             return
         
@@ -197,6 +208,11 @@ class IepSourceStructure(QtGui.QWidget):
         # Define colours
         colours = {'cell':'#007F00', 'class':'#0000FF', 'def':'#007F7F', 
                     'attribute':'#444444', 'import':'#8800BB', 'todo':'#FF3333'}
+        brushes = {}
+        for type in colours:
+            brushes[type] = QtGui.QBrush(QtGui.QColor(colours[type]))
+        font = self._tree.font()
+        font.setBold(True)
         
         # Define what to show
         showTypes = self._config.showTypes
@@ -204,52 +220,95 @@ class IepSourceStructure(QtGui.QWidget):
         # Define to what level to show (now is also a good time to save)
         showLevel = int( self._slider.value() )
         self._config.level = showLevel
-        
-        # Define function to set items
+        resetExpansion, self._resetExpansion = self._resetExpansion, False
+        
+        # Get the classes and defs that contain the current line
+        scopes = result.scopeIndex.getScopes(ln)
+        
+        # Define function to get the text of an item
+        def GetText(object):
+            type = object.type
+            if type=='cell':
+                type = '##'
+            elif type=='attribute':
+                type = 'attr'
+            #
+            if type == 'import':                   
+                return "%s (%s)" % (object.name, object.text)
+            elif type=='todo':
+                return object.name
+            else:
+                return "%s %s" % (type, object.name)
+        
+        # Define function to create an item
+        def CreateItem(object, key):
+            thisItem = QtGui.QTreeWidgetItem([key[1]])
+            thisItem.setForeground(0, brushes[object.type])
+            thisItem.setFont(0, font)
+            thisItem.key = key
+            return thisItem
+        
+        # Define function to update the items of a parent item. The items
+        # are compared with the objects by type and text, so that only the
+        # items that changed need to be inserted, removed or relabeled. 
         selectedItem = [None]
         def SetItems(parentItem, fictiveObjects, level):
             level += 1
-            for object in fictiveObjects:
-                type = object.type
-                if not type in showTypes:
-                    continue
-                # Construct text
-                if type=='cell':
-                    type = '##'
-                elif type=='attribute':
-                    type = 'attr'
-                #
-                if type == 'import':                   
-                    text = "%s (%s)" % (object.name, object.text)
-                elif type=='todo':
-                    text = object.name
-                else:
-                    text = "%s %s" % (type, object.name)
-                # Create item
-                thisItem = QtGui.QTreeWidgetItem(parentItem, [text])
-                color = QtGui.QColor(colours[object.type])
-                thisItem.setForeground(0, QtGui.QBrush(color))
-                font = thisItem.font(0)
-                font.setBold(True)
-                thisItem.setFont(0, font)
+            objects = [ob for ob in fictiveObjects if ob.type in showTypes]
+            keys = [(ob.type, GetText(ob)) for ob in objects]
+            oldKeys = [getattr(parentItem.child(i), 'key', None) 
+                        for i in range(parentItem.childCount())]
+            # Apply changes, starting at the end so that indices stay valid
+            newItems = set()
+            if keys != oldKeys:
+                matcher = difflib.SequenceMatcher(None, oldKeys, keys, False)
+                for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes()):
+                    if tag == 'equal':
+                        continue
+                    # Relabel items that were replaced by an object of the
+                    # same type (e.g. renamed), keeping their state
+                    while (i1 < i2 and j1 < j2 and oldKeys[i1] and 
+                            oldKeys[i1][0] == keys[j1][0]):
+                        thisItem = parentItem.child(i1)
+                        thisItem.setText(0, keys[j1][1])
+                        thisItem.key = keys[j1]
+                        i1, j1 = i1 + 1, j1 + 1
+                    for i in reversed(range(i1, i2)):
+                        parentItem.takeChild(i)
+                    for j in range(j1, j2):
+                        thisItem = CreateItem(objects[j], keys[j])
+                        parentItem.insertChild(i1 + j - j1, thisItem)
+                        newItems.add(id(thisItem))
+            # Update the items and their children
+            for i, object in enumerate(objects):
+                thisItem = parentItem.child(i)
                 thisItem.linenr = object.linenr
                 # Is this the current item?
-                if ln and object.linenr <= ln and object.linenr2 > ln:
+                if object.type in ['class', 'def']:
+                    if object in scopes:
+                        selectedItem[0] = thisItem
+                elif ln and object.linenr <= ln and object.linenr2 > ln:
                     selectedItem[0] = thisItem 
                 # Any children that we should display?
-                if object.children:
-                    SetItems(thisItem, object.children, level)
-                # Set visibility 
-                thisItem.setExpanded( bool(level < showLevel) )
+                SetItems(thisItem, object.children, level)
+                # Set visibility of new items
+                if resetExpansion or id(thisItem) in newItems:
+                    thisItem.setExpanded( bool(level < showLevel) )
         
         # Go
         self._tree.setUpdatesEnabled(False)
-        self._tree.clear()
-        SetItems(self._tree, result.rootItem.children, 0)
+        SetItems(self._tree.invisibleRootItem(), result.rootItem.children, 0)
         self._tree.setUpdatesEnabled(True)
         
-        # Handle selected item
+        # Handle selected item. Only scroll if it changed, so that the 
+        # user can scroll the tree.
         selectedItem = selectedItem[0]
-        if selectedItem:
-            selectedItem.setBackground(0, QtGui.QBrush(QtGui.QColor('#CCC')))
-            self._tree.scrollToItem(selectedItem) # ensure visible
+        if selectedItem is not self._selectedItem:
+            try:
+                self._selectedItem.setBackground(0, QtGui.QBrush())
+            except (AttributeError, RuntimeError):
+                pass # No previous item, or it has been removed
+            self._selectedItem = selectedItem
+            if selectedItem:
+                selectedItem.setBackground(0, QtGui.QBrush(QtGui.QColor('#CCC')))
+                self._tree.scrollToItem(selectedItem) # ensure visible
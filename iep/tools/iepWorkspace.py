@@ -32,6 +32,31 @@ def joinName(parts):
     return name.replace('.[', '[')
 
 
+def formatSize(size):
+    """ formatSize(size)
+    Get a readable version of a size as given by the kernel (the number 
+    of bytes as a string, prefixed with '~' if it is an estimate). 
+    Returns the text and the number of bytes (-1 if unknown).
+    """
+    prefix = ''
+    if size.startswith('~'):
+        prefix, size = '~', size[1:]
+    try:
+        nbytes = int(size)
+    except ValueError:
+        return '', -1
+    if nbytes < 1024:
+        text = '%i bytes' % nbytes
+    else:
+        value = float(nbytes)
+        for unit in ['KB', 'MB', 'GB', 'TB']:
+            value /= 1024
+            if value < 1024:
+                break
+        text = '%1.1f %s' % (value, unit)
+    return prefix + text, nbytes
+
+
 class WorkspaceProxy(QtCore.QObject):
     """ WorkspaceProxy
     
@@ -46,12 +71,25 @@ class WorkspaceProxy(QtCore.QObject):
     def __init__(self):
         QtCore.QObject.__init__(self)
         
-        # Variables
-        self._variables = []
+        # Variables (descriptions by name)
+        self._variables = {}
+        
+        # Changes since the tree was last updated: whether all variables
+        # are new, and the names of changed and removed variables
+        self._reset = True
+        self._changed = []
+        self._removed = []
         
         # Element to get more info of
         self._name = ''
         
+        # The shell that we have the variables of, the current request, and
+        # whether to do another request (and a full one) when it is done
+        self._shell = None
+        self._future = None
+        self._needUpdate = False
+        self._needReset = False
+        
         # Bind to events
         iep.shells.currentShellChanged.connect(self.onCurrentShellChanged)
         iep.shells.currentShellStateChanged.connect(self.onCurrentShellStateChanged)
@@ -75,11 +113,8 @@ class WorkspaceProxy(QtCore.QObject):
         Set the name that we want to know more of. 
         """
         self._name = name
-        
-        shell = iep.shells.getCurrentShell()
-        if shell:
-            future = shell._request.dir2(self._name)
-            future.add_done_callback(self.processResponse)
+        self._future = None # Ignore the response to a pending request
+        self.requestUpdate(True)
     
     
     def goUp(self):
@@ -99,8 +134,7 @@ class WorkspaceProxy(QtCore.QObject):
         """
         shell = iep.shells.getCurrentShell()
         if not shell:
-            self._variables = []
-            self.haveNewData.emit()
+            self.requestUpdate()
     
     
     def onCurrentShellStateChanged(self):
@@ -108,12 +142,43 @@ class WorkspaceProxy(QtCore.QObject):
         Do a request for information! 
         """ 
         shell = iep.shells.getCurrentShell()
+        if not shell or shell._state.lower() != 'busy':
+            self.requestUpdate()
+    
+    
+    def requestUpdate(self, reset=False):
+        """ requestUpdate(reset=False)
+        Ask the current shell for the variables that changed since the
+        previous request. If reset is True, ask for all variables. Only
+        one request is underway at a time, so that the changes are
+        applied in order.
+        """
+        
+        # Has the shell changed?
+        shell = iep.shells.getCurrentShell()
+        if shell is not self._shell:
+            self._shell = shell
+            self._future = None
+            reset = True
+        
+        # No shell, no variables
         if not shell:
-            # Should never happen I think, but just to be sure
-            self._variables = []
-        elif shell._state.lower() != 'busy':
-            future = shell._request.dir2(self._name)
-            future.add_done_callback(self.processResponse)
+            self._variables = {}
+            self._reset, self._changed, self._removed = True, [], []
+            self.haveNewData.emit()
+            return
+        
+        # Wait for the current request?
+        reset = reset or self._needReset
+        if self._future is not None:
+            self._needUpdate = True
+            self._needReset = reset
+            return
+        
+        # Request
+        self._needUpdate = self._needReset = False
+        self._future = shell._request.dir2diff(self._name, reset)
+        self._future.add_done_callback(self.processResponse)
     
     
     def processResponse(self, future):
@@ -121,7 +186,12 @@ class WorkspaceProxy(QtCore.QObject):
         We got a response, update our list and notify the tree.
         """
         
-        response = []
+        # Ignore responses to requests that were superseded
+        if future is not self._future:
+            return
+        self._future = None
+        
+        response = None
         
         # Process future
         if future.cancelled():
@@ -131,9 +201,58 @@ class WorkspaceProxy(QtCore.QObject):
         else:
             response = future.result()
         
-        self._variables = response
-        self.haveNewData.emit()
+        if not response:
+            # The changes are lost, do a full request next time
+            self._needReset = True
+        else:
+            # Apply changes
+            if response['reset']:
+                self._variables = {}
+                self._reset, self._changed, self._removed = True, [], []
+            for name in response['removed']:
+                self._variables.pop(name, None)
+                self._removed.append(name)
+            for des in response['changed']:
+                name = des.split(',', 1)[0]
+                self._variables[name] = des
+                self._changed.append(name)
+            self.haveNewData.emit()
+            # Get the next page
+            if not response['complete']:
+                self._needUpdate = True
+        
+        # Do the request that was postponed
+        if self._needUpdate:
+            self.requestUpdate()
+    
+    
+    def takeChanges(self):
+        """ takeChanges()
+        Get the changes since the last call, as a tuple (reset, changed,
+        removed). The names of changed and removed variables may occur 
+        more than once.
+        """
+        changes = self._reset, self._changed, self._removed
+        self._reset, self._changed, self._removed = False, [], []
+        return changes
+    
+
+
+class WorkspaceItem(QtGui.QTreeWidgetItem):
+    """ WorkspaceItem
+    
+    An item in the workspace tree. Sorts the size column by the number 
+    of bytes rather than by text.
     
+    """
+    
+    nbytes = -1
+    
+    def __lt__(self, other):
+        if self.treeWidget().sortColumn() == 2:
+            return self.nbytes < getattr(other, 'nbytes', -1)
+        return QtGui.QTreeWidgetItem.__lt__(self, other)
+
 
 
 class WorkspaceTree(QtGui.QTreeWidget):
@@ -154,8 +273,8 @@ class WorkspaceTree(QtGui.QTreeWidget):
         
         # Set header stuff
         self.setHeaderHidden(False)
-        self.setColumnCount(3)
-        self.setHeaderLabels(['Name', 'Type', 'Repr'])
+        self.setColumnCount(4)
+        self.setHeaderLabels(['Name', 'Type', 'Size', 'Repr'])
         #self.setColumnWidth(0, 100)
         self.setSortingEnabled(True)
         
@@ -163,6 +282,9 @@ class WorkspaceTree(QtGui.QTreeWidget):
         self.setAlternatingRowColors(True)
         self.setRootIsDecorated(False)
         
+        # Items by variable name
+        self._items = {}
+        
         # Create proxy
         self._proxy = WorkspaceProxy()
         self._proxy.haveNewData.connect(self.fillWorkspace)
@@ -235,37 +357,62 @@ class WorkspaceTree(QtGui.QTreeWidget):
     
     def fillWorkspace(self):
         """ fillWorkspace()
-        Update the workspace tree.
+        Update the workspace tree. Only the items of variables that
+        changed are updated.
         """
         
-        # Clear first
-        self.clear()
+        reset, changed, removed = self._proxy.takeChanges()
+        
+        # Clear first?
+        if reset:
+            self.clear()
+            self._items = {}
         
         # Set name
         line = self.parent()._line
         line.setText(self._proxy._name)
         
+        # Sort once, when all items are updated
+        self.setSortingEnabled(False)
+        
+        # Remove elements
+        for name in removed:
+            item = self._items.pop(name, None)
+            if item is not None:
+                self.takeTopLevelItem(self.indexOfTopLevelItem(item))
         
-        # Add elements
-        for des in self._proxy._variables:
+        # Add or update elements
+        for name in changed:
             
             # Get parts
+            des = self._proxy._variables.get(name, '')
             parts = des.split(',',4)
-            if len(parts) < 4:
+            if len(parts) < 5:
                 continue
             
             # Pop the 'kind' element
             kind = parts.pop(2)
             
-            # Create item
-            item = QtGui.QTreeWidgetItem(parts, 0)
-            self.addTopLevelItem(item)
+            # Make size readable
+            parts[2], nbytes = formatSize(parts[2])
+            
+            # Create item, or update it
+            item = self._items.get(name, None)
+            if item is None:
+                item = WorkspaceItem(parts, 0)
+                self.addTopLevelItem(item)
+                self._items[name] = item
+            else:
+                for i in range(len(parts)):
+                    item.setText(i, parts[i])
+            item.nbytes = nbytes
             
             # Set tooltip
             tt = '%s: %s' % (parts[0], parts[-1])
-            item.setToolTip(0,tt)
-            item.setToolTip(1,tt)
-            item.setToolTip(2,tt)
+            for i in range(len(parts)):
+                item.setToolTip(i,tt)
+        
+        self.setSortingEnabled(True)
 
 
 class IepWorkspace(QtGui.QWidget):
@@ -32,4 +32,10 @@ except ImportError:
 
 
 import iep
-iep.startIep()
+
+# Start IEP (worker processes, e.g. of the source parser, import this 
+# module too, but should not start IEP)
+if __name__ == '__main__':
+    import multiprocessing
+    multiprocessing.freeze_support()
+    iep.startIep()